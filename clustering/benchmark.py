@@ -0,0 +1,194 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from pipeline import CLUSTERING_DIR, Pipeline, Stage, build_stages
+
+sys.path.insert(0, os.path.join(CLUSTERING_DIR, "util_scripts"))
+from synthetic_data import cluster_sizes, sample_sphere
+
+# Pipeline stages timed by the benchmark, in run order, plus the final evaluation
+BENCHMARK_STAGES = ("ground_truth", "kmeans", "knn_graph", "training_data_kmeans", "docs_baseline",
+                    "ground_truth_baseline", "evaluate")
+
+
+def make_dataset(output_dir, num_docs, num_queries, dim, num_clusters, seed=0, chunk_size=65536):
+    """Writes clustered synthetic docs.npy and queries.npy (a Gaussian mixture on the sphere)."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_clusters, dim), dtype=np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    sizes = cluster_sizes(num_docs, num_clusters, 0.5, rng)
+
+    docs_path, queries_path = os.path.join(output_dir, "docs.npy"), os.path.join(output_dir, "queries.npy")
+    docs = np.lib.format.open_memmap(docs_path, mode="w+", dtype=np.float32, shape=(num_docs, dim))
+    start = 0
+    for c in range(num_clusters):
+        for offset in range(0, sizes[c], chunk_size):
+            count = min(chunk_size, sizes[c] - offset)
+            docs[start:start + count] = sample_sphere(centers[c], count, 1.0, rng)
+            start += count
+    docs.flush()
+    del docs
+
+    components = rng.choice(num_clusters, size=num_queries, p=sizes / num_docs)
+    np.save(queries_path, np.concatenate([sample_sphere(centers[c], 1, 1.0, rng) for c in components]))
+    return docs_path, queries_path
+
+
+def _output_bytes(paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+
+def measure(stage, log_path):
+    """
+    Runs a stage's commands as child processes and returns their summed wall and
+    CPU time, the peak RSS of the largest one (including the worker processes it
+    waited for) and the bytes the stage wrote.
+    """
+    for path in stage.outputs:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    result = {"wall_s": 0.0, "cpu_s": 0.0, "max_rss_bytes": 0, "exit_code": 0}
+    with open(log_path, "w") as log:
+        for argv in stage.resolve_commands():
+            start = time.perf_counter()
+            proc = subprocess.Popen(argv, cwd=stage.cwd, stdout=log, stderr=subprocess.STDOUT)
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            result["wall_s"] += time.perf_counter() - start
+            result["cpu_s"] += usage.ru_utime + usage.ru_stime
+            # ru_maxrss is in KiB on Linux
+            result["max_rss_bytes"] = max(result["max_rss_bytes"], usage.ru_maxrss * 1024)
+            if proc.returncode != 0:
+                result["exit_code"] = proc.returncode
+                break
+    result["output_bytes"] = _output_bytes(stage.written_files())
+    return result
+
+
+def run_scale(num_docs, args):
+    work_dir = os.path.join(args.work_dir, f"scale_{num_docs}")
+    os.makedirs(work_dir, exist_ok=True)
+    num_clusters = max(2, num_docs // args.docs_per_cluster)
+    print(f"=== {num_docs} docs, {args.num_queries} queries, dim {args.dim}, {num_clusters} clusters ===")
+    docs_path, queries_path = make_dataset(work_dir, num_docs, args.num_queries, args.dim, num_clusters, args.seed)
+
+    # The benchmark times the same stage definitions the pipeline runs
+    pipeline_args = argparse.Namespace(
+        modes=["baseline"], work_dir=work_dir, doc_embeddings=docs_path, query_embeddings=queries_path,
+        device="cpu", n_clusters=num_clusters, max_docs=0, train_size=args.num_queries - args.val_size,
+        val_size=args.val_size, num_queries=args.val_size, format="bin", prec_bits=5)
+    stages = build_stages(pipeline_args)
+
+    # Scores the exported ground truth against itself, which times both result loaders
+    tiptoe_dir = os.path.join(work_dir, "tiptoe_baseline")
+    gt_csv = os.path.join(tiptoe_dir, "msmarco_ground_truth.csv")
+    test_gnd = os.path.join(work_dir, "eval_data", "kmeans", "ground_truth_test_k10.npy")
+    reverse_index = os.path.join(tiptoe_dir, "reverse_index.npz")
+    stages.append(Stage("evaluate", [[sys.executable, os.path.join(CLUSTERING_DIR, "..", "evaluate.py"),
+                                      "--eval_path", gt_csv, "--ground_truth_path", test_gnd,
+                                      "--reverse_index_path", reverse_index]],
+                        inputs=[gt_csv, test_gnd, reverse_index], outputs=[]))
+
+    # Stages the selected ones depend on are run (and timed) as well
+    pipeline = Pipeline(stages, os.path.join(work_dir, "eval_data", ".pipeline"))
+    selected = pipeline.closure(args.stages)
+    results = {}
+    for name in (name for name in BENCHMARK_STAGES if name in selected):
+        stage = pipeline.stages[name]
+        result = measure(stage, os.path.join(work_dir, f"{name}.log"))
+        results[name] = result
+        print(f"{name:>24}: {result['wall_s']:8.2f}s wall {result['cpu_s']:8.2f}s cpu "
+              f"{result['max_rss_bytes'] / 2**20:8.1f} MiB rss {result['output_bytes'] / 2**20:8.1f} MiB out")
+        if result["exit_code"] != 0:
+            print(f"{name} failed with exit code {result['exit_code']}, see {work_dir}/{name}.log; skipping the rest")
+            break
+    return results
+
+
+def compare(results, baseline, threshold, min_seconds):
+    """
+    Lists (scale, stage, metric, baseline, current) for every wall time, CPU time
+    or peak RSS that grew by more than threshold (a fraction) over the baseline.
+    Times below min_seconds in the baseline are ignored as noise.
+    """
+    regressions = []
+    for scale, stages in results.items():
+        for name, current in stages.items():
+            previous = baseline.get(scale, {}).get(name)
+            if previous is None:
+                continue
+            if current["exit_code"] != 0 and previous["exit_code"] == 0:
+                regressions.append((scale, name, "exit_code", previous["exit_code"], current["exit_code"]))
+                continue
+            for metric in ("wall_s", "cpu_s", "max_rss_bytes"):
+                if metric != "max_rss_bytes" and previous[metric] < min_seconds:
+                    continue
+                if current[metric] > previous[metric] * (1 + threshold):
+                    regressions.append((scale, name, metric, previous[metric], current[metric]))
+    return regressions
+
+
+def main(args):
+    unknown = [name for name in args.stages if name not in BENCHMARK_STAGES]
+    if unknown:
+        raise ValueError(f"Unknown stages {unknown}, expected some of {BENCHMARK_STAGES}")
+    keep = args.work_dir is not None
+    args.work_dir = os.path.abspath(args.work_dir or tempfile.mkdtemp(prefix="tiptoe_benchmark_"))
+
+    report = {
+        "config": {"scales": args.scales, "num_queries": args.num_queries, "val_size": args.val_size, "dim": args.dim,
+                   "docs_per_cluster": args.docs_per_cluster, "seed": args.seed, "stages": args.stages},
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "results": {},
+    }
+    try:
+        for num_docs in args.scales:
+            report["results"][str(num_docs)] = run_scale(num_docs, args)
+    finally:
+        if not keep:
+            shutil.rmtree(args.work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved benchmark results to {args.output}")
+
+    failed = any(r["exit_code"] != 0 for stages in report["results"].values() for r in stages.values())
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(report["results"], baseline, args.threshold, args.min_seconds)
+        for scale, name, metric, previous, current in regressions:
+            change = f" ({(current / previous - 1) * 100:+.0f}%)" if metric != "exit_code" else ""
+            print(f"REGRESSION {scale} docs / {name} / {metric}: {previous:.4g} -> {current:.4g}{change}")
+        if not regressions:
+            print(f"No stage regressed by more than {args.threshold * 100:.0f}% against {args.baseline}")
+        failed = failed or bool(regressions)
+    return not failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the clustering pipeline stages on synthetic data at several scales.")
+    parser.add_argument('--scales', type=int, nargs='+', default=[10000, 100000], help="Number of documents per run")
+    parser.add_argument('--num_queries', type=int, default=2000, help="Number of queries (train + validation)")
+    parser.add_argument('--val_size', type=int, default=500, help="Validation (test) queries exported and evaluated")
+    parser.add_argument('--dim', type=int, default=384, help="Embedding dimension")
+    parser.add_argument('--docs_per_cluster', type=int, default=1000, help="Clusters = docs / docs_per_cluster")
+    parser.add_argument('--stages', nargs='+', default=list(BENCHMARK_STAGES), help="Stages to time (knn_graph is brute force on CPU, drop it at large scales)")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed of the synthetic data")
+    parser.add_argument('--work_dir', default=None, help="Keep the data and logs here (default: a temporary directory, removed afterwards)")
+    parser.add_argument('--output', default=None, help="Path to save the results JSON")
+    parser.add_argument('--baseline', default=None, help="Results JSON of an earlier run to compare against")
+    parser.add_argument('--threshold', type=float, default=0.25, help="Relative increase that counts as a regression")
+    parser.add_argument('--min_seconds', type=float, default=1.0, help="Ignore time regressions of stages faster than this in the baseline")
+
+    args = parser.parse_args()
+    sys.exit(0 if main(args) else 1)
@@ -2,49 +2,78 @@ import numpy as np
 import argparse
 import os
 
-def main(args):
-    # Load inputs
-    doc_cluster_assignments = np.load(args.cluster_assignments_path)
-    ground_truth_test = np.load(args.ground_truth_path)
-    query_vectors = np.load(args.query_vectors_path)
 
-    # Build doc to cluster map
-    doc_to_cluster = {i: cluster for i, cluster in enumerate(doc_cluster_assignments)}
-    ground_truth = ground_truth_test[:, 0].flatten()
+def multilabel_targets(cluster_ids, k):
+    """
+    Turns the (n, >=k) clusters of each query's top-k ground-truth docs into the set
+    of distinct clusters per query, in order of their best-ranked doc and padded
+    with -1 to width k.
+    """
+    cluster_ids = np.asarray(cluster_ids[:, :k], dtype=np.int32)
+    # A cluster is a duplicate if it already appears earlier in the row
+    earlier = np.tril(np.ones((k, k), dtype=bool), k=-1)
+    duplicate = ((cluster_ids[:, :, None] == cluster_ids[:, None, :]) & earlier).any(axis=2)
+    targets = np.where(duplicate, -1, cluster_ids)
+    order = np.argsort(duplicate, axis=1, kind="stable")
+    return np.take_along_axis(targets, order, axis=1)
+
 
-    # Assign clusters to queries
-    query_cluster_assignments = np.array([doc_to_cluster[doc] for doc in ground_truth])
+def save_rows(path, src, indices, chunk_size=65536):
+    """Gathers src[indices] into a new .npy one chunk at a time."""
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=src.dtype, shape=(len(indices),) + src.shape[1:])
+    for start in range(0, len(indices), chunk_size):
+        out[start:start + chunk_size] = src[indices[start:start + chunk_size]]
+    out.flush()
 
-    # Train/val split
-    y_train = query_cluster_assignments[:500000]
-    y_val = query_cluster_assignments[500000:501000]
 
-    np.save('y_train', y_train)
-    np.save('y_val', y_val)
+def split_indices(num_queries, train_size, val_size, seed=None):
+    if train_size + val_size > num_queries:
+        raise ValueError(f"train_size + val_size = {train_size + val_size} exceeds the {num_queries} available queries")
+    if seed is None:
+        # Contiguous split, in file order
+        order = np.arange(train_size + val_size)
+    else:
+        order = np.random.default_rng(seed).permutation(num_queries)[:train_size + val_size]
+    return np.sort(order[:train_size]), np.sort(order[train_size:])
 
-    # Split query vectors
-    x_train = query_vectors[:500000]
-    x_val = query_vectors[500000:501000]
 
-    np.save('x_train', x_train)
-    np.save('x_val', x_val)
+def main(args):
+    # Load inputs; the large arrays are only read through memory maps
+    doc_cluster_assignments = np.ravel(np.load(args.cluster_assignments_path))
+    ground_truth = np.load(args.ground_truth_path, mmap_mode='r')
+    query_vectors = np.load(args.query_vectors_path, mmap_mode='r')
+
+    train_idx, val_idx = split_indices(query_vectors.shape[0], args.train_size, args.val_size, args.seed)
+    os.makedirs(args.output_dir, exist_ok=True)
 
-    # Reduce ground truth test set
-    gnd_test = ground_truth_test[500000:501000]
+    # Each query is labeled with the cluster of its top-1 ground-truth doc (one gather)
+    for name, idx in (('train', train_idx), ('val', val_idx)):
+        np.save(os.path.join(args.output_dir, f'y_{name}'), doc_cluster_assignments[ground_truth[idx, 0]])
+        save_rows(os.path.join(args.output_dir, f'x_{name}.npy'), query_vectors, idx)
 
-    np.save(args.query_test_output, x_val)
-    np.save(args.ground_truth_test_output, gnd_test)
+        # Optionally, every cluster that holds one of the query's top-k ground-truth docs
+        if args.multilabel_k:
+            targets = multilabel_targets(doc_cluster_assignments[ground_truth[idx, :args.multilabel_k]], args.multilabel_k)
+            np.save(os.path.join(args.output_dir, f'y_{name}_multi'), targets)
+
+    # The validation split doubles as the test set for the end-to-end evaluation
+    save_rows(args.query_test_output, query_vectors, val_idx)
+    np.save(args.ground_truth_test_output, np.asarray(ground_truth[val_idx]))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process and split clustering data.")
-    
+
     parser.add_argument('--cluster_assignments_path', required=True, help="Path to cluster assignments .npy file")
     parser.add_argument('--ground_truth_path', required=True, help="Path to ground truth .npy file")
-    parser.add_argument('--query_vectors_path', required=True, help="Path to query embeddings .npy file") 
+    parser.add_argument('--query_vectors_path', required=True, help="Path to query embeddings .npy file")
     parser.add_argument('--query_test_output', default='../eval_data/query_test_reduced.npy', help="Output path for reduced test queries")
     parser.add_argument('--ground_truth_test_output', default='../eval_data/ground_truth_test_k10.npy', help="Output path for reduced ground truth")
+    parser.add_argument('--output_dir', default='.', help="Directory for the x_/y_ train and val .npy files")
+    parser.add_argument('--train_size', type=int, default=500000, help="Number of training queries")
+    parser.add_argument('--val_size', type=int, default=1000, help="Number of validation (and test) queries")
+    parser.add_argument('--seed', type=int, default=None, help="Shuffle queries with this seed before splitting (default: split in file order)")
+    parser.add_argument('--multilabel_k', type=int, default=0, help="Also write y_*_multi.npy with the clusters of each query's top-k ground truth (0 to disable)")
 
     args = parser.parse_args()
     main(args)
-
@@ -0,0 +1,124 @@
+import argparse
+import json
+import numpy as np
+
+# Router artifact: an .npz holding a linear scoring function score = x @ weights.T + bias
+# over (optionally normalized) query vectors, plus metadata. A centroid router is
+# the special case weights = centroids, bias = -||c||^2 / 2 (argmax of which is the
+# L2-nearest centroid of the unnormalized query); a trained LinearModel stores its layer weights and bias.
+# Only NumPy is needed to load and apply either kind.
+ROUTER_KINDS = ("centroid", "linear")
+
+
+class Router:
+    def __init__(self, weights, bias, kind, normalize_input=True, metadata=None):
+        if kind not in ROUTER_KINDS:
+            raise ValueError(f"Unknown router kind {kind!r}, expected one of {ROUTER_KINDS}")
+        self.weights = np.ascontiguousarray(weights, dtype=np.float32)
+        self.bias = np.asarray(bias, dtype=np.float32)
+        self.kind = kind
+        self.normalize_input = normalize_input
+        self.metadata = dict(metadata or {})
+
+    @property
+    def num_clusters(self):
+        return self.weights.shape[0]
+
+    @property
+    def dim(self):
+        return self.weights.shape[1]
+
+    @classmethod
+    def from_centroids(cls, centroids, **metadata):
+        centroids = np.asarray(centroids, dtype=np.float32)
+        sq_norms = np.sum(centroids * centroids, axis=1)
+        # For unit-norm centroids the correction is constant, so scores stay plain cosines
+        # and normalizing the query does not change its nearest centroid. Otherwise the
+        # -||c||^2 / 2 bias only picks the L2-nearest centroid of the query as given.
+        if np.allclose(sq_norms, 1.0, atol=1e-3):
+            return cls(centroids, np.zeros_like(sq_norms), "centroid", metadata=metadata)
+        return cls(centroids, -0.5 * sq_norms, "centroid", normalize_input=False, metadata=metadata)
+
+    @classmethod
+    def from_linear(cls, weight, bias, **metadata):
+        return cls(weight, bias, "linear", metadata=metadata)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as artifact:
+            return cls(artifact["weights"], artifact["bias"], str(artifact["kind"]),
+                       normalize_input=bool(artifact["normalize_input"]),
+                       metadata=json.loads(str(artifact["metadata"])))
+
+    def save(self, path):
+        metadata = dict(self.metadata, num_clusters=self.num_clusters, dim=self.dim)
+        np.savez(path, weights=self.weights, bias=self.bias, kind=np.array(self.kind),
+                 normalize_input=np.array(self.normalize_input), metadata=np.array(json.dumps(metadata)))
+
+    def scores(self, queries):
+        queries = np.asarray(queries, dtype=np.float32)
+        if self.normalize_input:
+            queries = queries / np.clip(np.linalg.norm(queries, axis=1, keepdims=True), a_min=1e-10, a_max=None)
+        scores = queries @ self.weights.T
+        scores += self.bias
+        return scores
+
+    def route(self, queries, m=1, block_size=65536):
+        """
+        Top-m clusters per query, one matrix product per block of queries.
+        Returns (ids, scores), both (num_queries, m) and sorted best first.
+        """
+        num_queries = queries.shape[0]
+        m = min(m, self.num_clusters)
+        ids = np.empty((num_queries, m), dtype=np.int64)
+        scores = np.empty((num_queries, m), dtype=np.float32)
+        for start in range(0, num_queries, block_size):
+            end = min(start + block_size, num_queries)
+            ids[start:end], scores[start:end] = self._route_block(queries[start:end], m)
+        return ids, scores
+
+    def route_file(self, query_path, ids_output, scores_output=None, m=1, block_size=65536):
+        """
+        Streams a (possibly huge) .npy of queries through the router, writing the
+        (num_queries, m) ids, and optionally scores, straight into .npy files.
+        """
+        queries = np.load(query_path, mmap_mode="r")
+        m = min(m, self.num_clusters)
+        ids = np.lib.format.open_memmap(ids_output, mode="w+", dtype=np.int64, shape=(queries.shape[0], m))
+        scores = None
+        if scores_output:
+            scores = np.lib.format.open_memmap(scores_output, mode="w+", dtype=np.float32, shape=(queries.shape[0], m))
+        for start in range(0, queries.shape[0], block_size):
+            end = min(start + block_size, queries.shape[0])
+            block_ids, block_scores = self._route_block(queries[start:end], m)
+            ids[start:end] = block_ids
+            if scores is not None:
+                scores[start:end] = block_scores
+        ids.flush()
+        if scores is not None:
+            scores.flush()
+
+    def _route_block(self, queries, m):
+        block_scores = self.scores(queries)
+        if m < self.num_clusters:
+            top = np.argpartition(-block_scores, m - 1, axis=1)[:, :m]
+        else:
+            top = np.tile(np.arange(self.num_clusters), (block_scores.shape[0], 1))
+        top_scores = np.take_along_axis(block_scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Route a query embedding file with a saved router artifact.")
+    parser.add_argument('--router_path', required=True, help="Path to router artifact .npz")
+    parser.add_argument('--query_vectors_path', required=True, help="Path to query embeddings .npy file")
+    parser.add_argument('--output_ids', required=True, help="Path to save the (num_queries, top_m) cluster ids .npy")
+    parser.add_argument('--output_scores', default=None, help="Optional path to save the matching scores .npy")
+    parser.add_argument('--top_m', type=int, default=1, help="Number of clusters to return per query")
+    parser.add_argument('--block_size', type=int, default=65536, help="Queries per matrix product")
+
+    args = parser.parse_args()
+    router = Router.load(args.router_path)
+    router.route_file(args.query_vectors_path, args.output_ids, args.output_scores, m=args.top_m, block_size=args.block_size)
+    print(f"Routed {args.query_vectors_path} with {router.kind} router ({router.num_clusters} clusters) to {args.output_ids}")
@@ -1,21 +1,39 @@
+import argparse
 import numpy as np
-import torch
-import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader
 
+from router import Router
 
-centroids = np.load('../eval_data/centroids.npy')
 
-test_queries = np.load('../eval_data/query_test_reduced.npy')
+def main(args):
+    centroids = np.load(args.centroids_path)
+    test_queries = np.load(args.query_vectors_path, mmap_mode='r')
 
-predicted_cluster_ids = []
-for query in test_queries:
-    dist_to_centroids = np.linalg.norm(centroids - query, axis=1)
-    cluster_id = np.argmin(dist_to_centroids)
-    predicted_cluster_ids.append(cluster_id)
+    # Nearest-centroid routing, saved as a reusable router artifact
+    router = Router.from_centroids(centroids, source=args.centroids_path)
+    router.save(args.router_output)
+    print(f"Saved centroid router to {args.router_output}")
 
-predicted_cluster_ids = np.array(predicted_cluster_ids)
-np.save('../eval_data/baseline_predicted_cluster_ids', predicted_cluster_ids)
+    ids, scores = router.route(test_queries, m=args.top_m, block_size=args.block_size)
 
+    # The top-1 cluster keeps the 1-D format prepare_query_data.py expects
+    predicted_cluster_ids = ids[:, 0]
+    np.save(args.output, predicted_cluster_ids)
 
+    # All m probes, for multi-probe analysis
+    if args.top_m_output:
+        np.savez(args.top_m_output, ids=ids, scores=scores)
+        print(f"Saved top-{args.top_m} cluster ids and scores to {args.top_m_output}")
 
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Route queries to their nearest k-means centroids.")
+    parser.add_argument('--centroids_path', default='../eval_data/centroids.npy', help="Path to centroids .npy file")
+    parser.add_argument('--query_vectors_path', default='../eval_data/query_test_reduced.npy', help="Path to (normalized) query vectors .npy file")
+    parser.add_argument('--output', default='../eval_data/baseline_predicted_cluster_ids.npy', help="Path to save the top-1 cluster id per query")
+    parser.add_argument('--router_output', default='../eval_data/centroid_router.npz', help="Path to save the centroid router artifact")
+    parser.add_argument('--top_m', type=int, default=1, help="Number of clusters to return per query")
+    parser.add_argument('--top_m_output', default=None, help="Optional .npz path for the (num_queries, top_m) ids and scores")
+    parser.add_argument('--block_size', type=int, default=65536, help="Queries per matrix product")
+
+    args = parser.parse_args()
+    main(args)
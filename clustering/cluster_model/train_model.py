@@ -1,113 +1,177 @@
+import argparse
+import os
 import numpy as np
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader
+
+from router import Router
 
 # --- Config ---
 BATCH_SIZE = 128
 NUM_EPOCHS = 20
 LEARNING_RATE = 1e-3
-
-# --- Device setup ---
-device = torch.device('cuda')
-print(f"Using device: {device}")
-
-# --- Dataset class ---
-class NPYDataset(Dataset):
-    def __init__(self, x_path, y_path):
-        self.X = np.load(x_path)
-        self.Y = np.load(y_path)
-        
-        self.Y = self.Y.flatten()
+LBFGS_LEARNING_RATE = 1.0
+
+
+# --- Data loading ---
+def load_normalized_tensor(x_path, chunk_size=65536):
+    """
+    Loads a memory-mapped .npy of vectors into a single float32 tensor, normalizing
+    each row once while copying, so no per-sample tensors are ever built.
+    """
+    X_np = np.load(x_path, mmap_mode='r')
+    X = torch.empty(X_np.shape, dtype=torch.float32)
+    for start in range(0, X_np.shape[0], chunk_size):
+        chunk = np.asarray(X_np[start:start + chunk_size], dtype=np.float32)
         # Normalize each input vector
-        norms = np.linalg.norm(self.X, axis=1, keepdims=True)
-        self.X = self.X / np.clip(norms, a_min=1e-10, a_max=None)
+        norms = np.linalg.norm(chunk, axis=1, keepdims=True)
+        X[start:start + chunk_size] = torch.from_numpy(chunk / np.clip(norms, a_min=1e-10, a_max=None))
+    return X
 
-    def __len__(self):
-        return len(self.Y)
 
-    def __getitem__(self, idx):
-        x = torch.tensor(self.X[idx], dtype=torch.float32)
-        y = torch.tensor(self.Y[idx], dtype=torch.long)
-        return x, y
+def load_labels(y_path):
+    # 1-D cluster ids, or (n, k) label sets padded with -1 for multi-label targets
+    Y = np.load(y_path)
+    Y = Y.reshape(Y.shape[0], -1)
+    return torch.from_numpy((Y[:, 0] if Y.shape[1] == 1 else Y).astype(np.int64))
 
 
-class LinearModel(nn.Module):
-    def __init__(self, input_dim, num_classes):
-        super().__init__()
-        self.linear = nn.Linear(input_dim, num_classes)
-
-    def forward(self, x):
-        return self.linear(x)
+def multi_hot(label_sets, num_classes):
+    # Rows of cluster ids padded with -1 become 0/1 target rows; padding adds 0
+    target = torch.zeros(label_sets.shape[0], num_classes, device=label_sets.device)
+    target.scatter_add_(1, label_sets.clamp(min=0), (label_sets >= 0).float())
+    return target.clamp_(max=1.0)
 
-# --- Load datasets ---
-train_dataset = NPYDataset('x_train.npy', 'y_train.npy')
-val_dataset   = NPYDataset('x_val.npy', 'y_val.npy')
 
-input_dim = train_dataset[0][0].shape[0]
-num_classes = np.max(train_dataset.Y) + 1
+def hit_rate(preds, Y):
+    # Single labels: accuracy; label sets: fraction of top-1 predictions inside the set
+    if Y.dim() == 1:
+        return (preds == Y).float().mean().item()
+    return (Y == preds[:, None]).any(dim=1).float().mean().item()
 
-train_loader = DataLoader(train_dataset, batch_size=BATCH_SIZE, shuffle=True, pin_memory=True)
-val_loader   = DataLoader(val_dataset, batch_size=BATCH_SIZE, shuffle=False, pin_memory=True)
 
-# --- Setup model, loss, optimizer ---
-model = LinearModel(input_dim, num_classes).to(device)
-criterion = nn.CrossEntropyLoss()
-optimizer = torch.optim.Adam(model.parameters(), lr=LEARNING_RATE)
+def iterate_batches(num_rows, batch_size, shuffle, device):
+    # Batches are index slices into the resident tensors; shuffling is a single randperm per epoch
+    order = torch.randperm(num_rows, device=device) if shuffle else torch.arange(num_rows, device=device)
+    for start in range(0, num_rows, batch_size):
+        yield order[start:start + batch_size]
 
-# --- Training loop with validation ---
-for epoch in range(NUM_EPOCHS):
-    model.train()
-    running_loss = 0.0
 
-    for batch_X, batch_Y in train_loader:
-        batch_X, batch_Y = batch_X.to(device), batch_Y.to(device)
+class LinearModel(nn.Module):
+    def __init__(self, input_dim, num_classes):
+        super().__init__()
+        self.linear = nn.Linear(input_dim, num_classes)
 
-        optimizer.zero_grad()
-        outputs = model(batch_X)
-        loss = criterion(outputs, batch_Y)
-        loss.backward()
-        optimizer.step()
+    def forward(self, x):
+        return self.linear(x)
 
-        running_loss += loss.item() * batch_X.size(0)
 
-    avg_loss = running_loss / len(train_loader.dataset)
-    
-    # --- Validation ---
+def predict(model, X, batch_size=65536):
     model.eval()
-    correct = 0
-    total = 0
+    preds = []
     with torch.no_grad():
-        for val_X, val_Y in val_loader:
-            val_X, val_Y = val_X.to(device), val_Y.to(device)
-            outputs = model(val_X)
-            preds = torch.argmax(outputs, dim=1)
-            correct += (preds == val_Y).sum().item()
-            total += val_Y.size(0)
-
-    val_acc = correct / total
-    print(f"Epoch {epoch+1}/{NUM_EPOCHS} - Loss: {avg_loss:.4f} - Val Acc: {val_acc:.4f}")
- 
-
-predicted_cluster_ids = []
-# --- Validation ---
-model.eval()
-correct = 0
-total = 0
-with torch.no_grad():
-    for val_X, val_Y in val_loader:
-        val_X, val_Y = val_X.to(device), val_Y.to(device)
-        outputs = model(val_X)
-        preds = torch.argmax(outputs, dim=1)
-        for pred in preds:
-            predicted_cluster_ids.append(pred)
-        correct += (preds == val_Y).sum().item()
-        total += val_Y.size(0)
-
-val_acc = correct / total
-print(f"Epoch {epoch+1}/{NUM_EPOCHS} - Loss: {avg_loss:.4f} - Val Acc: {val_acc:.4f}")
-
-
-predicted_cluster_ids = [t.cpu().numpy() for t in predicted_cluster_ids]
-predicted_cluster_ids = np.array(predicted_cluster_ids)
-np.save('../eval_data/predicted_cluster_ids', predicted_cluster_ids)
+        for start in range(0, X.shape[0], batch_size):
+            preds.append(torch.argmax(model(X[start:start + batch_size]), dim=1))
+    return torch.cat(preds)
+
+
+def train(model, X_train, Y_train, X_val, Y_val, args):
+    if Y_train.dim() == 1:
+        criterion = nn.CrossEntropyLoss()
+    else:
+        # Multi-label targets: every cluster holding a top-k ground-truth doc is a positive
+        bce = nn.BCEWithLogitsLoss()
+        criterion = lambda logits, label_sets: bce(logits, multi_hot(label_sets, logits.shape[1]))
+    num_train = X_train.shape[0]
+    device = X_train.device
+
+    if args.optimizer == 'lbfgs':
+        # Full-batch (or large-batch) quasi-Newton steps suit the convex linear router
+        optimizer = torch.optim.LBFGS(model.parameters(), lr=args.lr, max_iter=args.lbfgs_max_iter,
+                                      history_size=args.lbfgs_history, line_search_fn='strong_wolfe')
+        batch_size = args.lbfgs_batch_size or num_train
+    else:
+        optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+        batch_size = args.batch_size
+
+    # --- Training loop with validation ---
+    for epoch in range(args.epochs):
+        model.train()
+        running_loss = 0.0
+
+        for idx in iterate_batches(num_train, batch_size, shuffle=True, device=device):
+            batch_X, batch_Y = X_train[idx], Y_train[idx]
+
+            def closure():
+                optimizer.zero_grad()
+                loss = criterion(model(batch_X), batch_Y)
+                loss.backward()
+                return loss
+
+            loss = optimizer.step(closure)
+            running_loss += loss.item() * batch_X.size(0)
+
+        avg_loss = running_loss / num_train
+
+        # --- Validation ---
+        val_acc = hit_rate(predict(model, X_val), Y_val)
+        print(f"Epoch {epoch+1}/{args.epochs} - Loss: {avg_loss:.4f} - Val Acc: {val_acc:.4f}")
+
+
+def main(args):
+    # --- Device setup ---
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.device == 'auto':
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    else:
+        device = torch.device(args.device)
+    print(f"Using device: {device} ({torch.get_num_threads()} CPU threads)")
+
+    # --- Load datasets ---
+    X_train = load_normalized_tensor(os.path.join(args.data_dir, 'x_train.npy')).to(device)
+    label_suffix = '_multi' if args.multilabel else ''
+    Y_train = load_labels(os.path.join(args.data_dir, f'y_train{label_suffix}.npy')).to(device)
+    X_val = load_normalized_tensor(os.path.join(args.data_dir, 'x_val.npy')).to(device)
+    Y_val = load_labels(os.path.join(args.data_dir, f'y_val{label_suffix}.npy')).to(device)
+
+    input_dim = X_train.shape[1]
+    num_classes = int(max(Y_train.max().item(), Y_val.max().item())) + 1
+
+    # --- Setup model, loss, optimizer ---
+    model = LinearModel(input_dim, num_classes).to(device)
+    train(model, X_train, Y_train, X_val, Y_val, args)
+
+    # --- Validation ---
+    predicted_cluster_ids = predict(model, X_val)
+    val_acc = hit_rate(predicted_cluster_ids, Y_val)
+    print(f"Final Val Acc: {val_acc:.4f}")
+
+    np.save(args.output, predicted_cluster_ids.cpu().numpy())
+
+    # Save the trained router so new queries can be routed with NumPy alone
+    router = Router.from_linear(model.linear.weight.detach().cpu().numpy(), model.linear.bias.detach().cpu().numpy(),
+                                optimizer=args.optimizer, epochs=args.epochs, val_acc=val_acc)
+    router.save(args.router_output)
+    print(f"Saved linear router to {args.router_output}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train the linear query router on the split produced by compute_training_data.py.")
+    parser.add_argument('--data_dir', default='.', help="Directory holding x_train/y_train/x_val/y_val .npy files")
+    parser.add_argument('--output', default='../eval_data/predicted_cluster_ids.npy', help="Where to save the predicted cluster ids of the validation queries")
+    parser.add_argument('--router_output', default='../eval_data/linear_router.npz', help="Where to save the trained router artifact")
+    parser.add_argument('--device', default='auto', help="Torch device: auto, cpu, cuda, cuda:1, ...")
+    parser.add_argument('--threads', type=int, default=None, help="Number of CPU threads for torch (default: torch's choice)")
+    parser.add_argument('--multilabel', action='store_true', help="Train on y_*_multi.npy label sets (compute_training_data.py --multilabel_k) with a BCE loss")
+    parser.add_argument('--optimizer', choices=['adam', 'lbfgs'], default='adam', help="Mini-batch Adam or (large/full-batch) L-BFGS")
+    parser.add_argument('--epochs', type=int, default=NUM_EPOCHS)
+    parser.add_argument('--batch_size', type=int, default=BATCH_SIZE, help="Adam mini-batch size")
+    parser.add_argument('--lr', type=float, default=None, help=f"Learning rate (default: {LEARNING_RATE} for Adam, {LBFGS_LEARNING_RATE} for L-BFGS)")
+    parser.add_argument('--lbfgs_batch_size', type=int, default=0, help="L-BFGS batch size (0 for full batch)")
+    parser.add_argument('--lbfgs_max_iter', type=int, default=20, help="L-BFGS iterations per batch")
+    parser.add_argument('--lbfgs_history', type=int, default=10, help="L-BFGS history size")
+
+    args = parser.parse_args()
+    args.lr = args.lr or (LBFGS_LEARNING_RATE if args.optimizer == 'lbfgs' else LEARNING_RATE)
+    main(args)
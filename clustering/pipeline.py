@@ -0,0 +1,343 @@
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+
+# Stages of the clustering workflow as a DAG. Every stage declares the files it
+# reads and writes; a stage depends on the stages that write its inputs. A stage
+# is skipped when its outputs exist and are unchanged since its last successful
+# run, and the fingerprint of its commands, scripts and inputs (size and mtime)
+# still matches. Stages whose dependencies are done run in parallel.
+CLUSTERING_DIR = os.path.dirname(os.path.abspath(__file__))
+MODES = ("baseline", "learned", "graph")
+# Output directory suffix of the prepare_tiptoe_data scripts for each mode
+OUTPUT_DIR_SUFFIX = {"baseline": "baseline", "learned": "baseline_learned", "graph": "graph"}
+# Document partition each mode searches over: k-means clusters or a kNN-graph partition
+MODE_CLUSTERING = {"baseline": "kmeans", "learned": "kmeans", "graph": "graph"}
+
+
+def _path(*parts):
+    return os.path.join(CLUSTERING_DIR, *parts)
+
+
+def _script(*parts):
+    return [sys.executable, _path(*parts)]
+
+
+def _file_stat(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+class Stage:
+    """
+    A named step that runs one or more commands. `commands` is a list of argv
+    lists, or a function returning one when the commands depend on upstream
+    outputs (it is only called once the stage's inputs exist). `manifests` are
+    outputs listing, under "files", further files the stage wrote next to them
+    when their names are only known once it ran (e.g. one file per cluster).
+    """
+
+    def __init__(self, name, commands, inputs, outputs, cwd=CLUSTERING_DIR, manifests=()):
+        self.name = name
+        self.commands = commands
+        self.inputs = list(inputs)
+        self.outputs = list(outputs) + [path for path in manifests if path not in outputs]
+        self.manifests = list(manifests)
+        self.cwd = cwd
+        self.deps = set()
+
+    def written_files(self):
+        """The declared outputs and the files listed in the existing manifests."""
+        files = list(self.outputs)
+        for manifest in self.manifests:
+            if os.path.exists(manifest):
+                with open(manifest, "r") as f:
+                    files.extend(os.path.join(os.path.dirname(manifest), name) for name in json.load(f)["files"])
+        return files
+
+    def resolve_commands(self):
+        return self.commands() if callable(self.commands) else self.commands
+
+    def fingerprint(self):
+        digest = hashlib.sha1()
+        commands = self.resolve_commands()
+        digest.update(json.dumps([commands, self.cwd]).encode())
+        # Scripts are hashed by content, so editing a stage's code reruns it
+        for argv in commands:
+            for arg in argv:
+                if arg.endswith(".py") and os.path.isfile(arg):
+                    with open(arg, "rb") as f:
+                        digest.update(hashlib.sha1(f.read()).digest())
+        for path in self.inputs:
+            digest.update(json.dumps([path, _file_stat(path)]).encode())
+        return digest.hexdigest()
+
+
+class Pipeline:
+    def __init__(self, stages, state_dir):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_dir = state_dir
+        os.makedirs(state_dir, exist_ok=True)
+
+        writers = {}
+        for stage in stages:
+            for path in stage.outputs:
+                if path in writers:
+                    raise ValueError(f"{path} is written by both {writers[path]} and {stage.name}")
+                writers[path] = stage.name
+        for stage in stages:
+            stage.deps = {writers[path] for path in stage.inputs if path in writers}
+
+    def _state_path(self, stage):
+        return os.path.join(self.state_dir, f"{stage.name}.json")
+
+    def _log_path(self, stage):
+        return os.path.join(self.state_dir, f"{stage.name}.log")
+
+    def is_current(self, stage):
+        if not os.path.exists(self._state_path(stage)):
+            return False
+        written = stage.written_files()
+        if not all(os.path.exists(path) for path in stage.inputs + written):
+            return False
+        with open(self._state_path(stage), "r") as f:
+            state = json.load(f)
+        outputs_unchanged = state["outputs"] == {path: _file_stat(path) for path in written}
+        return outputs_unchanged and state["fingerprint"] == stage.fingerprint()
+
+    def closure(self, targets):
+        """The targets and every stage they (transitively) depend on."""
+        selected, todo = set(), list(targets)
+        while todo:
+            name = todo.pop()
+            if name not in selected:
+                selected.add(name)
+                todo.extend(self.stages[name].deps)
+        return selected
+
+    def run_stage(self, stage):
+        for path in stage.outputs:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        start = time.time()
+        with open(self._log_path(stage), "w") as log:
+            for argv in stage.resolve_commands():
+                log.write(f"$ {' '.join(argv)}\n")
+                log.flush()
+                result = subprocess.run(argv, cwd=stage.cwd, stdout=log, stderr=subprocess.STDOUT)
+                if result.returncode != 0:
+                    raise RuntimeError(f"{stage.name} failed (exit code {result.returncode}), see {self._log_path(stage)}")
+        written = stage.written_files()
+        missing = [path for path in written if not os.path.exists(path)]
+        if missing:
+            raise RuntimeError(f"{stage.name} did not write {missing}, see {self._log_path(stage)}")
+
+        state = {"fingerprint": stage.fingerprint(), "outputs": {path: _file_stat(path) for path in written}}
+        with open(self._state_path(stage) + ".tmp", "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(self._state_path(stage) + ".tmp", self._state_path(stage))
+        return time.time() - start
+
+    def run(self, targets, jobs=1, force=(), dry_run=False):
+        selected = self.closure(targets)
+        remaining = {name: set(self.stages[name].deps) & selected for name in selected}
+        rerun = set(force)
+        failed = []
+
+        def ready():
+            return sorted(name for name, deps in remaining.items() if not deps)
+
+        def finish(name):
+            del remaining[name]
+            for deps in remaining.values():
+                deps.discard(name)
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            running = {}
+            while remaining or running:
+                for name in ready() if not failed else []:
+                    stage = self.stages[name]
+                    # A stage reruns when forced, when an upstream stage reran, or when it is stale
+                    if name not in rerun and not (stage.deps & rerun) and self.is_current(stage):
+                        print(f"[skip] {name} is up to date")
+                        finish(name)
+                        continue
+                    rerun.add(name)
+                    if dry_run:
+                        print(f"[plan] {name}")
+                        finish(name)
+                        continue
+                    print(f"[run]  {name}")
+                    running[pool.submit(self.run_stage, stage)] = name
+                    del remaining[name]
+                if not running:
+                    if remaining and not failed and not ready():
+                        raise RuntimeError(f"Stages {sorted(remaining)} can never run: dependency cycle")
+                    if failed or not remaining:
+                        break
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        print(f"[done] {name} in {future.result():.1f}s")
+                    except Exception as e:
+                        print(f"[fail] {e}")
+                        failed.append(name)
+                    for deps in remaining.values():
+                        deps.discard(name)
+        return not failed
+
+
+def build_stages(args):
+    eval_dir = os.path.join(args.work_dir, "eval_data")
+    docs_norm = os.path.join(eval_dir, "msmarco_doc_embeddings_1M_norm.npy")
+    queries_norm = os.path.join(eval_dir, "msmarco_query_embeddings_norm.npy")
+    gnd = os.path.join(eval_dir, "ground_truth_1M_k10.npy")
+    device = ["--device", args.device]
+
+    # STEP 1: Compute the ground truth via exact NN search
+    stages = [Stage("ground_truth", [_script("util_scripts", "compute_gnd_gpu.py") + [
+        "--doc", args.doc_embeddings, "--query", args.query_embeddings, "--output_gnd", gnd,
+        "--output_doc", docs_norm, "--output_query", queries_norm, "--max_docs", str(args.max_docs)] + device],
+        inputs=[args.doc_embeddings, args.query_embeddings], outputs=[gnd, docs_norm, queries_norm],
+        cwd=_path("util_scripts"))]
+
+    # STEP 2: Cluster the documents, by k-means or by partitioning their kNN graph
+    clustering_dir = {name: os.path.join(eval_dir, name) for name in ("kmeans", "graph")}
+    assignments = {name: os.path.join(clustering_dir[name], "cluster_assignments.npy") for name in clustering_dir}
+    centroids = os.path.join(clustering_dir["kmeans"], "centroids.npy")
+    stages.append(Stage("kmeans", [_script("util_scripts", "kmeans_gpu.py") + [
+        "--input", docs_norm, "--output_centroids", centroids, "--output_assignments", assignments["kmeans"],
+        "--n_clusters", str(args.n_clusters)] + device],
+        inputs=[docs_norm], outputs=[centroids, assignments["kmeans"]], cwd=_path("util_scripts")))
+
+    knn_graph = os.path.join(clustering_dir["graph"], "knn_graph_for_metis.txt")
+    stages.append(Stage("knn_graph", [_script("util_scripts", "build_knn_graph.py") + [
+        "--input", docs_norm, "--output", knn_graph] + device],
+        inputs=[docs_norm], outputs=[knn_graph], cwd=_path("util_scripts")))
+    partition = f"{knn_graph}.part.{args.n_clusters}"
+    stages.append(Stage("graph_partition", [
+        ["gpmetis", "-ptype=rb", knn_graph, str(args.n_clusters)],
+        _script("util_scripts", "convert_metis_to_npy.py") + ["--input", partition, "--output", assignments["graph"]]],
+        inputs=[knn_graph], outputs=[partition, assignments["graph"]], cwd=clustering_dir["graph"]))
+
+    # STEP 3: Compute the query eval dataset and model training data for each clustering
+    test_queries, test_gnd = {}, {}
+    for name in clustering_dir:
+        test_queries[name] = os.path.join(clustering_dir[name], "query_test_reduced.npy")
+        test_gnd[name] = os.path.join(clustering_dir[name], "ground_truth_test_k10.npy")
+        training = [os.path.join(clustering_dir[name], f"{x}_{split}.npy") for x in ("x", "y") for split in ("train", "val")]
+        stages.append(Stage(f"training_data_{name}", [_script("cluster_model", "compute_training_data.py") + [
+            "--cluster_assignments_path", assignments[name], "--ground_truth_path", gnd,
+            "--query_vectors_path", queries_norm, "--output_dir", clustering_dir[name],
+            "--query_test_output", test_queries[name], "--ground_truth_test_output", test_gnd[name],
+            "--train_size", str(args.train_size), "--val_size", str(args.val_size)]],
+            inputs=[assignments[name], gnd, queries_norm], outputs=training + [test_queries[name], test_gnd[name]],
+            cwd=_path("cluster_model")))
+
+    for mode in args.modes:
+        clustering = MODE_CLUSTERING[mode]
+        mode_dir = os.path.join(eval_dir, mode)
+        suffix = OUTPUT_DIR_SUFFIX[mode]
+        tiptoe_dir = os.path.join(args.work_dir, "tiptoe_" + suffix)
+
+        # STEP 4: Route the test queries, with the centroids or a trained model
+        predicted = os.path.join(mode_dir, "predicted_cluster_ids.npy")
+        router = os.path.join(mode_dir, "router.npz")
+        if mode == "baseline":
+            stages.append(Stage(f"route_{mode}", [_script("cluster_model", "train_baseline.py") + [
+                "--centroids_path", centroids, "--query_vectors_path", test_queries[clustering],
+                "--output", predicted, "--router_output", router]],
+                inputs=[centroids, test_queries[clustering]], outputs=[predicted, router], cwd=_path("cluster_model")))
+        else:
+            training = [os.path.join(clustering_dir[clustering], f"{x}_{split}.npy") for x in ("x", "y") for split in ("train", "val")]
+            stages.append(Stage(f"route_{mode}", [_script("cluster_model", "train_model.py") + [
+                "--data_dir", clustering_dir[clustering], "--output", predicted, "--router_output", router]],
+                inputs=training, outputs=[predicted, router], cwd=_path("cluster_model")))
+
+        # STEP 5: Prepare data into tiptoe format
+        reverse_index = os.path.join(tiptoe_dir, "reverse_index.npz")
+        stages.append(Stage(f"docs_{mode}", [_script("prepare_tiptoe_data", "prepare_doc_data.py") + [
+            "--cluster_assignments_path", assignments[clustering], "--doc_embeddings_path", docs_norm,
+            "--output_dir_suffix", suffix, "--format", args.format, "--prec_bits", str(args.prec_bits)]],
+            inputs=[assignments[clustering], docs_norm], outputs=[reverse_index], cwd=args.work_dir,
+            manifests=[os.path.join(tiptoe_dir, "msmarco_cluster_files.json")]))
+
+        query_csv = os.path.join(tiptoe_dir, "msmarco_query.csv")
+        stages.append(Stage(f"queries_{mode}", [_script("prepare_tiptoe_data", "prepare_query_data.py") + [
+            "--query_vectors_path", test_queries[clustering], "--cluster_assignments_path", predicted,
+            "--output_dir_suffix", suffix, "--num_queries", str(args.num_queries)]],
+            inputs=[test_queries[clustering], predicted], outputs=[query_csv], cwd=args.work_dir))
+
+        gt_csv = os.path.join(tiptoe_dir, "msmarco_ground_truth.csv")
+        stages.append(Stage(f"ground_truth_{mode}", [_script("prepare_tiptoe_data", "prepare_ground_truth.py") + [
+            "--reverse_index_path", reverse_index, "--ground_truth_path", test_gnd[clustering],
+            "--output_dir_suffix", suffix]],
+            inputs=[reverse_index, test_gnd[clustering]], outputs=[gt_csv], cwd=args.work_dir))
+
+        def metadata_commands(suffix=suffix, clustering=clustering):
+            # The sizes are read from the upstream outputs once they exist
+            num_vectors, dim = np.load(docs_norm, mmap_mode="r").shape
+            num_clusters = int(np.max(np.load(assignments[clustering]))) + 1
+            return [_script("prepare_tiptoe_data", "prepare_metadata.py") + [
+                "--num_vectors", str(num_vectors), "--num_clusters", str(num_clusters), "--dim", str(dim),
+                "--output_dir_suffix", suffix]]
+        stages.append(Stage(f"metadata_{mode}", metadata_commands, inputs=[docs_norm, assignments[clustering]],
+                            outputs=[os.path.join(tiptoe_dir, "msmarco_metadata.json")], cwd=args.work_dir))
+    return stages
+
+
+def mode_targets(mode):
+    return [f"{step}_{mode}" for step in ("docs", "queries", "ground_truth", "metadata")]
+
+
+def main(args):
+    args.modes = MODES if "all" in args.modes else list(dict.fromkeys(args.modes))
+    args.work_dir = os.path.abspath(args.work_dir)
+    state_dir = args.state_dir or os.path.join(args.work_dir, "eval_data", ".pipeline")
+    pipeline = Pipeline(build_stages(args), state_dir)
+
+    targets = args.stages or [name for mode in args.modes for name in mode_targets(mode)]
+    unknown = [name for name in targets + args.force if name not in pipeline.stages]
+    if unknown:
+        raise ValueError(f"Unknown stages {unknown}, expected some of {sorted(pipeline.stages)}")
+    unreachable = [name for name in args.force if name not in pipeline.closure(targets)]
+    if unreachable:
+        raise ValueError(f"--force {unreachable} would not run: not among the targets {targets} or their dependencies")
+
+    start = time.time()
+    ok = pipeline.run(targets, jobs=args.jobs, force=args.force, dry_run=args.dry_run)
+    print(f"Pipeline {'finished' if ok else 'FAILED'} in {time.time() - start:.1f}s")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the clustering workflow as a DAG, skipping stages whose outputs are up to date.")
+    parser.add_argument('modes', nargs='+', choices=MODES + ("all",), help="Modes to prepare Tiptoe data for")
+    parser.add_argument('--doc_embeddings', default=_path("raw_data", "msmarco_doc_embeddings.npy"), help="Raw document embeddings (.npy or .fbin)")
+    parser.add_argument('--query_embeddings', default=_path("raw_data", "msmarco_query_embeddings.npy"), help="Raw query embeddings (.npy or .fbin)")
+    parser.add_argument('--device', choices=['gpu', 'cpu'], default='gpu', help="Engine for ground truth, k-means and the kNN graph")
+    parser.add_argument('--n_clusters', type=int, default=1000, help="Number of clusters (k-means and graph partition)")
+    parser.add_argument('--max_docs', type=int, default=1000000, help="Only use the first max_docs documents (0 for all)")
+    parser.add_argument('--train_size', type=int, default=500000, help="Number of router training queries")
+    parser.add_argument('--val_size', type=int, default=1000, help="Number of validation (and test) queries")
+    parser.add_argument('--num_queries', type=int, default=100, help="Number of test queries exported to Tiptoe format")
+    parser.add_argument('--format', choices=['bin', 'csv'], default='bin', help="Cluster file format")
+    parser.add_argument('--prec_bits', type=int, default=5, help="Quantization bits for the binary cluster format")
+    parser.add_argument('--jobs', type=int, default=2, help="Stages run in parallel")
+    parser.add_argument('--stages', nargs='+', default=None, help="Only bring these stages (and their dependencies) up to date")
+    parser.add_argument('--force', nargs='+', default=[], help="Rerun these stages (and everything downstream) even if up to date")
+    parser.add_argument('--dry_run', action='store_true', help="Only print which stages would run")
+    parser.add_argument('--work_dir', default=CLUSTERING_DIR, help="Directory holding eval_data/ and the tiptoe_<mode>/ outputs")
+    parser.add_argument('--state_dir', default=None, help="Where stage fingerprints and logs are kept (default: <work_dir>/eval_data/.pipeline)")
+
+    args = parser.parse_args()
+    sys.exit(0 if main(args) else 1)
@@ -0,0 +1,103 @@
+import os
+import struct
+import numpy as np
+
+# Binary cluster file, read by search/database.ReadClusterFromBin:
+#   magic "TTCL" | uint32 version | uint64 dim | uint64 count | uint64 precBits
+# followed by count*dim int8 values (row-major), already quantized with the same
+# rounding and clamping as utils.QuantizeClamp. All integers are little endian.
+MAGIC = b"TTCL"
+VERSION = 1
+HEADER = struct.Struct("<4sIQQQ")
+HEADER_SIZE = HEADER.size
+
+
+def quantize_clamp(values, prec_bits):
+    """
+    Vectorized mirror of Go's utils.QuantizeClamp: round half away from zero to
+    2^(precBits-1) steps, clamp to [-2^(precBits-1), 2^(precBits-1)], cast to int8.
+    """
+    scale = 1 << (prec_bits - 1)
+    scaled = np.asarray(values, dtype=np.float64) * scale
+    quantized = np.sign(scaled) * np.floor(np.abs(scaled) + 0.5)
+    # int8(128) wraps to -128 in Go as well, which only matters for precBits = 8
+    return np.clip(quantized, -scale, scale).astype(np.int16).astype(np.int8)
+
+
+def read_header(path):
+    with open(path, "rb") as f:
+        magic, version, dim, count, prec_bits = HEADER.unpack(f.read(HEADER_SIZE))
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a binary cluster file")
+    if version != VERSION:
+        raise ValueError(f"{path} has unsupported cluster file version {version}")
+    return dim, count, prec_bits
+
+
+def read_cluster_bin(path, mode="r"):
+    """Returns (vectors, prec_bits) with vectors an int8 (count, dim) memmap."""
+    dim, count, prec_bits = read_header(path)
+    if count == 0:
+        return np.zeros((0, dim), dtype=np.int8), prec_bits
+    vectors = np.memmap(path, dtype=np.int8, mode=mode, offset=HEADER_SIZE, shape=(count, dim))
+    return vectors, prec_bits
+
+
+class ClusterBinWriter:
+    """
+    Streams float vectors into a binary cluster file chunk by chunk. The vector
+    count in the header is patched when the writer is closed.
+    """
+
+    def __init__(self, path, dim, prec_bits):
+        self.path = path
+        self.dim = dim
+        self.prec_bits = prec_bits
+        self.count = 0
+        self.f = open(path, "wb", buffering=1 << 22)
+        self.f.write(HEADER.pack(MAGIC, VERSION, dim, 0, prec_bits))
+
+    def write(self, vectors):
+        vectors = np.asarray(vectors).reshape(-1, self.dim)
+        self.f.write(quantize_clamp(vectors, self.prec_bits).tobytes())
+        self.count += vectors.shape[0]
+
+    def close(self):
+        self.f.seek(0)
+        self.f.write(HEADER.pack(MAGIC, VERSION, self.dim, self.count, self.prec_bits))
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_cluster_bin(path, vectors, prec_bits, chunk_size=65536):
+    with ClusterBinWriter(path, vectors.shape[1], prec_bits) as writer:
+        for start in range(0, vectors.shape[0], chunk_size):
+            writer.write(vectors[start:start + chunk_size])
+
+
+def append_cluster_bin(path, vectors, prec_bits):
+    """
+    Appends float vectors to a binary cluster file (created if missing) and
+    patches the vector count in its header. Returns the position of the first
+    appended vector within the cluster.
+    """
+    vectors = np.asarray(vectors)
+    if not os.path.exists(path):
+        write_cluster_bin(path, vectors, prec_bits)
+        return 0
+    dim, count, file_prec_bits = read_header(path)
+    if dim != vectors.shape[1] or file_prec_bits != prec_bits:
+        raise ValueError(f"{path} holds {dim}-dim {file_prec_bits}-bit vectors, cannot append "
+                         f"{vectors.shape[1]}-dim {prec_bits}-bit ones")
+    with open(path, "r+b") as f:
+        f.seek(HEADER_SIZE + count * dim)
+        f.write(quantize_clamp(vectors, prec_bits).tobytes())
+        f.truncate()
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, dim, count + vectors.shape[0], prec_bits))
+    return count
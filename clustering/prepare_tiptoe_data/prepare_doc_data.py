@@ -1,55 +1,101 @@
 import argparse
-import numpy as np
 import json
+import numpy as np
 import os
+import sys
 from tqdm import tqdm
 
-def export_cluster_data(cluster_ids, doc_vectors, output_dir, mapping_filename="reverse_index.json"):
+from cluster_format import write_cluster_bin
+from reverse_index import ReverseIndex
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "util_scripts"))
+from vector_io import load_vectors
+
+CLUSTER_MANIFEST = "msmarco_cluster_files.json"
+
+
+def group_by_cluster(cluster_ids):
+    """
+    Returns (order, cluster_values, starts, counts): order lists doc ids grouped by
+    cluster and, within a cluster, in increasing doc id order.
+    """
+    order = np.argsort(cluster_ids, kind="stable")
+    cluster_values, starts, counts = np.unique(cluster_ids[order], return_index=True, return_counts=True)
+    return order, cluster_values, starts, counts
+
+
+def write_cluster_manifest(output_dir, filenames, file_format, prec_bits, manifest_filename=CLUSTER_MANIFEST):
+    """Lists the cluster files of an export, so their changes can be detected (see pipeline.py)."""
+    manifest_path = os.path.join(output_dir, manifest_filename)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump({"format": file_format, "prec_bits": prec_bits if file_format == "bin" else None,
+                   "files": list(filenames)}, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return manifest_path
+
+
+def export_cluster_data(cluster_ids, doc_vectors, output_dir, mapping_filename="reverse_index.npz",
+                        file_format="bin", prec_bits=5, chunk_size=65536):
     os.makedirs(output_dir, exist_ok=True)
 
     # Ensure cluster_ids is a flat 1D array of integers
     cluster_ids = np.ravel(cluster_ids).astype(int)
 
-    reverse_mapping = {}
-
     # Group document indices by cluster
-    clusters = {}
-    for doc_id, cluster_id in enumerate(cluster_ids):
-        clusters.setdefault(cluster_id, []).append(doc_id)
-
-    for cluster_id, doc_indices in tqdm(clusters.items()):
-        cluster_vectors = doc_vectors[doc_indices]
+    order, cluster_values, starts, counts = group_by_cluster(cluster_ids)
 
-        # Save vectors using numpy's savetxt
-        vector_filename = os.path.join(output_dir, f"msmarco_cluster_{cluster_id}.csv")
-        np.savetxt(vector_filename, cluster_vectors, delimiter=",", fmt="%.4f")
+    filenames = []
+    for cluster_id, start, count in tqdm(zip(cluster_values, starts, counts), total=len(cluster_values)):
+        doc_indices = order[start:start + count]
 
-        # Build reverse mapping for each document in this cluster
-        for position_in_cluster, original_doc_id in enumerate(doc_indices):
-            reverse_mapping[str(original_doc_id)] = [int(cluster_id), position_in_cluster]
+        if file_format == "bin":
+            # Vectors are quantized here once, so the Go server can memory-map them as-is
+            vector_filename = os.path.join(output_dir, f"msmarco_cluster_{cluster_id}.bin")
+            write_cluster_bin(vector_filename, _GatheredRows(doc_vectors, doc_indices), prec_bits, chunk_size)
+        else:
+            # Save vectors using numpy's savetxt
+            vector_filename = os.path.join(output_dir, f"msmarco_cluster_{cluster_id}.csv")
+            np.savetxt(vector_filename, doc_vectors[doc_indices], delimiter=",", fmt="%.4f")
 
+        filenames.append(os.path.basename(vector_filename))
         print(f"Saved cluster {cluster_id}: {len(doc_indices)} documents")
 
-    # Save reverse mapping as JSON
+    # Save reverse mapping as two int32 arrays (cluster id, position) indexed by doc id
     mapping_path = os.path.join(output_dir, mapping_filename)
-    with open(mapping_path, "w") as f:
-        json.dump(reverse_mapping, f, indent=2)
+    ReverseIndex.from_assignments(cluster_ids).save(mapping_path)
 
     print(f"Saved reverse mapping to {mapping_path}")
 
+    manifest_path = write_cluster_manifest(output_dir, filenames, file_format, prec_bits)
+    print(f"Saved the list of cluster files to {manifest_path}")
+
+
+class _GatheredRows:
+    """Lazy view of doc_vectors[doc_indices] that gathers one slice at a time."""
+
+    def __init__(self, doc_vectors, doc_indices):
+        self.doc_vectors = doc_vectors
+        self.doc_indices = doc_indices
+        self.shape = (len(doc_indices), doc_vectors.shape[1])
+
+    def __getitem__(self, rows):
+        return self.doc_vectors[self.doc_indices[rows]]
+
 
 def main(args):
     cluster_ids = np.load(args.cluster_assignments_path)
-    doc_vectors = np.load(args.doc_embeddings_path)
+    doc_vectors = load_vectors(args.doc_embeddings_path)
     output_dir = "tiptoe_" + args.output_dir_suffix
-    export_cluster_data(cluster_ids, doc_vectors, output_dir)
+    export_cluster_data(cluster_ids, doc_vectors, output_dir, file_format=args.format, prec_bits=args.prec_bits)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Load cluster and document embeddings and export cluster data.")
-    
+
     parser.add_argument('--output_dir_suffix', required=True, choices=['baseline', 'baseline_learned', 'graph'])
     parser.add_argument('--cluster_assignments_path', required=True, help="Path to cluster assignments .npy file")
-    parser.add_argument('--doc_embeddings_path', required=True, help="Path to document embeddings .npy file")
+    parser.add_argument('--doc_embeddings_path', required=True, help="Path to document embeddings .npy or .fbin file")
+    parser.add_argument('--format', choices=['bin', 'csv'], default='bin', help="Cluster file format: pre-quantized binary or float CSV")
+    parser.add_argument('--prec_bits', type=int, default=5, help="Quantization bits for the binary format (must match the server's -precBits)")
 
     args = parser.parse_args()
     main(args)
@@ -1,52 +1,67 @@
 import argparse
 import numpy as np
-import json
-import csv
 import os
+import sys
 
-def convert_ground_truth(reverse_index_path, ground_truth_array, output_csv_path):
+from reverse_index import ReverseIndex
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "util_scripts"))
+from vector_io import load_vectors
+
+
+def convert_ground_truth(reverse_index_path, ground_truth_array, output_csv_path, num_queries=None,
+                         chunk_size=65536, allow_missing=False):
     # Load reverse index mapping
-    with open(reverse_index_path, "r") as f:
-        reverse_index = json.load(f)
+    reverse_index = ReverseIndex.load(reverse_index_path)
 
-    num_queries, top_k = ground_truth_array.shape
-    transformed_data = []
-    num_queries = 100
+    total_queries, top_k = ground_truth_array.shape
+    num_queries = total_queries if num_queries is None else min(num_queries, total_queries)
 
-    for i in range(num_queries):
-        row = []
-        for original_doc_id in ground_truth_array[i]:
-            original_doc_id_str = str(original_doc_id)
-            if original_doc_id_str not in reverse_index:
-                raise ValueError(f"Doc ID {original_doc_id} not found in reverse index.")
-            cluster_id, position = reverse_index[original_doc_id_str]
-            row.extend([cluster_id, position])  # No parentheses, just values
-        transformed_data.append(row)
+    # Translate every doc id to its (cluster_id, position) pair in one gather
+    cluster_ids, positions = reverse_index.lookup(ground_truth_array[:num_queries])
 
-    # Save to CSV (no header, no parentheses)
-    with open(output_csv_path, "w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerows(transformed_data)
+    # Report all missing ids at once instead of stopping at the first one
+    missing = cluster_ids < 0
+    if missing.any():
+        missing_ids = np.unique(np.asarray(ground_truth_array[:num_queries])[missing])
+        message = (f"{missing_ids.size} distinct doc IDs ({int(missing.sum())} entries in "
+                   f"{int(missing.any(axis=1).sum())} queries) not found in reverse index, "
+                   f"e.g. {missing_ids[:10].tolist()}")
+        if not allow_missing:
+            raise ValueError(message)
+        print(f"Warning: {message}; writing them as -1,-1")
 
-    print(f"Saved transformed ground truth to {output_csv_path}")
+    # Save to CSV (no header, no parentheses), streamed out a chunk of rows at a time
+    with open(output_csv_path, "w") as f:
+        for start in range(0, num_queries, chunk_size):
+            end = min(start + chunk_size, num_queries)
+            rows = np.empty((end - start, 2 * top_k), dtype=np.int64)
+            rows[:, 0::2] = cluster_ids[start:end]  # No parentheses, just values
+            rows[:, 1::2] = positions[start:end]
+            np.savetxt(f, rows, fmt="%d", delimiter=",")
+
+    print(f"Saved transformed ground truth for {num_queries} queries to {output_csv_path}")
 
 
 def main(args):
     reverse_index_path = args.reverse_index_path
-    ground_truth_array = np.load(args.ground_truth_path)
+    ground_truth_array = load_vectors(args.ground_truth_path)
     
     output_dir = "tiptoe_" + args.output_dir_suffix
-    output_path = os.path.join(output_dir, "msmarco_ground_truth.csv")
-    convert_ground_truth(reverse_index_path, ground_truth_array, output_path)
+    output_path = args.output_path or os.path.join(output_dir, "msmarco_ground_truth.csv")
+    convert_ground_truth(reverse_index_path, ground_truth_array, output_path, num_queries=args.num_queries,
+                         chunk_size=args.chunk_size, allow_missing=args.allow_missing)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Convert ground truth using reverse index.")
     parser.add_argument('--output_dir_suffix', required=True, choices=['baseline', 'baseline_learned', 'graph'])
-    parser.add_argument('--reverse_index_path', required=True, help="Path to reverse index JSON file")
-    parser.add_argument('--ground_truth_path', required=True, help="Path to ground truth .npy file")
+    parser.add_argument('--reverse_index_path', required=True, help="Path to reverse index .npz (or legacy .json) file")
+    parser.add_argument('--ground_truth_path', required=True, help="Path to ground truth .npy or .ibin file")
+    parser.add_argument('--output_path', default=None, help="Output CSV path (default: tiptoe_<suffix>/msmarco_ground_truth.csv)")
+    parser.add_argument('--num_queries', type=int, default=None, help="Only convert the first num_queries rows (default: all)")
+    parser.add_argument('--chunk_size', type=int, default=65536, help="Rows per CSV write")
+    parser.add_argument('--allow_missing', action='store_true', help="Write missing doc ids as -1,-1 instead of failing")
 
     args = parser.parse_args()
     main(args)
-
-
@@ -1,13 +1,21 @@
 import numpy as np
 import argparse
 import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cluster_model"))
+from router import Router
 
 def main(args):
     # Load and slice query vectors
-    query_vectors = np.load(args.query_vectors_path)[:100]
+    query_vectors = np.load(args.query_vectors_path, mmap_mode='r')[:args.num_queries]
 
-    # Load and slice cluster assignments
-    query_cluster_assignments = np.load(args.cluster_assignments_path)[:100]
+    if args.router_path:
+        # Route the queries directly with a saved router artifact
+        query_cluster_assignments = Router.load(args.router_path).route(query_vectors, m=1)[0][:, 0]
+    else:
+        # Load and slice cluster assignments
+        query_cluster_assignments = np.load(args.cluster_assignments_path)[:args.num_queries]
 
     # Reshape cluster IDs to column vector and concatenate with query vectors
     ids_column = query_cluster_assignments.reshape(-1, 1)
@@ -23,9 +31,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Prepare MSMARCO query CSV with cluster IDs and embeddings.")
     parser.add_argument('--output_dir_suffix', required=True, choices=['baseline', 'baseline_learned', 'graph'])
     parser.add_argument('--query_vectors_path', required=True, help="Path to reduced query vectors .npy file")
-    parser.add_argument('--cluster_assignments_path', required=True, help="Path to predicted cluster IDs .npy file")
+    routing = parser.add_mutually_exclusive_group(required=True)
+    routing.add_argument('--cluster_assignments_path', help="Path to predicted cluster IDs .npy file")
+    routing.add_argument('--router_path', help="Path to a router artifact .npz to route the queries with")
+    parser.add_argument('--num_queries', type=int, default=100, help="Number of queries to export")
 
     args = parser.parse_args()
     main(args)
-
-
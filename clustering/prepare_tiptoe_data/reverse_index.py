@@ -0,0 +1,90 @@
+import json
+import os
+import zipfile
+import numpy as np
+
+# A reverse index maps an original doc id to the (cluster id, position within the
+# cluster) pair used in result and ground-truth CSVs. It is stored as two int32
+# arrays indexed by doc id in an uncompressed .npz, so it can be memory-mapped.
+# Docs that are not in the index have cluster id and position -1.
+
+
+def _memmap_npz(path):
+    """
+    Memory-maps every array of an uncompressed .npz. np.load ignores mmap_mode for
+    archives, so the array data offsets are read from the zip local headers.
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as zf, open(path, "rb") as f:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                return dict(np.load(path))
+            # Local file header: 30 fixed bytes, then the file name and extra field
+            f.seek(info.header_offset + 26)
+            name_len, extra_len = np.frombuffer(f.read(4), dtype="<u2")
+            f.seek(info.header_offset + 30 + int(name_len) + int(extra_len))
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            arrays[info.filename[:-len(".npy")]] = np.memmap(
+                path, dtype=dtype, mode="r", offset=f.tell(), shape=shape,
+                order="F" if fortran_order else "C")
+    return arrays
+
+
+class ReverseIndex:
+    def __init__(self, cluster_ids, positions):
+        self.cluster_ids = cluster_ids
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.cluster_ids)
+
+    @classmethod
+    def from_assignments(cls, cluster_ids):
+        """
+        Builds the index from per-doc cluster assignments. Within a cluster, docs
+        keep increasing doc id order, which is the order the cluster files use.
+        """
+        cluster_ids = np.ravel(cluster_ids).astype(np.int32)
+        order = np.argsort(cluster_ids, kind="stable")
+        sorted_ids = cluster_ids[order]
+        starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+        group_start = np.repeat(starts, np.diff(np.r_[starts, len(sorted_ids)]))
+        positions = np.empty(len(cluster_ids), dtype=np.int32)
+        positions[order] = np.arange(len(cluster_ids), dtype=np.int32) - group_start
+        return cls(cluster_ids, positions)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a .npz index memory-mapped, or converts a legacy reverse_index.json."""
+        if os.path.splitext(path)[1] == ".json":
+            with open(path, "r") as f:
+                mapping = json.load(f)
+            doc_ids = np.fromiter(mapping.keys(), dtype=np.int64, count=len(mapping))
+            pairs = np.array(list(mapping.values()), dtype=np.int32).reshape(-1, 2)
+            cluster_ids = np.full(doc_ids.max() + 1 if len(doc_ids) else 0, -1, dtype=np.int32)
+            positions = cluster_ids.copy()
+            cluster_ids[doc_ids], positions[doc_ids] = pairs[:, 0], pairs[:, 1]
+            return cls(cluster_ids, positions)
+
+        arrays = _memmap_npz(path)
+        return cls(arrays["cluster_id"], arrays["position"])
+
+    def save(self, path):
+        np.savez(path, cluster_id=np.asarray(self.cluster_ids, dtype=np.int32),
+                 position=np.asarray(self.positions, dtype=np.int32))
+
+    def lookup(self, doc_ids):
+        """
+        Translates an array of doc ids (any shape) into (cluster_ids, positions)
+        arrays of the same shape with one gather. Unknown ids map to -1.
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        known = (doc_ids >= 0) & (doc_ids < len(self))
+        safe_ids = np.where(known, doc_ids, 0)
+        cluster_ids = np.where(known, self.cluster_ids[safe_ids.ravel()].reshape(doc_ids.shape), -1)
+        positions = np.where(known, self.positions[safe_ids.ravel()].reshape(doc_ids.shape), -1)
+        return cluster_ids, positions
@@ -0,0 +1,239 @@
+import argparse
+import json
+import os
+import sys
+import numpy as np
+
+from cluster_format import append_cluster_bin, read_cluster_bin, read_header
+from prepare_doc_data import write_cluster_manifest
+from reverse_index import ReverseIndex
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "util_scripts"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cluster_model"))
+from pir_layout import HINT_SZ, column_capacity, db_shape
+from vector_io import load_vectors
+from router import Router
+
+# Positions within a cluster are what the result and ground-truth CSVs refer to,
+# so they never move: new documents are appended at the end of their cluster and
+# deleted ones are tombstoned, i.e. their row is zeroed (it scores 0, like the
+# server's padding rows) and the reverse index no longer points to it.
+
+
+class ExportedIndex:
+    """The cluster files, reverse index and metadata prepare_doc_data wrote to output_dir."""
+
+    def __init__(self, output_dir, prefix="msmarco", mapping_filename="reverse_index.npz"):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.mapping_path = os.path.join(output_dir, mapping_filename)
+        self.metadata_path = os.path.join(output_dir, f"{prefix}_metadata.json")
+        with open(self.metadata_path, "r") as f:
+            self.metadata = json.load(f)
+
+        # Copied into memory, the file is rewritten at the end of the update
+        index = ReverseIndex.load(self.mapping_path)
+        self.reverse_index = ReverseIndex(np.array(index.cluster_ids, dtype=np.int32), np.array(index.positions, dtype=np.int32))
+        self.file_format = "bin" if os.path.exists(self.cluster_path(0, "bin")) else "csv"
+        self.prec_bits = read_header(self.cluster_path(0, "bin"))[2] if self.file_format == "bin" else None
+        self.rows = np.array([self._count_rows(i) for i in range(self.metadata["num_clusters"])], dtype=np.int64)
+
+    def cluster_path(self, cluster, file_format=None):
+        return os.path.join(self.output_dir, f"{self.prefix}_cluster_{cluster}.{file_format or self.file_format}")
+
+    def _count_rows(self, cluster):
+        path = self.cluster_path(cluster)
+        if not os.path.exists(path):
+            return 0
+        if self.file_format == "bin":
+            return read_header(path)[1]
+        with open(path, "rb") as f:
+            return sum(1 for line in f if line.strip())
+
+    def live_counts(self):
+        live = self.reverse_index.cluster_ids[self.reverse_index.cluster_ids >= 0]
+        return np.bincount(live, minlength=len(self.rows))
+
+    def tombstone(self, doc_ids):
+        """Zeroes the rows of the given (present) doc ids and drops them from the reverse index."""
+        clusters, positions = self.reverse_index.lookup(doc_ids)
+        present = clusters >= 0
+        for cluster in np.unique(clusters[present]):
+            rows = positions[present & (clusters == cluster)]
+            if self.file_format == "bin":
+                vectors, _ = read_cluster_bin(self.cluster_path(cluster), mode="r+")
+                vectors[rows] = 0
+                vectors.flush()
+                del vectors
+            else:
+                path = self.cluster_path(cluster)
+                with open(path, "r") as f:
+                    lines = f.readlines()
+                zero_line = ",".join(["0.0000"] * self.metadata["dim"]) + "\n"
+                for row in rows:
+                    lines[row] = zero_line
+                with open(path + ".tmp", "w") as f:
+                    f.writelines(lines)
+                os.replace(path + ".tmp", path)
+        self.reverse_index.cluster_ids[doc_ids[present]] = -1
+        self.reverse_index.positions[doc_ids[present]] = -1
+        return int(present.sum())
+
+    def append(self, doc_ids, cluster_ids, vectors, chunk_size=65536):
+        """Appends each document to the end of its cluster's file and records its position."""
+        num_clusters = max(len(self.rows), int(cluster_ids.max()) + 1)
+        self.rows = np.r_[self.rows, np.zeros(num_clusters - len(self.rows), dtype=np.int64)]
+        if len(self.reverse_index) <= doc_ids.max():
+            grow = int(doc_ids.max()) + 1 - len(self.reverse_index)
+            self.reverse_index = ReverseIndex(np.r_[self.reverse_index.cluster_ids, np.full(grow, -1, dtype=np.int32)],
+                                              np.r_[self.reverse_index.positions, np.full(grow, -1, dtype=np.int32)])
+
+        # Documents are grouped by cluster, keeping their doc id order within it
+        order = np.lexsort((doc_ids, cluster_ids))
+        clusters, starts = np.unique(cluster_ids[order], return_index=True)
+        for cluster, start, end in zip(clusters, starts, np.r_[starts[1:], len(order)]):
+            members = order[start:end]
+            first = int(self.rows[cluster])
+            for offset in range(0, len(members), chunk_size):
+                block = np.asarray(vectors[np.sort(members[offset:offset + chunk_size])], dtype=np.float32)
+                if self.file_format == "bin":
+                    append_cluster_bin(self.cluster_path(cluster), block, self.prec_bits)
+                else:
+                    with open(self.cluster_path(cluster), "a") as f:
+                        np.savetxt(f, block, delimiter=",", fmt="%.4f")
+            self.rows[cluster] += len(members)
+            self.reverse_index.cluster_ids[doc_ids[members]] = cluster
+            self.reverse_index.positions[doc_ids[members]] = first + np.arange(len(members), dtype=np.int32)
+
+    def save(self):
+        # Written under temporary names and renamed, so readers never see half a file
+        tmp_path = self.mapping_path[:-len(".npz")] + ".tmp.npz"
+        self.reverse_index.save(tmp_path)
+        os.replace(tmp_path, self.mapping_path)
+
+        self.metadata["num_vectors"] = int(self.rows.sum())
+        self.metadata["num_clusters"] = len(self.rows)
+        with open(self.metadata_path + ".tmp", "w") as f:
+            json.dump(self.metadata, f, indent=2)
+        os.replace(self.metadata_path + ".tmp", self.metadata_path)
+
+        # Clusters created by the update join the export's list of cluster files
+        manifest_filename = f"{self.prefix}_cluster_files.json"
+        if os.path.exists(os.path.join(self.output_dir, manifest_filename)):
+            filenames = [os.path.basename(self.cluster_path(i)) for i in range(len(self.rows))
+                         if os.path.exists(self.cluster_path(i))]
+            write_cluster_manifest(self.output_dir, filenames, self.file_format, self.prec_bits, manifest_filename)
+
+
+def drift_report(rows_before, live_before, rows, live, route_scores, max_cluster_size, max_growth, max_tombstone_fraction, min_score):
+    """
+    Per-cluster changes of the clusters the update touched, with the reasons a
+    cluster should be re-split locally: it outgrew the size limit or its size
+    before the update by max_growth, too many of its rows are tombstones, or the
+    new documents routed to it fit it poorly (mean routing score below min_score).
+    """
+    report = []
+    rows_before = np.r_[rows_before, np.zeros(len(rows) - len(rows_before), dtype=np.int64)]
+    live_before = np.r_[live_before, np.zeros(len(rows) - len(live_before), dtype=np.int64)]
+    touched = np.flatnonzero((rows != rows_before) | (live != live_before))
+    for cluster in touched:
+        before = int(rows_before[cluster])
+        entry = {"cluster": int(cluster), "rows_before": before, "rows": int(rows[cluster]), "live": int(live[cluster]),
+                 "tombstone_fraction": 1.0 - live[cluster] / rows[cluster] if rows[cluster] else 0.0}
+        if cluster in route_scores:
+            entry["added"] = len(route_scores[cluster])
+            entry["mean_route_score"] = float(np.mean(route_scores[cluster]))
+
+        reasons = []
+        if rows[cluster] > max_cluster_size:
+            reasons.append(f"{rows[cluster]} rows > {max_cluster_size}")
+        if before and rows[cluster] > before * max_growth:
+            reasons.append(f"grew {rows[cluster] / before:.2f}x")
+        if entry["tombstone_fraction"] > max_tombstone_fraction:
+            reasons.append(f"{entry['tombstone_fraction'] * 100:.0f}% tombstones")
+        if min_score is not None and entry.get("mean_route_score", np.inf) < min_score:
+            reasons.append(f"mean route score {entry['mean_route_score']:.3f} < {min_score}")
+        entry["resplit"] = reasons
+        report.append(entry)
+    return report
+
+
+def main(args):
+    output_dir = "tiptoe_" + args.output_dir_suffix
+    index = ExportedIndex(output_dir)
+    rows_before, live_before = index.rows.copy(), index.live_counts()
+    shape_before = db_shape(rows_before, index.metadata["dim"], args.hint_sz)
+
+    # Deleted documents, and the old rows of re-added ones, are tombstoned first
+    new_doc_ids = None
+    if args.new_doc_embeddings_path:
+        new_vectors = load_vectors(args.new_doc_embeddings_path)
+        if args.new_doc_ids_path:
+            new_doc_ids = np.ravel(np.load(args.new_doc_ids_path)).astype(np.int64)
+        else:
+            new_doc_ids = len(index.reverse_index) + np.arange(new_vectors.shape[0], dtype=np.int64)
+        if len(new_doc_ids) != new_vectors.shape[0]:
+            raise ValueError(f"{len(new_doc_ids)} doc ids for {new_vectors.shape[0]} new documents")
+    deleted = np.ravel(np.load(args.delete_ids_path)).astype(np.int64) if args.delete_ids_path else np.empty(0, dtype=np.int64)
+    num_deleted = index.tombstone(np.unique(deleted))
+    num_replaced = index.tombstone(np.unique(new_doc_ids)) if new_doc_ids is not None else 0
+    num_tombstoned = num_deleted + num_replaced
+    print(f"Tombstoned {num_deleted} deleted documents (of {len(deleted)} requested) and {num_replaced} replaced ones")
+
+    # New documents go to their best cluster under the saved centroids or router
+    route_scores = {}
+    if new_doc_ids is not None:
+        router = Router.load(args.router_path) if args.router_path else Router.from_centroids(np.load(args.centroids_path))
+        cluster_ids = np.empty(len(new_doc_ids), dtype=np.int64)
+        scores = np.empty(len(new_doc_ids), dtype=np.float32)
+        for start in range(0, len(new_doc_ids), args.chunk_size):
+            ids, block_scores = router.route(np.asarray(new_vectors[start:start + args.chunk_size], dtype=np.float32))
+            cluster_ids[start:start + len(ids)], scores[start:start + len(ids)] = ids[:, 0], block_scores[:, 0]
+        index.append(new_doc_ids, cluster_ids, new_vectors, args.chunk_size)
+        for cluster in np.unique(cluster_ids):
+            route_scores[int(cluster)] = scores[cluster_ids == cluster]
+        print(f"Appended {len(new_doc_ids)} documents to {len(route_scores)} clusters")
+
+    index.save()
+    shape = db_shape(index.rows, index.metadata["dim"], args.hint_sz)
+    print(f"Updated {index.metadata_path}: {index.metadata['num_vectors']} vectors in {index.metadata['num_clusters']} clusters")
+    print(f"DB {shape_before['l']} x {shape_before['m']} ({shape_before['padding'] * 100:.2f}% padding) -> "
+          f"{shape['l']} x {shape['m']} ({shape['padding'] * 100:.2f}% padding)")
+
+    max_cluster_size = args.max_cluster_size or column_capacity(args.hint_sz) - 1
+    report = drift_report(rows_before, live_before, index.rows, index.live_counts(), route_scores, max_cluster_size,
+                          args.max_growth, args.max_tombstone_fraction, args.min_route_score)
+    flagged = [entry for entry in report if entry["resplit"]]
+    for entry in flagged:
+        print(f"Cluster {entry['cluster']} should be re-split: {', '.join(entry['resplit'])}")
+    print(f"{len(report)} clusters changed, {len(flagged)} flagged for re-splitting")
+
+    report_path = args.report_path or os.path.join(output_dir, "update_report.json")
+    with open(report_path, "w") as f:
+        json.dump({"db_before": shape_before, "db_after": shape, "tombstoned": num_tombstoned,
+                   "added": 0 if new_doc_ids is None else len(new_doc_ids), "clusters": report}, f, indent=2)
+    print(f"Saved drift report to {report_path}")
+    print("Note: ground-truth CSVs exported before the update are stale")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add and delete documents of an exported Tiptoe index without re-clustering.")
+    parser.add_argument('--output_dir_suffix', required=True, choices=['baseline', 'baseline_learned', 'graph'])
+    parser.add_argument('--new_doc_embeddings_path', default=None, help="Normalized embeddings of the documents to add (.npy or .fbin)")
+    parser.add_argument('--new_doc_ids_path', default=None, help="Doc ids of the added documents .npy (default: after the last indexed id); existing ids are replaced")
+    parser.add_argument('--delete_ids_path', default=None, help="Doc ids to delete .npy")
+    routing = parser.add_mutually_exclusive_group()
+    routing.add_argument('--centroids_path', help="Centroids .npy the index was clustered with")
+    routing.add_argument('--router_path', help="Router artifact .npz to assign the new documents with")
+    parser.add_argument('--hint_sz', type=int, default=HINT_SZ, help="Server hintSz, for the database shape and default size limit")
+    parser.add_argument('--max_cluster_size', type=int, default=None, help="Flag clusters above this size (default: column capacity - 1)")
+    parser.add_argument('--max_growth', type=float, default=1.5, help="Flag clusters that grew by more than this factor")
+    parser.add_argument('--max_tombstone_fraction', type=float, default=0.2, help="Flag clusters with more tombstoned rows than this")
+    parser.add_argument('--min_route_score', type=float, default=None, help="Flag clusters whose new documents' mean routing score is below this")
+    parser.add_argument('--chunk_size', type=int, default=65536, help="Documents per routing and write chunk")
+    parser.add_argument('--report_path', default=None, help="Path of the drift report (default: <output_dir>/update_report.json)")
+
+    args = parser.parse_args()
+    if args.new_doc_embeddings_path and not (args.centroids_path or args.router_path):
+        parser.error("--centroids_path or --router_path is needed to assign new documents")
+    main(args)
@@ -1,44 +1,205 @@
+import argparse
+import hashlib
+import json
+import multiprocessing as mp
 import os
 import numpy as np
-from beir.datasets.data_loader import GenericDataLoader
-from sentence_transformers import SentenceTransformer
 from tqdm import tqdm
-from beir import util  # This is the correct import for downloading datasets
 
-# Step 2: Load the MS MARCO dataset using BEIR
-dataset = "msmarco"
-data_path = os.path.join("datasets", dataset)
+from embedding_cache import EmbeddingCache, hash_texts
 
-# Download and extract the dataset
-url = f"https://public.ukp.informatik.tu-darmstadt.de/thakur/BEIR/datasets/{dataset}.zip"
-data_path = util.download_and_unzip(url, data_path)
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
 
-# Load the corpus, queries, and qrels
-corpus, queries, qrels = GenericDataLoader(data_path).load(split="train")
 
-# Step 3: Initialize the embedding model
-model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+def load_msmarco(data_dir, dataset="msmarco", split="train"):
+    from beir import util  # This is the correct import for downloading datasets
+    from beir.datasets.data_loader import GenericDataLoader
 
-# Function to encode texts in batches
-def encode_texts(texts, batch_size=64):
-    embeddings = []
-    for i in tqdm(range(0, len(texts), batch_size), desc="Encoding"):
-        batch_texts = texts[i:i+batch_size]
-        batch_embeddings = model.encode(batch_texts, convert_to_numpy=True, show_progress_bar=False)
-        embeddings.append(batch_embeddings)
-    return np.vstack(embeddings)
+    # Download and extract the dataset
+    url = f"https://public.ukp.informatik.tu-darmstadt.de/thakur/BEIR/datasets/{dataset}.zip"
+    data_path = util.download_and_unzip(url, os.path.join(data_dir, dataset))
 
-# Step 4: Prepare and encode documents
-doc_ids = list(corpus.keys())
-doc_texts = [corpus[doc_id].get("title", "") + " " + corpus[doc_id].get("text", "") for doc_id in doc_ids]
-doc_embeddings = encode_texts(doc_texts)
+    # Load the corpus, queries, and qrels
+    corpus, queries, qrels = GenericDataLoader(data_path).load(split=split)
+    return corpus, queries
 
-# Step 5: Prepare and encode queries
-query_ids = list(queries.keys())
-query_texts = [queries[qid] for qid in query_ids]
-query_embeddings = encode_texts(query_texts)
 
+def plan_shards(texts, shard_size):
+    """
+    Orders texts by length so every shard (and every batch inside it) holds texts
+    of similar length, which keeps padding waste low. Returns a list of index
+    arrays, one per shard, each sorted by original position.
+    """
+    lengths = np.fromiter((len(t) for t in texts), dtype=np.int64, count=len(texts))
+    order = np.argsort(lengths, kind="stable")
+    return [np.sort(order[start:start + shard_size]) for start in range(0, len(texts), shard_size)]
 
-np.save("msmarco_doc_embeddings.npy", doc_embeddings)
-np.save("msmarco_query_embeddings.npy", query_embeddings)
 
+def _plan_fingerprint(model_name, shards):
+    digest = hashlib.sha1(model_name.encode())
+    for shard in shards:
+        digest.update(shard.tobytes())
+    return digest.hexdigest()
+
+
+def _load_progress(progress_path, fingerprint):
+    if os.path.exists(progress_path):
+        with open(progress_path, "r") as f:
+            progress = json.load(f)
+        if progress.get("fingerprint") == fingerprint:
+            return progress
+        print(f"Ignoring {progress_path}: it was written for a different corpus, model or shard size")
+    return {"fingerprint": fingerprint, "dim": None, "done": []}
+
+
+def _save_progress(progress_path, progress):
+    tmp_path = progress_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, progress_path)
+
+
+_worker_state = {}
+
+
+def _init_worker(model_name, threads_per_worker):
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    torch.set_num_threads(threads_per_worker)
+    _worker_state["model"] = SentenceTransformer(model_name, device="cpu")
+
+
+def _encode_shard(task):
+    shard_id, texts, batch_size = task
+    model = _worker_state["model"]
+    embeddings = model.encode(texts, batch_size=batch_size, convert_to_numpy=True, show_progress_bar=False)
+    return shard_id, embeddings.astype(np.float32, copy=False)
+
+
+def embed_texts(texts, output_path, model_name=MODEL_NAME, shard_size=65536, batch_size=64, workers=None,
+                threads_per_worker=1, cache=None, cache_chunk_size=65536):
+    """
+    Encodes texts into a preallocated (len(texts), dim) float32 .npy memmap,
+    one length-bucketed shard at a time. Finished shards are recorded in
+    <output_path>.progress.json, so an interrupted run resumes from there.
+    workers=0 encodes in this process on the model's default device (e.g. a GPU);
+    otherwise shards are spread over that many CPU worker processes.
+    With an EmbeddingCache, cached texts are copied from it and only the misses
+    are encoded (and then added to the cache).
+    """
+    # Look up every text in the cache at once; only the misses are sharded
+    todo = np.arange(len(texts))
+    if cache is not None:
+        keys = hash_texts(model_name, texts)
+        hit, hit_rows = cache.lookup(keys)
+        todo = np.flatnonzero(~hit)
+        print(f"{len(texts) - len(todo)}/{len(texts)} embeddings found in the cache")
+    shards = [todo[shard] for shard in plan_shards([texts[i] for i in todo], shard_size)]
+
+    progress_path = output_path + ".progress.json"
+    progress = _load_progress(progress_path, _plan_fingerprint(model_name, shards))
+
+    out = None
+    if progress["dim"] is not None and os.path.exists(output_path):
+        out = np.lib.format.open_memmap(output_path, mode="r+")
+        if out.shape != (len(texts), progress["dim"]) or out.dtype != np.float32:
+            out = None
+    if out is None and progress["done"]:
+        # The finished shards only exist in the output, so without it they are encoded again
+        print(f"{output_path} is missing or has the wrong shape, discarding the recorded progress")
+        progress["done"], progress["dim"] = [], None
+        _save_progress(progress_path, progress)
+    done = set(progress["done"])
+    pending = [shard_id for shard_id in range(len(shards)) if shard_id not in done]
+    print(f"{len(done)}/{len(shards)} shards already encoded, {len(pending)} to go")
+
+    def allocate(dim):
+        nonlocal out
+        # The output is allocated once the embedding dimension is known
+        progress["dim"] = int(dim)
+        out = np.lib.format.open_memmap(output_path, mode="w+", dtype=np.float32, shape=(len(texts), progress["dim"]))
+
+    if cache is not None and len(hit_rows):
+        if out is None:
+            allocate(cache.dim)
+        hit_idx = np.flatnonzero(hit)
+        for start in tqdm(range(0, len(hit_idx), cache_chunk_size), desc="Copying cached embeddings"):
+            out[hit_idx[start:start + cache_chunk_size]] = cache.read(hit_rows[start:start + cache_chunk_size])
+        out.flush()
+
+    def write_shard(shard_id, embeddings):
+        if out is None:
+            allocate(embeddings.shape[1])
+        out[shards[shard_id]] = embeddings
+        out.flush()
+        if cache is not None:
+            # Flushed per shard, so a crash only loses the shard being encoded
+            cache.put(keys[shards[shard_id]], embeddings)
+            cache.flush()
+        progress["done"].append(int(shard_id))
+        _save_progress(progress_path, progress)
+
+    tasks = ((shard_id, [texts[i] for i in shards[shard_id]], batch_size) for shard_id in pending)
+    if workers == 0:
+        from sentence_transformers import SentenceTransformer
+
+        model = SentenceTransformer(model_name)
+        for shard_id, shard_texts, _ in tqdm(tasks, total=len(pending), desc="Encoding"):
+            write_shard(shard_id, model.encode(shard_texts, batch_size=batch_size, convert_to_numpy=True,
+                                               show_progress_bar=False).astype(np.float32, copy=False))
+    elif pending:
+        ctx = mp.get_context("spawn")
+        with ctx.Pool(workers, initializer=_init_worker, initargs=(model_name, threads_per_worker)) as pool:
+            for shard_id, embeddings in tqdm(pool.imap_unordered(_encode_shard, tasks), total=len(pending), desc="Encoding"):
+                write_shard(shard_id, embeddings)
+
+    if out is None:
+        raise ValueError(f"Nothing was encoded into {output_path}")
+    del out
+    if cache is not None:
+        cache.flush()
+    if os.path.exists(progress_path):
+        os.remove(progress_path)
+
+
+def main(args):
+    corpus, queries = load_msmarco(args.data_dir, split=args.split)
+
+    threads_per_worker = max(1, args.threads_per_worker)
+    workers = args.workers if args.workers is not None else max(1, os.cpu_count() // threads_per_worker)
+    cache = EmbeddingCache(args.cache_dir) if args.cache_dir else None
+
+    # Prepare and encode documents
+    doc_ids = list(corpus.keys())
+    doc_texts = [corpus[doc_id].get("title", "") + " " + corpus[doc_id].get("text", "") for doc_id in doc_ids]
+    embed_texts(doc_texts, os.path.join(args.output_dir, "msmarco_doc_embeddings.npy"), args.model,
+                args.shard_size, args.batch_size, workers, threads_per_worker, cache)
+
+    # Prepare and encode queries
+    query_ids = list(queries.keys())
+    query_texts = [queries[qid] for qid in query_ids]
+    embed_texts(query_texts, os.path.join(args.output_dir, "msmarco_query_embeddings.npy"), args.model,
+                args.shard_size, args.batch_size, workers, threads_per_worker, cache)
+
+    # Entries not used by this run are the first to go once the cache outgrows its budget
+    if cache is not None and args.cache_max_gb is not None:
+        cache.evict(int(args.cache_max_gb * 2**30))
+        cache.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed the MS MARCO corpus and queries with a sentence-transformers model.")
+    parser.add_argument('--data_dir', default='datasets', help="Where to download and extract the BEIR dataset")
+    parser.add_argument('--split', default='train', help="BEIR split whose queries are embedded")
+    parser.add_argument('--output_dir', default='.', help="Directory for the embedding .npy files")
+    parser.add_argument('--model', default=MODEL_NAME, help="sentence-transformers model name")
+    parser.add_argument('--shard_size', type=int, default=65536, help="Texts per shard (unit of work and of resumption)")
+    parser.add_argument('--batch_size', type=int, default=64, help="Encoding batch size")
+    parser.add_argument('--workers', type=int, default=None, help="CPU worker processes (default: cores / threads_per_worker; 0 encodes in-process on the default device)")
+    parser.add_argument('--threads_per_worker', type=int, default=1, help="Torch threads per CPU worker")
+    parser.add_argument('--cache_dir', default=None, help="Persistent embedding cache; only texts missing from it are encoded")
+    parser.add_argument('--cache_max_gb', type=float, default=None, help="Evict least recently used cache entries beyond this size")
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+KEY_DTYPE = np.dtype("S16")
+
+
+def hash_texts(model_name, texts):
+    """16-byte BLAKE2b digest of (model name, text) for every text."""
+    prefix = model_name.encode() + b"\x00"
+    keys = np.empty(len(texts), dtype=KEY_DTYPE)
+    for i, text in enumerate(texts):
+        keys[i] = hashlib.blake2b(prefix + text.encode("utf-8"), digest_size=16).digest()
+    return keys
+
+
+class EmbeddingCache:
+    """
+    Persistent on-disk embedding cache keyed by hash(model name, text).
+
+    Vectors live in an append-only float32 file; index.npz holds the sorted keys,
+    the row of each key in the vector file and a last-used generation used for
+    size-bounded eviction. Lookups are one searchsorted over the sorted keys.
+    The index is only rewritten by flush(), after the vectors it references are
+    on disk, so a crash at worst loses the rows appended since the last flush;
+    opening the cache cuts the vector file back to the rows the index knows.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, "index.npz")
+        os.makedirs(cache_dir, exist_ok=True)
+
+        if os.path.exists(self.index_path):
+            with np.load(self.index_path, allow_pickle=False) as index:
+                self.keys = index["keys"]
+                self.rows = index["rows"]
+                self.last_used = index["last_used"]
+                meta = json.loads(str(index["meta"]))
+            self.dim = meta["dim"]
+            self.num_rows = meta["num_rows"]
+            self.generation = meta["generation"]
+            self.vectors_file = meta["vectors_file"]
+        else:
+            self.keys = np.empty(0, dtype=KEY_DTYPE)
+            self.rows = np.empty(0, dtype=np.int64)
+            self.last_used = np.empty(0, dtype=np.int64)
+            self.dim = None
+            self.num_rows = 0
+            self.generation = 0
+            self.vectors_file = "vectors.0.f32"
+        self._stale_file = None
+
+        # Drop rows appended after the last flush (or by a run that never flushed);
+        # the index does not know them, and new rows are numbered from num_rows
+        if os.path.exists(self._vectors_path()):
+            with open(self._vectors_path(), "r+b") as f:
+                f.truncate(self.num_rows * (self.dim or 0) * 4)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _vectors_path(self, name=None):
+        return os.path.join(self.cache_dir, name or self.vectors_file)
+
+    def _vectors(self):
+        if self.num_rows == 0:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        return np.memmap(self._vectors_path(), dtype=np.float32, mode="r", shape=(self.num_rows, self.dim))
+
+    def lookup(self, keys):
+        """
+        Returns (hit, rows): a boolean mask over keys and, for the hits, their rows
+        in the vector file. Hits are marked as used in the current generation.
+        """
+        self.generation += 1
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=bool), np.empty(0, dtype=np.int64)
+        pos = np.searchsorted(self.keys, keys)
+        pos_clipped = np.minimum(pos, len(self.keys) - 1)
+        hit = self.keys[pos_clipped] == keys
+        self.last_used[pos_clipped[hit]] = self.generation
+        return hit, self.rows[pos_clipped[hit]]
+
+    def read(self, rows, out=None):
+        vectors = self._vectors()
+        return vectors[rows] if out is None else np.take(vectors, rows, axis=0, out=out)
+
+    def put(self, keys, vectors):
+        """Appends the vectors of keys that are not cached yet."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.dim is None:
+            self.dim = int(vectors.shape[1])
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"Cache holds {self.dim}-dim vectors, got {vectors.shape[1]}-dim")
+
+        keys, first = np.unique(keys, return_index=True)
+        if len(self.keys):
+            pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+            new = self.keys[pos] != keys
+            keys, first = keys[new], first[new]
+        if len(keys) == 0:
+            return
+
+        with open(self._vectors_path(), "ab") as f:
+            vectors[first].tofile(f)
+        new_rows = np.arange(self.num_rows, self.num_rows + len(keys), dtype=np.int64)
+        self.num_rows += len(keys)
+
+        all_keys = np.concatenate([self.keys, keys])
+        order = np.argsort(all_keys, kind="stable")
+        self.keys = all_keys[order]
+        self.rows = np.concatenate([self.rows, new_rows])[order]
+        self.last_used = np.concatenate([self.last_used, np.full(len(keys), self.generation, dtype=np.int64)])[order]
+
+    def evict(self, max_bytes):
+        """
+        Keeps the most recently used vectors that fit in max_bytes and compacts them
+        into a new vector file, which the index switches to on the next flush().
+        """
+        row_bytes = 4 * (self.dim or 0)
+        if row_bytes == 0 or self.num_rows * row_bytes <= max_bytes:
+            return
+        keep_count = max_bytes // row_bytes
+        keep = np.sort(np.argsort(-self.last_used, kind="stable")[:keep_count])
+
+        new_file = f"vectors.{self.generation}.f32"
+        vectors = self._vectors()
+        with open(self._vectors_path(new_file), "wb") as f:
+            for start in range(0, len(keep), 65536):
+                vectors[self.rows[keep[start:start + 65536]]].tofile(f)
+        del vectors
+
+        self._stale_file = self.vectors_file
+        self.vectors_file = new_file
+        self.keys, self.last_used = self.keys[keep], self.last_used[keep]
+        self.rows = np.arange(len(keep), dtype=np.int64)
+        self.num_rows = len(keep)
+        print(f"Evicted cache down to {self.num_rows} vectors ({self.num_rows * row_bytes / 2**30:.2f} GiB)")
+
+    def flush(self):
+        meta = {"dim": self.dim, "num_rows": self.num_rows, "generation": self.generation,
+                "vectors_file": self.vectors_file}
+        tmp_path = self.index_path + ".tmp.npz"
+        np.savez(tmp_path, keys=self.keys, rows=self.rows, last_used=self.last_used, meta=np.array(json.dumps(meta)))
+        os.replace(tmp_path, self.index_path)
+
+        # The previous vector file is only removed once the index no longer points to it
+        if self._stale_file and os.path.exists(self._vectors_path(self._stale_file)):
+            os.remove(self._vectors_path(self._stale_file))
+        self._stale_file = None
@@ -1,19 +1,29 @@
-import faiss
+import argparse
 import os
+import shutil
+import tempfile
 import time
 import numpy as np
 from scipy.sparse import coo_matrix, csr_matrix, triu
 
+from vector_io import load_vectors
+
+MAX_WEIGHT = 1000
+# Width reserved for the edge count in the METIS header, which is only known
+# once the whole graph has been streamed out
+HEADER_EDGE_WIDTH = 20
+EDGE_DTYPE = np.dtype([('src', '<i4'), ('dst', '<i4'), ('w', '<i4')])
+
+
 def create_undirected_csr_from_faiss(distances, indices, num_nodes, k):
     """
     Converts FAISS kNN results into a weighted, undirected SciPy CSR matrix.
     (This function from the previous response is correct)
     """
     print("\n--- Step 1: Creating a Weighted, Undirected CSR Graph ---")
-    
+
     neighbor_indices = indices[:, 1:]
     neighbor_distances = distances[:, 1:]
-    MAX_WEIGHT = 1000
     max_dist = np.max(neighbor_distances)
     if max_dist == 0: max_dist = 1.0
     scaled_weights = MAX_WEIGHT * (1.0 - neighbor_distances / max_dist)
@@ -29,95 +39,266 @@ def create_undirected_csr_from_faiss(distances, indices, num_nodes, k):
     )
     undirected_graph = directed_graph.maximum(directed_graph.T)
     graph_csr = undirected_graph.tocsr()
-    
+
     print("CSR graph created successfully.")
     print(f" - Graph has {graph_csr.shape[0]} nodes.")
     print(f" - Graph has {graph_csr.nnz} non-zero entries before cleaning.")
-    
+
     return graph_csr
 
 
-def save_csr_to_metis_format_corrected(graph: csr_matrix, filename: str):
+def format_int_rows(tokens, row_lengths):
+    """
+    Formats non-negative integers as text lines without a Python loop per value:
+    row i holds the next row_lengths[i] tokens separated by spaces and ends with a
+    newline (rows of length 0 become empty lines). Returns a uint8 buffer.
+    """
+    tokens = np.asarray(tokens, dtype=np.int64)
+    row_lengths = np.asarray(row_lengths, dtype=np.int64)
+    num_rows = len(row_lengths)
+
+    ndigits = np.ones(len(tokens), dtype=np.int64)
+    power = 10
+    while len(tokens) and power <= tokens.max():
+        ndigits += tokens >= power
+        power *= 10
+
+    # Each token takes its digits plus one separator byte; an empty row takes one newline
+    token_row = np.repeat(np.arange(num_rows), row_lengths)
+    token_bytes = ndigits + 1
+    row_bytes = np.bincount(token_row, weights=token_bytes, minlength=num_rows).astype(np.int64)
+    row_bytes[row_lengths == 0] = 1
+    row_start = np.cumsum(row_bytes) - row_bytes
+    token_offset = np.cumsum(token_bytes) - token_bytes
+    first_token = np.cumsum(row_lengths) - row_lengths
+    token_start = row_start[token_row] + token_offset - token_offset[first_token[token_row]]
+
+    buf = np.full(int(row_bytes.sum()), ord('\n'), dtype=np.uint8)
+    not_last = np.ones(len(tokens), dtype=bool)
+    not_last[first_token[row_lengths > 0] + row_lengths[row_lengths > 0] - 1] = False
+    buf[(token_start + ndigits)[not_last]] = ord(' ')
+
+    remaining = tokens.copy()
+    for p in range(int(ndigits.max()) if len(tokens) else 0):
+        mask = ndigits > p
+        buf[token_start[mask] + ndigits[mask] - 1 - p] = ord('0') + remaining[mask] % 10
+        remaining //= 10
+    return buf
+
+
+def _write_metis_rows(f, neighbors, weights, row_lengths):
+    # METIS adjacency lines alternate 1-based neighbor ids and edge weights
+    tokens = np.empty(2 * len(neighbors), dtype=np.int64)
+    tokens[0::2] = neighbors + 1
+    tokens[1::2] = weights
+    f.write(memoryview(format_int_rows(tokens, 2 * row_lengths)))
+
+
+def save_csr_to_metis_format_corrected(graph: csr_matrix, output_path: str, block_rows: int = 65536):
     """
     Saves a weighted SciPy CSR matrix to the METIS graph file format.
-    
+
     This version includes crucial corrections:
     1. Removes self-loops.
     2. Uses a robust method to count the number of unique undirected edges.
     """
-    print(f"\n--- Step 2: Saving Graph to METIS Format at '{filename}' (Corrected) ---")
-    
+    print(f"\n--- Step 2: Saving Graph to METIS Format at '{output_path}' (Corrected) ---")
+
     # --- Bug Fix Start ---
 
     # 1. Explicitly remove self-loops (edges from a node to itself)
     graph.setdiag(0)
     graph.eliminate_zeros()
-    
+
     num_nodes = graph.shape[0]
 
     # 2. Get a robust count of unique edges.
     # The number of unique edges in an undirected graph is the number of non-zero
     # elements in its upper (or lower) triangle.
     num_edges = triu(graph, k=1).nnz
-    
+
     print(f"Graph cleaned: {graph.nnz} non-zero entries remain after removing self-loops.")
     print(f"Robust edge count for METIS header: {num_edges}")
 
     # --- Bug Fix End ---
 
-    file_path = os.path.join('../eval_data', filename)
-
-    with open(file_path, 'w') as f:
+    with open(output_path, 'wb', buffering=1 << 24) as f:
         # Write header: num_nodes, num_edges, format_code
         header = f"{num_nodes} {num_edges} 001\n"
-        f.write(header)
-        
-        for i in range(num_nodes):
-            start, end = graph.indptr[i], graph.indptr[i+1]
-            neighbors = graph.indices[start:end]
-            edge_weights = graph.data[start:end]
-            
-            # Add 1 to neighbor index for 1-based format
-            line_parts = [f"{neighbor + 1} {weight}" for neighbor, weight in zip(neighbors, edge_weights)]
-            f.write(" ".join(line_parts) + "\n")
-            
+        f.write(header.encode())
+
+        # Rows are formatted and written a block at a time
+        for start in range(0, num_nodes, block_rows):
+            end = min(start + block_rows, num_nodes)
+            lo, hi = graph.indptr[start], graph.indptr[end]
+            _write_metis_rows(f, graph.indices[lo:hi], graph.data[lo:hi], np.diff(graph.indptr[start:end + 1]))
+
     print("METIS file saved successfully.")
-    print(f" - To use, run: gpmetis {filename} <num_partitions>")
+    print(f" - To use, run: gpmetis {output_path} <num_partitions>")
 
 
-if __name__ == "__main__":
-    # --- FAISS Setup and Search ---
-    
-    # Parameters
-    num_embeddings = 10**6
-    embedding_dim = 384
-    k = 10
-    
-    print("--- Running FAISS kNN Search ---")
-    
-    # Generate random placeholder data
-	
-    embeddings = np.load('../eval_data/msmarco_doc_embeddings_1M_norm.npy') 
-    
+def _edge_weights(neighbor_distances, max_dist):
+    scaled_weights = MAX_WEIGHT * (1.0 - neighbor_distances / max_dist)
+    return np.maximum(1, scaled_weights.astype(int))
+
+
+def _directed_edges(distances, indices, start, end, max_dist):
+    # Same edge definition as create_undirected_csr_from_faiss: drop the first
+    # (self) neighbor, then any remaining self-loops and missing (-1) neighbors
+    neighbor_indices = np.asarray(indices[start:end, 1:], dtype=np.int64)
+    weights = _edge_weights(np.asarray(distances[start:end, 1:]), max_dist)
+    src = np.repeat(np.arange(start, end), neighbor_indices.shape[1])
+    dst = neighbor_indices.ravel()
+    w = weights.ravel()
+    keep = (dst >= 0) & (dst != src)
+    return src[keep], dst[keep], w[keep]
+
+
+def write_metis_streaming(distances, indices, output_path, chunk_size=65536, tmp_dir=None):
+    """
+    Builds the symmetrized (max-weight) kNN graph and writes it in METIS format
+    without materializing the full edge list.
+
+    Pass 1 streams the kNN rows and spills every reversed edge into an on-disk
+    bucket for the chunk of its new source node. Pass 2 loads, per node chunk, the
+    forward edges plus that chunk's bucket, sorts and deduplicates them (keeping
+    the larger weight of i->j and j->i) and appends the formatted lines. Peak
+    memory is proportional to one chunk of nodes.
+    """
+    num_nodes = indices.shape[0]
+
+    # The weight scale depends on the global maximum neighbor distance
+    max_dist = 0.0
+    for start in range(0, num_nodes, chunk_size):
+        max_dist = max(max_dist, float(np.max(distances[start:start + chunk_size, 1:])))
+    if max_dist == 0: max_dist = 1.0
+
+    work_dir = tempfile.mkdtemp(prefix="knn_buckets_", dir=tmp_dir)
+    num_chunks = (num_nodes + chunk_size - 1) // chunk_size
+    bucket_paths = [os.path.join(work_dir, f"bucket_{b}.bin") for b in range(num_chunks)]
+
+    try:
+        print("\n--- Pass 1: Spilling reversed edges into sorted buckets ---")
+        for start in range(0, num_nodes, chunk_size):
+            src, dst, w = _directed_edges(distances, indices, start, min(start + chunk_size, num_nodes), max_dist)
+            reversed_edges = np.empty(len(src), dtype=EDGE_DTYPE)
+            reversed_edges['src'], reversed_edges['dst'], reversed_edges['w'] = dst, src, w
+            reversed_edges = reversed_edges[np.argsort(reversed_edges['src'], kind='stable')]
+            bounds = np.searchsorted(reversed_edges['src'], np.arange(num_chunks + 1) * chunk_size)
+            for b in np.flatnonzero(np.diff(bounds)):
+                with open(bucket_paths[b], 'ab') as bf:
+                    reversed_edges[bounds[b]:bounds[b + 1]].tofile(bf)
+
+        print(f"--- Pass 2: Symmetrizing {num_chunks} chunks and writing METIS file to '{output_path}' ---")
+        num_entries = 0
+        with open(output_path, 'wb', buffering=1 << 24) as f:
+            f.write(f"{num_nodes} {0:>{HEADER_EDGE_WIDTH}} 001\n".encode())
+            for b, start in enumerate(range(0, num_nodes, chunk_size)):
+                end = min(start + chunk_size, num_nodes)
+                src, dst, w = _directed_edges(distances, indices, start, end, max_dist)
+                if os.path.exists(bucket_paths[b]):
+                    reversed_edges = np.fromfile(bucket_paths[b], dtype=EDGE_DTYPE)
+                    src = np.concatenate([src, reversed_edges['src']])
+                    dst = np.concatenate([dst, reversed_edges['dst']])
+                    w = np.concatenate([w, reversed_edges['w']])
+
+                # Sort by (src, dst, w) and keep the last, i.e. heaviest, copy of each edge
+                order = np.lexsort((w, dst, src))
+                src, dst, w = src[order], dst[order], w[order]
+                last = np.ones(len(src), dtype=bool)
+                last[:-1] = (src[1:] != src[:-1]) | (dst[1:] != dst[:-1])
+                src, dst, w = src[last], dst[last], w[last]
+
+                _write_metis_rows(f, dst, w, np.bincount(src - start, minlength=end - start))
+                num_entries += len(src)
+
+            # Every undirected edge appears once in each endpoint's adjacency list
+            num_edges = num_entries // 2
+            f.seek(0)
+            f.write(f"{num_nodes} {num_edges:>{HEADER_EDGE_WIDTH}} 001\n".encode())
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print("METIS file saved successfully.")
+    print(f" - Graph has {num_nodes} nodes and {num_edges} undirected edges.")
+    print(f" - To use, run: gpmetis {output_path} <num_partitions>")
+
+
+def knn_search(embeddings, k, device="gpu", gpu_id=1, chunk_size=65536, embeddings_path=None,
+               query_block_size=4096, num_workers=None, tmp_dir=None):
+    """
+    Returns the squared-L2 (distances, indices) of the k+1 nearest neighbors of
+    every embedding (the +1 is the point itself). The CPU search runs the
+    ground-truth process pool of compute_gnd_gpu over embeddings_path.
+    """
+    num_embeddings, embedding_dim = embeddings.shape
+    distances = np.empty((num_embeddings, k + 1), dtype=np.float32)
+    indices = np.empty((num_embeddings, k + 1), dtype=np.int64)
+
+    if device == "cpu":
+        from compute_gnd_gpu import search_cpu
+
+        if embeddings_path is None:
+            raise ValueError("The CPU search memory-maps the embeddings in its workers, embeddings_path is required")
+        work_dir = tempfile.mkdtemp(prefix="knn_search_", dir=tmp_dir)
+        try:
+            ids_path, scores_path = os.path.join(work_dir, "ids.npy"), os.path.join(work_dir, "scores.npy")
+            search_cpu(embeddings_path, embeddings_path, ids_path, k=k + 1, query_block_size=query_block_size,
+                       doc_block_size=chunk_size, num_workers=num_workers,
+                       checkpoint_dir=os.path.join(work_dir, "blocks"), output_scores_path=scores_path)
+            indices[:] = np.load(ids_path)
+            # Unit-norm embeddings: ||x - y||^2 = 2 - 2 x.y
+            distances[:] = np.maximum(0.0, 2.0 - 2.0 * np.load(scores_path))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return distances, indices
+
+    import faiss
+
     # Initialize FAISS GPU resources
     res = faiss.StandardGpuResources()
 
     # Create a flat L2 index on GPU
     index = faiss.IndexFlatL2(embedding_dim)  # L2 distance
-    gpu_index = faiss.index_cpu_to_gpu(res, 1, index)
-    gpu_index.add(embeddings)
+    gpu_index = faiss.index_cpu_to_gpu(res, gpu_id, index)
+    for start in range(0, num_embeddings, chunk_size):
+        gpu_index.add(np.ascontiguousarray(embeddings[start:start + chunk_size], dtype=np.float32))
+
+    for start in range(0, num_embeddings, chunk_size):
+        end = min(start + chunk_size, num_embeddings)
+        query = np.ascontiguousarray(embeddings[start:end], dtype=np.float32)
+        distances[start:end], indices[start:end] = gpu_index.search(query, k + 1)  # +1 to include self
+    return distances, indices
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a symmetric kNN graph of the document embeddings in METIS format.")
+    parser.add_argument('--input', default='../eval_data/msmarco_doc_embeddings_1M_norm.npy', help="Path to normalized document embeddings (.npy or .fbin)")
+    parser.add_argument('--output', default='../eval_data/knn_graph_for_metis.txt', help="Path of the METIS graph file to write")
+    parser.add_argument('--k', type=int, default=10, help="Number of neighbors per node")
+    parser.add_argument('--device', choices=['gpu', 'cpu'], default='gpu', help="Engine for the kNN search")
+    parser.add_argument('--gpu', type=int, default=1, help="GPU ID to use")
+    parser.add_argument('--chunk_size', type=int, default=65536, help="Number of nodes per search and symmetrization chunk")
+    parser.add_argument('--query_block_size', type=int, default=4096, help="CPU: nodes per search work unit")
+    parser.add_argument('--workers', type=int, default=None, help="CPU: number of search processes (default: all cores)")
+    parser.add_argument('--tmp_dir', default=None, help="Directory for the temporary search blocks and edge buckets (default: system temp dir)")
+    args = parser.parse_args()
+
+    # --- FAISS Setup and Search ---
+
+    print("--- Running kNN Search ---")
+
+    embeddings = load_vectors(args.input)
 
     # Run the kNN search
     print("Running kNN search...")
     start = time.time()
-    distances, indices = gpu_index.search(embeddings, k + 1)  # +1 to include self
+    distances, indices = knn_search(embeddings, args.k, device=args.device, gpu_id=args.gpu, chunk_size=args.chunk_size,
+                                    embeddings_path=args.input, query_block_size=args.query_block_size,
+                                    num_workers=args.workers, tmp_dir=args.tmp_dir)
     end = time.time()
-    print(f"Search completed in {end - start:.2f} seconds") 
+    print(f"Search completed in {end - start:.2f} seconds")
     # --- Main Workflow ---
-    
-    # 1. Convert FAISS output to CSR
-    graph_csr_weighted = create_undirected_csr_from_faiss(distances, indices, num_embeddings, k)
 
-    # 2. Save the CSR matrix using the CORRECTED function
-    metis_filename = "knn_graph_for_metis.txt"
-    save_csr_to_metis_format_corrected(graph_csr_weighted, metis_filename)
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    write_metis_streaming(distances, indices, args.output, chunk_size=args.chunk_size, tmp_dir=args.tmp_dir)
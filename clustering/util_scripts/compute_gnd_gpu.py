@@ -1,17 +1,215 @@
 import argparse
-import faiss
+import glob
+import json
 import numpy as np
 import os
+import shutil
+import time
+import multiprocessing as mp
+from contextlib import contextmanager
+
+from synthetic_data import merge_topk
+from vector_io import load_vectors
+
+BLAS_THREAD_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+
+
+def normalize_to_npy(src, output_path, max_rows=None, chunk_size=65536):
+    """
+    Writes the L2-normalized float32 rows of `src` to `output_path` chunk by chunk.
+    The file is written under a temporary name and renamed once complete, so an
+    existing output is always a finished one.
+    """
+    num_rows = src.shape[0] if not max_rows else min(max_rows, src.shape[0])
+    tmp_path = output_path + ".tmp.npy"
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(num_rows, src.shape[1]))
+    for start in range(0, num_rows, chunk_size):
+        end = min(start + chunk_size, num_rows)
+        chunk = np.asarray(src[start:end], dtype=np.float32)
+        out[start:end] = chunk / np.clip(np.linalg.norm(chunk, axis=1, keepdims=True), a_min=1e-10, a_max=None)
+    out.flush()
+    del out
+    os.replace(tmp_path, output_path)
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _read_manifest(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _write_manifest(path, manifest):
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def normalize_if_stale(src_path, output_path, max_rows=None):
+    """
+    Reuses output_path only if its manifest (<output_path>.manifest.json) says it
+    was normalized from the same, unchanged source with the same max_rows and
+    its shape is the expected one; otherwise (re)writes both.
+    """
+    src = load_vectors(src_path)
+    num_rows = src.shape[0] if not max_rows else min(max_rows, src.shape[0])
+    manifest = {"source": _file_signature(src_path), "source_shape": list(src.shape), "max_rows": max_rows,
+                "shape": [num_rows, src.shape[1]]}
+    manifest_path = output_path + ".manifest.json"
+    if os.path.exists(output_path) and _read_manifest(manifest_path) == manifest \
+            and list(load_vectors(output_path).shape) == manifest["shape"]:
+        print(f"Reusing {output_path}")
+        return
+    normalize_to_npy(src, output_path, max_rows=max_rows)
+    _write_manifest(manifest_path, manifest)
+
+
+def blocked_topk(queries, docs, k, doc_block_size=65536):
+    """
+    Exact inner-product top-k of every query against `docs`, computed one doc
+    block at a time so only a (num_queries, doc_block_size) score matrix is live.
+    For unit-norm vectors this is the same ranking as L2 distance.
+    Returns (scores, ids), both sorted best first.
+    """
+    num_queries, num_docs = queries.shape[0], docs.shape[0]
+    best_scores = np.full((num_queries, k), -np.inf, dtype=np.float32)
+    best_ids = np.full((num_queries, k), -1, dtype=np.int64)
+
+    for start in range(0, num_docs, doc_block_size):
+        end = min(start + doc_block_size, num_docs)
+        scores = queries @ np.asarray(docs[start:end], dtype=np.float32).T
+        kk = min(k, end - start)
+        top = np.argpartition(-scores, kk - 1, axis=1)[:, :kk]
+        best_scores, best_ids = merge_topk(best_scores, best_ids,
+                                           np.take_along_axis(scores, top, axis=1), top + start, k)
+
+    order = np.argsort(-best_scores, axis=1, kind="stable")
+    return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_ids, order, axis=1)
+
+
+def _block_path(checkpoint_dir, block_id, suffix=""):
+    return os.path.join(checkpoint_dir, f"block_{block_id:06d}{suffix}.npy")
+
+
+_worker_state = {}
+
+
+def _init_worker(doc_path, query_path):
+    _worker_state["docs"] = load_vectors(doc_path)
+    _worker_state["queries"] = load_vectors(query_path)
+
+
+def _search_query_block(task):
+    block_id, start, end, k, doc_block_size, checkpoint_dir, with_scores = task
+    queries = np.asarray(_worker_state["queries"][start:end], dtype=np.float32)
+    scores, ids = blocked_topk(queries, _worker_state["docs"], k, doc_block_size)
+
+    # Write then rename, so a killed run never leaves a truncated block behind;
+    # the ids go last, their file marks the block as done
+    outputs = [("_scores", scores)] if with_scores else []
+    for suffix, array in outputs + [("", ids)]:
+        tmp_path = _block_path(checkpoint_dir, block_id, suffix + ".tmp")
+        np.save(tmp_path, array)
+        os.replace(tmp_path, _block_path(checkpoint_dir, block_id, suffix))
+    return block_id
+
+
+@contextmanager
+def _blas_threads(num_threads):
+    # Worker processes are spawned, so they pick up the BLAS thread count from the
+    # environment at import time; this keeps workers * threads within the core count
+    saved = {var: os.environ.get(var) for var in BLAS_THREAD_VARS}
+    for var in BLAS_THREAD_VARS:
+        os.environ[var] = str(num_threads)
+    try:
+        yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def search_cpu(doc_path, query_path, output_gnd_path, k=10, query_block_size=4096, doc_block_size=65536,
+               num_workers=None, checkpoint_dir=None, keep_checkpoints=False, output_scores_path=None):
+    """
+    Exact ground truth on CPU: query blocks are spread over a process pool, each
+    worker streams over the memory-mapped docs, and finished blocks are saved to
+    `checkpoint_dir` so a rerun only computes the blocks that are missing.
+    With output_scores_path, the inner products of the top-k are saved as well.
+    """
+    num_queries = load_vectors(query_path).shape[0]
+    checkpoint_dir = checkpoint_dir or output_gnd_path + ".blocks"
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    with_scores = output_scores_path is not None
+
+    # Blocks are only reused for the same inputs, k and block boundaries
+    manifest = {"docs": _file_signature(doc_path), "queries": _file_signature(query_path),
+                "doc_shape": list(load_vectors(doc_path).shape), "query_shape": list(load_vectors(query_path).shape),
+                "k": k, "query_block_size": query_block_size}
+    manifest_path = os.path.join(checkpoint_dir, "manifest.json")
+    if _read_manifest(manifest_path) != manifest:
+        stale = glob.glob(os.path.join(checkpoint_dir, "block_*.npy"))
+        if stale:
+            print(f"Discarding {len(stale)} checkpoint files of different inputs or parameters in {checkpoint_dir}")
+        for path in stale:
+            os.remove(path)
+        _write_manifest(manifest_path, manifest)
+
+    tasks = []
+    for block_id, start in enumerate(range(0, num_queries, query_block_size)):
+        done = os.path.exists(_block_path(checkpoint_dir, block_id))
+        if with_scores:
+            done = done and os.path.exists(_block_path(checkpoint_dir, block_id, "_scores"))
+        if not done:
+            end = min(start + query_block_size, num_queries)
+            tasks.append((block_id, start, end, k, doc_block_size, checkpoint_dir, with_scores))
+    num_blocks = (num_queries + query_block_size - 1) // query_block_size
+    print(f"{num_blocks - len(tasks)}/{num_blocks} query blocks already done, computing {len(tasks)}")
+
+    num_workers = max(1, min(num_workers or os.cpu_count(), len(tasks) or 1))
+    threads_per_worker = max(1, os.cpu_count() // num_workers)
+    start_time = time.time()
+    if tasks:
+        with _blas_threads(threads_per_worker):
+            ctx = mp.get_context("spawn")
+            with ctx.Pool(num_workers, initializer=_init_worker, initargs=(doc_path, query_path)) as pool:
+                for done, _ in enumerate(pool.imap_unordered(_search_query_block, tasks), start=1):
+                    elapsed = time.time() - start_time
+                    print(f"Finished {done}/{len(tasks)} blocks ({elapsed:.1f}s elapsed)")
+
+    # Assemble the checkpointed blocks into the final ground-truth array
+    outputs = [("", output_gnd_path, np.int64)] + ([("_scores", output_scores_path, np.float32)] if with_scores else [])
+    for suffix, path, dtype in outputs:
+        out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(num_queries, k))
+        for block_id, start in enumerate(range(0, num_queries, query_block_size)):
+            block = np.load(_block_path(checkpoint_dir, block_id, suffix))
+            out[start:start + block.shape[0]] = block
+        out.flush()
+        del out
+
+    if not keep_checkpoints:
+        shutil.rmtree(checkpoint_dir)
+
+
+def main(doc_embeddings_path, query_embeddings_path, output_gnd_path,
+         output_doc_path, output_query_path, d=384, k=10, gpu_id=5, max_docs=1000000):
+    # faiss is only needed on GPU machines, so it is imported lazily
+    import faiss
 
-def main(doc_embeddings_path, query_embeddings_path, output_gnd_path, 
-         output_doc_path, output_query_path, d=384, k=10, gpu_id=5):
     # Load data
-    xb = np.load(doc_embeddings_path)
-    xq = np.load(query_embeddings_path)
-    
+    xb = load_vectors(doc_embeddings_path)
+    xq = np.array(load_vectors(query_embeddings_path), dtype=np.float32)
+
     # Downsample the documents to 1M vectors
 
-    xb = xb[:1000000]
+    xb = np.array(xb[:max_docs] if max_docs else xb, dtype=np.float32)
 
     # Normalize vectors
     xb /= np.linalg.norm(xb, axis=1, keepdims=True)
@@ -19,7 +217,7 @@ def main(doc_embeddings_path, query_embeddings_path, output_gnd_path,
 
     # Set up CPU index
     cpu_index = faiss.IndexFlatL2(d)
-    
+
     # Move to GPU
     gpu_res = faiss.StandardGpuResources()
     gpu_index = faiss.index_cpu_to_gpu(gpu_res, gpu_id, cpu_index)
@@ -35,32 +233,66 @@ def main(doc_embeddings_path, query_embeddings_path, output_gnd_path,
     np.save(output_doc_path, xb)
     np.save(output_query_path, xq)
 
+
+def main_cpu(doc_embeddings_path, query_embeddings_path, output_gnd_path, output_doc_path, output_query_path,
+             k=10, max_docs=1000000, query_block_size=4096, doc_block_size=65536, num_workers=None,
+             checkpoint_dir=None, keep_checkpoints=False):
+    # Normalized copies are written once and reused when resuming an interrupted run with the same inputs
+    normalize_if_stale(doc_embeddings_path, output_doc_path, max_rows=max_docs)
+    normalize_if_stale(query_embeddings_path, output_query_path)
+
+    search_cpu(output_doc_path, output_query_path, output_gnd_path, k=k, query_block_size=query_block_size,
+               doc_block_size=doc_block_size, num_workers=num_workers, checkpoint_dir=checkpoint_dir,
+               keep_checkpoints=keep_checkpoints)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="FAISS GPU Search with Normalized Embeddings")
-    parser.add_argument('--doc', type=str, required=True, help='Path to document embeddings (npy)')
-    parser.add_argument('--query', type=str, required=True, help='Path to query embeddings (npy)')
+    parser.add_argument('--doc', type=str, required=True, help='Path to document embeddings (.npy or .fbin)')
+    parser.add_argument('--query', type=str, required=True, help='Path to query embeddings (.npy or .fbin)')
     parser.add_argument('--output_gnd', type=str, required=True, help='Path to save index result (npy)')
     parser.add_argument('--output_doc', type=str, required=True, help='Path to save normalized document embeddings (npy)')
     parser.add_argument('--output_query', type=str, required=True, help='Path to save normalized query embeddings (npy)')
     parser.add_argument('--dimension', type=int, default=384, help='Dimension of embeddings')
     parser.add_argument('--k', type=int, default=10, help='Number of nearest neighbors to retrieve')
     parser.add_argument('--gpu', type=int, default=5, help='GPU ID to use')
+    parser.add_argument('--max_docs', type=int, default=1000000, help='Only use the first max_docs documents (0 for all)')
+    parser.add_argument('--device', choices=['gpu', 'cpu'], default='gpu', help='Search engine to use')
+    parser.add_argument('--query_block_size', type=int, default=4096, help='CPU: queries per work unit and checkpoint')
+    parser.add_argument('--doc_block_size', type=int, default=65536, help='CPU: documents per matrix product')
+    parser.add_argument('--workers', type=int, default=None, help='CPU: number of worker processes (default: all cores)')
+    parser.add_argument('--checkpoint_dir', type=str, default=None, help='CPU: directory for finished query blocks (default: <output_gnd>.blocks)')
+    parser.add_argument('--keep_checkpoints', action='store_true', help='CPU: keep the query blocks after assembling the output')
 
     args = parser.parse_args()
-    
-    xb = np.load(args.doc)
-    xq = np.load(args.query)
-    
-    os.makedirs('../eval_data', exist_ok=True)
-
-    main(
-        doc_embeddings_path=args.doc,
-        query_embeddings_path=args.query,
-        output_gnd_path=args.output_gnd,
-        output_doc_path=args.output_doc,
-        output_query_path=args.output_query,
-        d=args.dimension,
-        k=args.k,
-        gpu_id=args.gpu
-    )
 
+    for path in (args.output_gnd, args.output_doc, args.output_query):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    if args.device == 'cpu':
+        main_cpu(
+            doc_embeddings_path=args.doc,
+            query_embeddings_path=args.query,
+            output_gnd_path=args.output_gnd,
+            output_doc_path=args.output_doc,
+            output_query_path=args.output_query,
+            k=args.k,
+            max_docs=args.max_docs,
+            query_block_size=args.query_block_size,
+            doc_block_size=args.doc_block_size,
+            num_workers=args.workers,
+            checkpoint_dir=args.checkpoint_dir,
+            keep_checkpoints=args.keep_checkpoints
+        )
+    else:
+        main(
+            doc_embeddings_path=args.doc,
+            query_embeddings_path=args.query,
+            output_gnd_path=args.output_gnd,
+            output_doc_path=args.output_doc,
+            output_query_path=args.output_query,
+            d=args.dimension,
+            k=args.k,
+            gpu_id=args.gpu,
+            max_docs=args.max_docs
+        )
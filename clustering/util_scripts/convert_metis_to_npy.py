@@ -1,5 +1,11 @@
+import argparse
 import numpy as np
 
-# Replace 'your_file.txt' with the path to your txt file
-arr = np.loadtxt('../eval_data/knn_graph_for_metis.txt.part.1000', dtype=int)
-np.save('../eval_data/cluster_assignments', arr)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a gpmetis partition file into a cluster assignments .npy file.")
+    parser.add_argument('--input', default='../eval_data/knn_graph_for_metis.txt.part.1000', help="Path to the gpmetis .part.<n> output")
+    parser.add_argument('--output', default='../eval_data/cluster_assignments.npy', help="Path to save the cluster assignments (npy)")
+    args = parser.parse_args()
+
+    arr = np.loadtxt(args.input, dtype=int)
+    np.save(args.output, arr)
@@ -1,22 +1,274 @@
 import numpy as np
-import faiss
 import argparse
+import os
+import sys
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from compute_gnd_gpu import _blas_threads
+from vector_io import load_vectors
+
+
+def _normalize_rows(x):
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    return x / np.clip(norms, a_min=1e-10, a_max=None)
+
+
+def _read_chunk(doc_vectors, start, end, flag_spherical=True):
+    # Slicing a memory-mapped array only pages in this chunk; the float32 cast
+    # and normalization allocate a chunk-sized buffer, never an N-sized one.
+    chunk = np.asarray(doc_vectors[start:end], dtype=np.float32)
+    if flag_spherical:
+        chunk = _normalize_rows(chunk)
+    return chunk
+
+
+def assign_in_chunks(doc_vectors, centroids, chunk_size=65536, n_threads=None, flag_spherical=True):
+    """
+    Assigns every row of doc_vectors to its nearest centroid, reading the
+    (possibly memory-mapped) input one chunk at a time. Returns (N, 1) int64
+    assignments, the same shape faiss search returns.
+    """
+    num_docs = doc_vectors.shape[0]
+    centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+    # argmin ||x - c||^2 == argmax (x.c - ||c||^2 / 2), which is exact for
+    # centroids of any norm and reduces to the dot product for unit centroids
+    half_sq_norms = 0.5 * np.sum(centroids * centroids, axis=1)
+    assignments = np.empty((num_docs, 1), dtype=np.int64)
+
+    def assign(start):
+        end = min(start + chunk_size, num_docs)
+        chunk = _read_chunk(doc_vectors, start, end, flag_spherical)
+        scores = chunk @ centroids.T
+        scores -= half_sq_norms
+        assignments[start:end, 0] = np.argmax(scores, axis=1)
+
+    with ThreadPoolExecutor(max_workers=n_threads or os.cpu_count()) as pool:
+        list(pool.map(assign, range(0, num_docs, chunk_size)))
+
+    return assignments
+
+
+def minibatch_spherical_k_means(doc_vectors, n_clusters, batch_size=65536, max_epochs=20, tol=1e-4,
+                                patience=2, chunk_size=65536, n_threads=None, seed=0):
+    """
+    Out-of-core mini-batch spherical k-means (Sculley, 2010) for CPU-only machines.
+
+    doc_vectors may be a memory-mapped .npy; it is only ever read in contiguous
+    batches, so peak memory is O(batch_size * d + n_clusters * d) regardless of N.
+    An epoch visits every batch once in shuffled order. Training stops early once
+    the mean cosine similarity to the assigned centroid improves by less than `tol`
+    (relative) for `patience` consecutive epochs. The final assignment then
+    streams over all N documents in chunks.
+    """
+    rng = np.random.default_rng(seed)
+    num_docs, d = doc_vectors.shape
+    print(f"Embedding dimension: {d}, total docs: {num_docs}")
+
+    # Initialize centroids from distinct random documents (sorted for sequential mmap reads)
+    init_indices = np.sort(rng.choice(num_docs, n_clusters, replace=False))
+    centroids = _normalize_rows(np.asarray(doc_vectors[init_indices], dtype=np.float32))
+    counts = np.zeros(n_clusters, dtype=np.int64)
+
+    batch_starts = np.arange(0, num_docs, batch_size)
+    print(f"Training mini-batch spherical k-means with {n_clusters} clusters, "
+          f"{len(batch_starts)} batches of {batch_size} per epoch...")
+
+    best_objective = -np.inf
+    epochs_without_improvement = 0
+    for epoch in range(max_epochs):
+        start_time = time.time()
+        objective_sum = 0.0
+        hits = np.zeros(n_clusters, dtype=np.int64)
+
+        for start in rng.permutation(batch_starts):
+            batch = _read_chunk(doc_vectors, start, min(start + batch_size, num_docs))
+            scores = batch @ centroids.T
+            labels = np.argmax(scores, axis=1)
+            best_scores = scores[np.arange(len(labels)), labels]
+            objective_sum += float(best_scores.sum())
+
+            # Per-cluster batch sums via a single sort + reduceat instead of a Python loop
+            order = np.argsort(labels, kind="stable")
+            sorted_labels = labels[order]
+            present, first = np.unique(sorted_labels, return_index=True)
+            batch_sums = np.add.reduceat(batch[order], first, axis=0)
+            batch_counts = np.diff(np.append(first, len(labels)))
+
+            # Per-center learning rate 1 / count, then project back onto the sphere
+            counts[present] += batch_counts
+            hits[present] += batch_counts
+            centroids[present] += (batch_sums - batch_counts[:, None] * centroids[present]) / counts[present, None]
+            centroids[present] = _normalize_rows(centroids[present])
+
+        # Re-seed centroids that attracted no documents this epoch with the worst-fit
+        # documents of the last batch
+        dead = np.flatnonzero(hits == 0)
+        if len(dead) > 0:
+            worst = np.argsort(best_scores)[:len(dead)]
+            centroids[dead[:len(worst)]] = batch[worst]
+            counts[dead[:len(worst)]] = 0
+
+        objective = objective_sum / num_docs
+        improvement = (objective - best_objective) / abs(best_objective) if np.isfinite(best_objective) else np.inf
+        print(f"Epoch {epoch + 1}/{max_epochs} - mean cosine: {objective:.6f} - "
+              f"re-seeded: {len(dead)} - {time.time() - start_time:.2f}s")
+
+        if improvement < tol:
+            epochs_without_improvement += 1
+            if epochs_without_improvement >= patience:
+                print(f"Converged after {epoch + 1} epochs (relative improvement < {tol})")
+                break
+        else:
+            epochs_without_improvement = 0
+        best_objective = max(best_objective, objective)
+
+    print("K-means training completed.")
+
+    assignments = assign_in_chunks(doc_vectors, centroids, chunk_size=chunk_size, n_threads=n_threads)
+    return centroids, assignments
+
+
+def split_clusters(sizes, n_clusters):
+    """
+    Number of sub-clusters per coarse cluster, proportional to its size, at
+    least one per non-empty and at most one per document, summing to n_clusters.
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    if sizes.sum() < n_clusters or np.count_nonzero(sizes) > n_clusters:
+        raise ValueError(f"Cannot split {np.count_nonzero(sizes)} coarse clusters of {sizes.sum()} documents "
+                         f"into {n_clusters} clusters")
+    share = n_clusters * sizes / sizes.sum()
+    counts = np.clip(np.floor(share).astype(np.int64), np.minimum(sizes, 1), sizes)
+    # Move one cluster at a time between the coarse clusters furthest from their share
+    while counts.sum() != n_clusters:
+        if counts.sum() < n_clusters:
+            room = np.flatnonzero(counts < sizes)
+            counts[room[np.argmax((share - counts)[room])]] += 1
+        else:
+            room = np.flatnonzero(counts > 1)
+            counts[room[np.argmax((counts - share)[room])]] -= 1
+    return counts
+
+
+def assign_two_level(doc_vectors, coarse_centroids, centroids, parents, coarse_assignments=None, chunk_size=65536,
+                     n_threads=None):
+    """
+    Two-level nearest-centroid lookup: each document goes to its nearest coarse
+    centroid (unless coarse_assignments are given), then to the nearest of that
+    coarse cluster's sub-centroids. parents[c] is the coarse cluster of centroid c.
+    Costs N * (C_coarse + C / C_coarse) dot products instead of N * C.
+    """
+    num_docs = doc_vectors.shape[0]
+    order = np.argsort(parents, kind="stable")
+    group_starts = np.searchsorted(parents[order], np.arange(len(coarse_centroids) + 1))
+    assignments = np.empty((num_docs, 1), dtype=np.int64)
+
+    def assign(start):
+        end = min(start + chunk_size, num_docs)
+        chunk = _read_chunk(doc_vectors, start, end)
+        if coarse_assignments is None:
+            coarse = np.argmax(chunk @ coarse_centroids.T, axis=1)
+        else:
+            coarse = np.ravel(coarse_assignments[start:end])
+        for group in np.unique(coarse):
+            rows = np.flatnonzero(coarse == group)
+            members = order[group_starts[group]:group_starts[group + 1]]
+            assignments[start + rows, 0] = members[np.argmax(chunk[rows] @ centroids[members].T, axis=1)]
+
+    with ThreadPoolExecutor(max_workers=n_threads or os.cpu_count()) as pool:
+        list(pool.map(assign, range(0, num_docs, chunk_size)))
+    return assignments
+
+
+_worker_state = {}
+
+
+def _init_worker(input_path):
+    _worker_state["docs"] = load_vectors(input_path)
+    # Every sub-clustering prints its epochs; only the parent reports progress
+    sys.stdout = open(os.devnull, "w")
+
+
+def _sub_cluster(task):
+    coarse_id, doc_ids, n_sub, batch_size, max_epochs, tol, patience, seed = task
+    # doc_ids are sorted, so the gather walks the memory map front to back
+    docs = _normalize_rows(np.asarray(_worker_state["docs"][doc_ids], dtype=np.float32))
+    if n_sub == 1:
+        return coarse_id, _normalize_rows(docs.sum(axis=0, keepdims=True))
+    centroids, _ = minibatch_spherical_k_means(docs, n_sub, batch_size=batch_size, max_epochs=max_epochs, tol=tol,
+                                               patience=patience, n_threads=1, seed=seed)
+    return coarse_id, centroids
+
+
+def hierarchical_k_means(input_path, n_clusters, n_coarse=None, batch_size=65536, max_epochs=20, tol=1e-4,
+                         patience=2, chunk_size=65536, n_threads=None, n_workers=None, seed=0):
+    """
+    Two-level spherical k-means for corpora too large for flat assignment: a
+    mini-batch k-means into n_coarse clusters (default sqrt(n_clusters)), then
+    every coarse cluster is sub-clustered, in proportion to its size, by worker
+    processes that each read their documents from the memory-mapped input. The
+    final assignment is a two-level lookup. Returns (centroids, assignments,
+    coarse_centroids, parents) with flat centroid ids 0..n_clusters-1.
+    """
+    doc_vectors = load_vectors(input_path)
+    n_coarse = n_coarse or max(1, int(round(np.sqrt(n_clusters))))
+    print(f"Coarse level: {n_coarse} clusters")
+    coarse_centroids, coarse_assignments = minibatch_spherical_k_means(
+        doc_vectors, n_coarse, batch_size=batch_size, max_epochs=max_epochs, tol=tol, patience=patience,
+        chunk_size=chunk_size, n_threads=n_threads, seed=seed)
+
+    coarse_ids = np.ravel(coarse_assignments)
+    order = np.argsort(coarse_ids, kind="stable")
+    sizes = np.bincount(coarse_ids, minlength=n_coarse)
+    n_subs = split_clusters(sizes, n_clusters)
+    starts = np.r_[0, np.cumsum(sizes)]
+    print(f"Sub-clustering {np.count_nonzero(n_subs)} coarse clusters of {sizes.min()}-{sizes.max()} documents "
+          f"into {n_subs.min()}-{n_subs.max()} clusters each")
+
+    # Largest coarse clusters first, so no big one is left for last
+    tasks = [(j, order[starts[j]:starts[j + 1]], int(n_subs[j]), batch_size, max_epochs, tol, patience, seed + 1 + j)
+             for j in np.argsort(-sizes, kind="stable") if n_subs[j] > 0]
+    n_workers = max(1, min(n_workers or os.cpu_count(), len(tasks)))
+    sub_centroids = {}
+    start_time = time.time()
+    with _blas_threads(max(1, os.cpu_count() // n_workers)):
+        with ProcessPoolExecutor(n_workers, mp_context=mp.get_context("spawn"), initializer=_init_worker,
+                                 initargs=(input_path,)) as pool:
+            for done, (j, centroids) in enumerate(pool.map(_sub_cluster, tasks), start=1):
+                sub_centroids[j] = centroids
+                if done % max(1, len(tasks) // 10) == 0 or done == len(tasks):
+                    print(f"Sub-clustered {done}/{len(tasks)} coarse clusters ({time.time() - start_time:.1f}s elapsed)")
+
+    # Flat ids: the sub-clusters of coarse cluster 0 first, then those of 1, ...
+    kept = [j for j in range(n_coarse) if n_subs[j] > 0]
+    centroids = np.concatenate([sub_centroids[j] for j in kept]).astype(np.float32)
+    parents = np.repeat(np.arange(n_coarse), n_subs)
+    assignments = assign_two_level(doc_vectors, coarse_centroids, centroids, parents, coarse_assignments,
+                                   chunk_size=chunk_size, n_threads=n_threads)
+    return centroids, assignments, coarse_centroids, parents
+
+
+def k_means(doc_vectors, n_clusters, flag_spherical=False, gpu_device=0, sample_size=50000, niter=20,
+            chunk_size=65536):
+    # faiss is only needed on GPU machines, so it is imported lazily
+    import faiss
 
-def k_means(doc_vectors, n_clusters, flag_spherical=False, gpu_device=0, sample_size=50000):
     d = doc_vectors.shape[1]
     print(f"Embedding dimension: {d}, total docs: {doc_vectors.shape[0]}")
 
     # Sample a subset for training (optional but recommended for large datasets)
     train_sample = min(sample_size, doc_vectors.shape[0])
-    sample_indices = np.random.choice(doc_vectors.shape[0], train_sample, replace=False)
-    train_data = doc_vectors[sample_indices].astype(np.float32)
+    sample_indices = np.sort(np.random.choice(doc_vectors.shape[0], train_sample, replace=False))
+    train_data = np.ascontiguousarray(doc_vectors[sample_indices], dtype=np.float32)
 
     print(f"Training k-means on {train_data.shape[0]} samples with {n_clusters} clusters...")
 
     # Setup GPU resources
     res = faiss.StandardGpuResources()
     clustering = faiss.Clustering(d, n_clusters)
-    clustering.niter = 2
+    clustering.niter = niter
     clustering.max_points_per_centroid = 10000000  # helps with large datasets
 
     # Optional: Spherical (normalize vectors to unit norm before clustering)
@@ -32,43 +284,87 @@ def k_means(doc_vectors, n_clusters, flag_spherical=False, gpu_device=0, sample_
 
     print("K-means training completed.")
 
-    # Compute final assignments for all documents
-    full_data = doc_vectors.astype(np.float32)
-    if flag_spherical:
-        faiss.normalize_L2(full_data)
-
     # Use a GPU index to assign clusters
     index_assign = faiss.GpuIndexFlatL2(res, d, config)
     centroid_matrix = faiss.vector_to_array(clustering.centroids).reshape(n_clusters, d)
     index_assign.add(centroid_matrix)
-    distances, assignments = index_assign.search(full_data, 1)
+
+    # Compute final assignments for all documents chunk by chunk, so the full
+    # matrix is never cast or copied in host memory
+    assignments = np.empty((doc_vectors.shape[0], 1), dtype=np.int64)
+    for start in range(0, doc_vectors.shape[0], chunk_size):
+        end = min(start + chunk_size, doc_vectors.shape[0])
+        chunk = np.ascontiguousarray(doc_vectors[start:end], dtype=np.float32)
+        if flag_spherical:
+            faiss.normalize_L2(chunk)
+        _, assignments[start:end] = index_assign.search(chunk, 1)
     centroids_np = faiss.vector_to_array(clustering.centroids).reshape(n_clusters, -1)
     return centroids_np, assignments
 
 
-def main(input_path, n_clusters, gpu_device):
-    # Load vectors
-    doc_vectors = np.load(input_path)
-    n_clusters = 1000
-    centroids, cluster_assignments = k_means(doc_vectors, n_clusters, flag_spherical=True, gpu_device=1)
+def main(input_path, n_clusters, gpu_device, device="gpu", niter=20, sample_size=50000, batch_size=65536,
+         tol=1e-4, patience=2, chunk_size=65536, n_threads=None, seed=0, hierarchical=False, n_coarse=None,
+         n_workers=None, output_hierarchy=None):
+    if hierarchical:
+        centroids, cluster_assignments, coarse_centroids, parents = hierarchical_k_means(
+            input_path, n_clusters, n_coarse=n_coarse, batch_size=batch_size, max_epochs=niter, tol=tol,
+            patience=patience, chunk_size=chunk_size, n_threads=n_threads, n_workers=n_workers, seed=seed)
+        if output_hierarchy:
+            np.savez(output_hierarchy, coarse_centroids=coarse_centroids, parents=parents)
+            print(f"Saved the cluster hierarchy to {output_hierarchy}")
+        return centroids, cluster_assignments
+
+    # Memory-map the vectors; both engines read them chunk by chunk
+    doc_vectors = load_vectors(input_path)
+    if device == "cpu":
+        centroids, cluster_assignments = minibatch_spherical_k_means(
+            doc_vectors, n_clusters, batch_size=batch_size, max_epochs=niter, tol=tol, patience=patience,
+            chunk_size=chunk_size, n_threads=n_threads, seed=seed)
+    else:
+        centroids, cluster_assignments = k_means(doc_vectors, n_clusters, flag_spherical=True, gpu_device=gpu_device,
+                                                 sample_size=sample_size, niter=niter, chunk_size=chunk_size)
     return centroids, cluster_assignments
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="Run K-means clustering on document embeddings using FAISS.")
-    parser.add_argument('--input', type=str, required=True, help='Path to input normalized document embeddings (npy)')
+    parser = argparse.ArgumentParser(description="Run K-means clustering on document embeddings using FAISS (GPU) or mini-batch spherical k-means (CPU).")
+    parser.add_argument('--input', type=str, required=True, help='Path to input normalized document embeddings (.npy or .fbin)')
     parser.add_argument('--output_centroids', type=str, required=True, help='Path to save output centroids (npy)')
     parser.add_argument('--output_assignments', type=str, required=True, help='Path to save cluster assignments (npy)')
     parser.add_argument('--n_clusters', type=int, default=1000, help='Number of clusters to compute')
     parser.add_argument('--gpu', type=int, default=1, help='GPU ID to use for clustering')
+    parser.add_argument('--device', choices=['gpu', 'cpu'], default='gpu', help='Clustering engine to use')
+    parser.add_argument('--niter', type=int, default=20, help='GPU: k-means iterations on the sample; CPU: maximum number of epochs')
+    parser.add_argument('--sample_size', type=int, default=50000, help='GPU: number of documents sampled for training')
+    parser.add_argument('--batch_size', type=int, default=65536, help='CPU: mini-batch size')
+    parser.add_argument('--tol', type=float, default=1e-4, help='CPU: relative objective improvement below which an epoch counts as converged')
+    parser.add_argument('--patience', type=int, default=2, help='CPU: converged epochs in a row before stopping early')
+    parser.add_argument('--chunk_size', type=int, default=65536, help='Number of documents per chunk in the final assignment pass')
+    parser.add_argument('--threads', type=int, default=None, help='CPU: worker threads for the assignment pass (default: all cores)')
+    parser.add_argument('--seed', type=int, default=0, help='CPU: random seed for initialization and batch order')
+    parser.add_argument('--hierarchical', action='store_true', help='Two-level mini-batch k-means on CPU: coarse clusters, then sub-clusters in parallel (ignores --device)')
+    parser.add_argument('--n_coarse', type=int, default=None, help='Hierarchical: number of coarse clusters (default: sqrt(n_clusters))')
+    parser.add_argument('--workers', type=int, default=None, help='Hierarchical: worker processes for the sub-clustering (default: all cores)')
+    parser.add_argument('--output_hierarchy', type=str, default=None, help='Hierarchical: optional path to save the coarse centroids and each centroid\'s coarse parent (npz)')
 
     args = parser.parse_args()
 
-    centroids, cluster_assignments = main(input_path=args.input, 
-					  n_clusters=args.n_clusters,
-					  gpu_device=args.gpu)
+    centroids, cluster_assignments = main(input_path=args.input,
+                                          n_clusters=args.n_clusters,
+                                          gpu_device=args.gpu,
+                                          device=args.device,
+                                          niter=args.niter,
+                                          sample_size=args.sample_size,
+                                          batch_size=args.batch_size,
+                                          tol=args.tol,
+                                          patience=args.patience,
+                                          chunk_size=args.chunk_size,
+                                          n_threads=args.threads,
+                                          seed=args.seed,
+                                          hierarchical=args.hierarchical,
+                                          n_coarse=args.n_coarse,
+                                          n_workers=args.workers,
+                                          output_hierarchy=args.output_hierarchy)
 
     np.save(args.output_centroids, centroids)
     np.save(args.output_assignments, cluster_assignments)
-
-
@@ -0,0 +1,82 @@
+import numpy as np
+
+# Python mirror of how the Go server lays clusters out in the SimplePIR database
+# (search/database.PackClusters and BuildVectorDatabase): clusters are packed
+# first-fit-decreasing into columns of `hint_sz * 125` rows, each column is `dim`
+# values wide, and the database is (max column size) x (columns * dim).
+HINT_SZ = 900
+ROWS_PER_HINT = 125
+# Plaintext records are RECORD_LEN bits (recordLen in BuildVectorDatabase): inner
+# products are computed mod 2^RECORD_LEN and re-centered by utils.SmoothResult
+RECORD_LEN = 15
+
+
+def column_capacity(hint_sz=HINT_SZ):
+    return hint_sz * ROWS_PER_HINT
+
+
+def pack_clusters(sizes, max_capacity):
+    """
+    First-fit-decreasing packing of cluster sizes into columns, exactly as
+    PackClusters: a cluster goes into the first column where it fits strictly
+    below the capacity, which is raised to the largest cluster if needed.
+    Returns (columns, column_sizes): the cluster ids in each column, in packing
+    order, and the number of rows each column uses. Go's sort is not stable, so
+    clusters of equal size may land in different (equally sized) slots.
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    if len(sizes) == 0:
+        raise ValueError("No clusters given")
+    order = np.argsort(-sizes, kind="stable")
+    max_capacity = max(int(max_capacity), int(sizes[order[0]]))
+
+    columns = [[int(order[0])]]
+    column_sizes = np.zeros(len(sizes), dtype=np.int64)
+    column_sizes[0] = sizes[order[0]]
+    for cluster in order[1:]:
+        size = sizes[cluster]
+        fits = np.flatnonzero(column_sizes[:len(columns)] + size < max_capacity)
+        if len(fits):
+            column = fits[0]
+        else:
+            column = len(columns)
+            columns.append([])
+        columns[column].append(int(cluster))
+        column_sizes[column] += size
+    return columns, column_sizes[:len(columns)]
+
+
+def db_shape(sizes, dim, hint_sz=HINT_SZ):
+    """
+    The database shape BuildVectorDatabase ends up with for these cluster sizes:
+    l rows (the fullest column) by m = columns * dim, and how much of the l * m
+    values are padding.
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    columns, column_sizes = pack_clusters(sizes, column_capacity(hint_sz))
+    l = int(column_sizes.max())
+    m = len(columns) * dim
+    actual = int(sizes.sum()) * dim
+    return {
+        "l": l,
+        "m": m,
+        "num_columns": len(columns),
+        "db_size": l * m,
+        "actual_size": actual,
+        "padding": 1.0 - actual / (l * m),
+        "largest_cluster": int(sizes.max()),
+    }
+
+
+def inner_product_bits(dim, prec_bits):
+    """
+    Bits of the largest inner product of two vectors quantized to prec_bits,
+    sign bit included: QuantizeClamp keeps values within +-2^(prec_bits-1), so
+    |score| <= dim * 2^(2 * (prec_bits - 1)).
+    """
+    return float(np.log2(dim) + 2 * (prec_bits - 1) + 1)
+
+
+def scores_fit(dim, prec_bits, record_len=RECORD_LEN):
+    """Whether no inner product can wrap around, i.e. every |score| < 2^(record_len - 1)."""
+    return inner_product_bits(dim, prec_bits) < record_len
@@ -0,0 +1,182 @@
+import argparse
+import json
+import os
+import sys
+import time
+import multiprocessing as mp
+import numpy as np
+
+from compute_gnd_gpu import _blas_threads
+from pir_layout import RECORD_LEN, inner_product_bits, scores_fit
+from synthetic_data import merge_topk
+from vector_io import load_vectors
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "prepare_tiptoe_data"))
+from cluster_format import quantize_clamp
+
+# SimplePIR plaintext modulus of the server, see pir_layout.RECORD_LEN
+PLAINTEXT_MOD = 1 << RECORD_LEN
+
+
+def smooth_scores(inner_products, mod=PLAINTEXT_MOD):
+    """Vectorized utils.SmoothResult of inner products reduced mod `mod`."""
+    reduced = np.mod(inner_products, mod)
+    return np.where(reduced > mod // 2, reduced - mod, reduced)
+
+
+def record_bytes(dim, prec_bits):
+    """Bytes per document at prec_bits per value: int8 as stored, and bit-packed."""
+    return dim, dim * prec_bits / 8
+
+
+_worker_state = {}
+
+
+def _init_worker(doc_path, query_path, num_queries):
+    _worker_state["docs"] = load_vectors(doc_path)
+    queries = np.asarray(load_vectors(query_path)[:num_queries], dtype=np.float32)
+    _worker_state["queries"] = queries
+    _worker_state["quantized_queries"] = {}
+
+
+def _queries_at(prec_bits):
+    # Queries are quantized once per worker and precision
+    cache = _worker_state["quantized_queries"]
+    if prec_bits not in cache:
+        cache[prec_bits] = quantize_clamp(_worker_state["queries"], prec_bits).astype(np.float32)
+    return cache[prec_bits]
+
+
+def _search_doc_block(task):
+    """
+    Top-k of every query within one document block, with exact float scores
+    (prec_bits 0) or with the quantized, wrapped scores the server returns.
+    Also counts the inner products that wrapped around the plaintext modulus.
+    """
+    prec_bits, start, end, k, query_block_size = task
+    docs = np.asarray(_worker_state["docs"][start:end], dtype=np.float32)
+    if prec_bits:
+        # int8 products summed in float32 are exact: |score| < dim * 2^14 << 2^24
+        docs = quantize_clamp(docs, prec_bits).astype(np.float32)
+        queries = _queries_at(prec_bits)
+    else:
+        queries = _worker_state["queries"]
+
+    kk = min(k, end - start)
+    scores_out = np.empty((queries.shape[0], kk), dtype=np.float32)
+    ids_out = np.empty((queries.shape[0], kk), dtype=np.int64)
+    wrapped = 0
+    for q in range(0, queries.shape[0], query_block_size):
+        scores = queries[q:q + query_block_size] @ docs.T
+        if prec_bits:
+            inner_products = scores.astype(np.int64)
+            wrapped += int(np.count_nonzero(np.abs(inner_products) >= PLAINTEXT_MOD // 2))
+            scores = smooth_scores(inner_products).astype(np.float32)
+        top = np.argpartition(-scores, kk - 1, axis=1)[:, :kk]
+        scores_out[q:q + query_block_size] = np.take_along_axis(scores, top, axis=1)
+        ids_out[q:q + query_block_size] = top + start
+    return prec_bits, scores_out, ids_out, wrapped
+
+
+def sweep(doc_path, query_path, prec_bits_values, k=10, num_queries=None, doc_block_size=65536,
+          query_block_size=4096, num_workers=None):
+    """
+    Blocked exhaustive top-k of the queries over all documents, exactly (key 0)
+    and for every precBits value, spread over a process pool by (precBits, doc
+    block). Returns ({prec_bits: top-k ids sorted best first}, {prec_bits: wrapped inner products}).
+    """
+    num_docs = load_vectors(doc_path).shape[0]
+    num_queries = min(num_queries or np.inf, load_vectors(query_path).shape[0])
+    settings = [0] + list(prec_bits_values)
+    tasks = [(prec_bits, start, min(start + doc_block_size, num_docs), k, query_block_size)
+             for prec_bits in settings for start in range(0, num_docs, doc_block_size)]
+
+    best = {p: (np.full((num_queries, k), -np.inf, dtype=np.float32), np.full((num_queries, k), -1, dtype=np.int64))
+            for p in settings}
+    wrapped = dict.fromkeys(settings, 0)
+    num_workers = max(1, min(num_workers or os.cpu_count(), len(tasks)))
+    start_time = time.time()
+    with _blas_threads(max(1, os.cpu_count() // num_workers)):
+        ctx = mp.get_context("spawn")
+        with ctx.Pool(num_workers, initializer=_init_worker, initargs=(doc_path, query_path, num_queries)) as pool:
+            for done, (prec_bits, scores, ids, count) in enumerate(pool.imap_unordered(_search_doc_block, tasks), start=1):
+                best[prec_bits] = merge_topk(*best[prec_bits], scores, ids, k)
+                wrapped[prec_bits] += count
+                if done % max(1, len(tasks) // 10) == 0 or done == len(tasks):
+                    print(f"Finished {done}/{len(tasks)} blocks ({time.time() - start_time:.1f}s elapsed)")
+
+    topk = {}
+    for prec_bits, (scores, ids) in best.items():
+        order = np.argsort(-scores, axis=1, kind="stable")
+        topk[prec_bits] = np.take_along_axis(ids, order, axis=1)
+    return topk, wrapped
+
+
+def recall_at_k(result_ids, ground_truth, k):
+    """Mean fraction of each query's top-k ground truth found in its top-k results."""
+    results, truth = np.asarray(result_ids)[:, :k], np.asarray(ground_truth)[:, :k]
+    hits = ((results[:, :, None] == truth[:, None, :]).any(axis=2) & (results >= 0)).sum(axis=1)
+    return float(np.mean(hits)) / k
+
+
+def main(args):
+    topk, wrapped = sweep(args.doc_embeddings_path, args.query_embeddings_path, args.prec_bits, args.k,
+                          args.num_queries, args.doc_block_size, args.query_block_size, args.workers)
+    num_queries, dim = topk[0].shape[0], load_vectors(args.doc_embeddings_path).shape[1]
+    num_docs = load_vectors(args.doc_embeddings_path).shape[0]
+
+    # Recall against the given ground truth, or against the unquantized search
+    if args.ground_truth_path:
+        ground_truth = np.asarray(load_vectors(args.ground_truth_path)[:num_queries, :args.k])
+        reference = recall_at_k(topk[0], ground_truth, args.k)
+        print(f"Unquantized recall@{args.k}: {reference:.4f}")
+    else:
+        ground_truth, reference = topk[0], 1.0
+
+    rows = []
+    for prec_bits in args.prec_bits:
+        recall = recall_at_k(topk[prec_bits], ground_truth, args.k)
+        stored, packed = record_bytes(dim, prec_bits)
+        rows.append({"prec_bits": prec_bits, f"recall@{args.k}": recall, "recall_delta": recall - reference,
+                     "overlap_with_float": recall_at_k(topk[prec_bits], topk[0], args.k),
+                     "wrapped_fraction": wrapped[prec_bits] / (num_docs * num_queries),
+                     "inner_product_bits": inner_product_bits(dim, prec_bits),
+                     "scores_fit": scores_fit(dim, prec_bits),
+                     "record_bytes": stored, "packed_record_bytes": packed})
+
+    print(f"{'precBits':>8} {'recall':>8} {'delta':>8} {'overlap':>8} {'wrapped':>9} {'|ip| bits':>9} {'fits':>5} {'bytes/doc':>9} {'packed':>8}")
+    for row in rows:
+        print(f"{row['prec_bits']:>8} {row[f'recall@{args.k}']:>8.4f} {row['recall_delta']:>+8.4f} "
+              f"{row['overlap_with_float']:>8.4f} {row['wrapped_fraction']:>9.2e} {row['inner_product_bits']:>9.1f} {str(row['scores_fit']):>5} "
+              f"{row['record_bytes']:>9} {row['packed_record_bytes']:>8.1f}")
+
+    # Smallest precision within the recall budget whose scores never wrapped around
+    safe = [row for row in rows if row["recall_delta"] >= -args.max_recall_loss and row["wrapped_fraction"] == 0]
+    if safe:
+        print(f"Smallest safe precBits (recall loss <= {args.max_recall_loss}, no wraparound): "
+              f"{min(row['prec_bits'] for row in safe)}")
+    else:
+        print(f"No precBits value stays within a recall loss of {args.max_recall_loss} without wraparound")
+
+    if args.output_json:
+        with open(args.output_json, "w") as f:
+            json.dump({"k": args.k, "num_queries": int(num_queries), "reference_recall": reference, "results": rows}, f, indent=2)
+        print(f"Saved sweep results to {args.output_json}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the recall cost of the server's precBits quantization without running the PIR search.")
+    parser.add_argument('--doc_embeddings_path', required=True, help="Path to normalized document embeddings (.npy or .fbin)")
+    parser.add_argument('--query_embeddings_path', required=True, help="Path to normalized query embeddings (.npy or .fbin)")
+    parser.add_argument('--ground_truth_path', default=None, help="Optional doc-id ground truth (.npy/.ibin); default: the unquantized top-k")
+    parser.add_argument('--prec_bits', type=int, nargs='+', default=[3, 4, 5, 6, 7, 8], help="precBits values to sweep")
+    parser.add_argument('--k', type=int, default=10, help="Top-k depth of the recall")
+    parser.add_argument('--num_queries', type=int, default=None, help="Only use the first num_queries queries")
+    parser.add_argument('--max_recall_loss', type=float, default=0.01, help="Recall drop tolerated when picking the smallest precBits")
+    parser.add_argument('--doc_block_size', type=int, default=65536, help="Documents per work unit")
+    parser.add_argument('--query_block_size', type=int, default=4096, help="Queries per matrix product")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (default: all cores)")
+    parser.add_argument('--output_json', default=None, help="Optional path to save the sweep results")
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,216 @@
+import argparse
+import os
+import sys
+import numpy as np
+
+from pir_layout import HINT_SZ, column_capacity, db_shape
+from vector_io import load_vectors
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cluster_model"))
+from router import Router
+
+
+def cluster_centroids(doc_vectors, cluster_ids, num_clusters, chunk_size=65536):
+    """Normalized mean of every cluster's documents, accumulated one chunk at a time."""
+    sums = np.zeros((num_clusters, doc_vectors.shape[1]), dtype=np.float64)
+    for start in range(0, doc_vectors.shape[0], chunk_size):
+        ids = cluster_ids[start:start + chunk_size]
+        order = np.argsort(ids, kind="stable")
+        chunk = np.asarray(doc_vectors[start:start + chunk_size], dtype=np.float32)[order]
+        present, first = np.unique(ids[order], return_index=True)
+        sums[present] += np.add.reduceat(chunk, first, axis=0)
+    return (sums / np.clip(np.linalg.norm(sums, axis=1, keepdims=True), a_min=1e-10, a_max=None)).astype(np.float32)
+
+
+def score_moves(doc_vectors, cluster_ids, centroids, min_size, num_candidates=8, chunk_size=65536):
+    """
+    For every document of a cluster larger than min_size, its num_candidates
+    next-nearest clusters among the others (the smaller ones) and the score it
+    loses by moving there. Returns (doc_ids, targets, losses).
+    """
+    sizes = np.bincount(cluster_ids, minlength=centroids.shape[0])
+    oversized = sizes > min_size
+    docs = np.flatnonzero(oversized[cluster_ids])
+    num_candidates = min(num_candidates, int((~oversized).sum()))
+    if num_candidates == 0:
+        raise ValueError(f"Every cluster is larger than {min_size}, there is nowhere to move documents")
+
+    targets = np.empty((len(docs), num_candidates), dtype=np.int64)
+    losses = np.empty((len(docs), num_candidates), dtype=np.float32)
+    for start in range(0, len(docs), chunk_size):
+        block = docs[start:start + chunk_size]
+        scores = np.asarray(doc_vectors[block], dtype=np.float32) @ centroids.T
+        own = scores[np.arange(len(block)), cluster_ids[block]]
+        scores[:, oversized] = -np.inf
+        top = np.argpartition(-scores, num_candidates - 1, axis=1)[:, :num_candidates]
+        targets[start:start + len(block)] = top
+        losses[start:start + len(block)] = own[:, None] - np.take_along_axis(scores, top, axis=1)
+    return docs, targets, losses
+
+
+def _rank_within(groups):
+    """Position of every element among the elements of its group, in array order."""
+    order = np.argsort(groups, kind="stable")
+    sorted_groups = groups[order]
+    starts = np.r_[0, np.flatnonzero(sorted_groups[1:] != sorted_groups[:-1]) + 1]
+    ranks = np.empty(len(groups), dtype=np.int64)
+    ranks[order] = np.arange(len(groups)) - np.repeat(starts, np.diff(np.r_[starts, len(groups)]))
+    return ranks
+
+
+def rebalance(cluster_ids, moves, max_cluster_size, window=4096):
+    """
+    Shrinks every cluster above max_cluster_size by applying the cheapest of the
+    scored moves first: a document moves while its cluster is still too large and
+    the target has room. Returns (new_cluster_ids, moved_doc_ids, score_losses).
+
+    The moves are applied a window at a time: all of them up to the first one
+    that would overfill its target or shrink its source below the limit, which
+    is then checked again against the updated sizes.
+    """
+    docs, targets, losses = moves
+    cluster_ids = np.array(cluster_ids, dtype=np.int64)
+    sizes = np.bincount(cluster_ids, minlength=int(max(cluster_ids.max(), targets.max(initial=0))) + 1)
+
+    # Candidate moves of the documents of oversized clusters only, cheapest first
+    num_candidates = targets.shape[1]
+    rows = np.flatnonzero(sizes[cluster_ids[docs]] > max_cluster_size)
+    pairs = (rows[:, None] * num_candidates + np.arange(num_candidates)).ravel()
+    pairs = pairs[np.argsort(losses.ravel()[pairs], kind="stable")]
+    pair_rows, pair_cols = np.divmod(pairs, num_candidates)
+
+    moved = np.zeros(len(docs), dtype=bool)
+    moved_rows, moved_cols = [], []
+    start = 0
+    while start < len(pairs) and (sizes > max_cluster_size).any():
+        end = min(start + window, len(pairs))
+        block_rows, block_cols = pair_rows[start:end], pair_cols[start:end]
+        sources, dests = cluster_ids[docs[block_rows]], targets[block_rows, block_cols]
+        valid = np.flatnonzero(~moved[block_rows] & (sizes[sources] > max_cluster_size) & (sizes[dests] < max_cluster_size))
+        # Once a document's first valid move is applied its later ones are not
+        valid = np.sort(valid[np.unique(block_rows[valid], return_index=True)[1]])
+        fits = (_rank_within(sources[valid]) < sizes[sources[valid]] - max_cluster_size) & \
+               (_rank_within(dests[valid]) < max_cluster_size - sizes[dests[valid]])
+        if fits.all():
+            apply, start = valid, end
+            window *= 2
+        else:
+            # The first move valid on its own is always applied
+            barrier = int(np.argmin(fits))
+            apply, start = valid[:barrier], start + valid[barrier]
+            window = max(1024, window // 2)
+
+        cluster_ids[docs[block_rows[apply]]] = dests[apply]
+        sizes += np.bincount(dests[apply], minlength=len(sizes)) - np.bincount(sources[apply], minlength=len(sizes))
+        moved[block_rows[apply]] = True
+        moved_rows.append(block_rows[apply])
+        moved_cols.append(block_cols[apply])
+
+    moved_rows = np.concatenate(moved_rows) if moved_rows else np.empty(0, dtype=np.int64)
+    moved_cols = np.concatenate(moved_cols) if moved_cols else np.empty(0, dtype=np.int64)
+    return cluster_ids, docs[moved_rows].astype(np.int64), losses[moved_rows, moved_cols].astype(np.float32)
+
+
+def candidate_sizes(sizes, hint_sz, num_columns, slacks=(0.001, 0.005, 0.02)):
+    """
+    Cluster size limits worth trying: the column capacity, and for every column
+    count up to the current one, the even split of all documents over that many
+    columns plus a little slack for the packer. Only limits below the largest
+    cluster change anything.
+    """
+    total, largest = int(sizes.sum()), int(sizes.max())
+    limits = {column_capacity(hint_sz) - 1}
+    for k in range(1, num_columns + 1):
+        limits.update(int(np.ceil(total / k * (1 + slack))) for slack in slacks)
+    # There must be room for every document below the limit
+    return sorted(limit for limit in limits if total / len(sizes) < limit < largest)
+
+
+def cluster_recall(ground_truth, doc_cluster_ids, query_cluster_ids):
+    """Mean fraction of each query's ground-truth docs that lie in the cluster it is routed to."""
+    return float(np.mean(doc_cluster_ids[ground_truth] == query_cluster_ids[:, None]))
+
+
+def print_shape(label, shape):
+    print(f"{label:>7}: DB {shape['l']} x {shape['m']} = {shape['db_size']} values for {shape['actual_size']} "
+          f"({shape['padding'] * 100:.2f}% padding), {shape['num_columns']} columns, largest cluster {shape['largest_cluster']}")
+
+
+def main(args):
+    doc_vectors = load_vectors(args.doc_embeddings_path)
+    cluster_ids = np.ravel(np.load(args.cluster_assignments_path)).astype(np.int64)
+    num_clusters = int(cluster_ids.max()) + 1
+    dim = doc_vectors.shape[1]
+
+    if args.centroids_path:
+        centroids = np.load(args.centroids_path).astype(np.float32)
+        centroids /= np.clip(np.linalg.norm(centroids, axis=1, keepdims=True), a_min=1e-10, a_max=None)
+    else:
+        # Partitions without centroids (e.g. from METIS) use the normalized cluster means
+        centroids = cluster_centroids(doc_vectors, cluster_ids, num_clusters, args.chunk_size)
+
+    sizes = np.bincount(cluster_ids, minlength=num_clusters)
+    before = db_shape(sizes, dim, args.hint_sz)
+    print_shape("Before", before)
+
+    # Try each size limit (or the given one) and keep the one with the smallest database
+    limits = [args.max_cluster_size] if args.max_cluster_size else \
+        candidate_sizes(sizes, args.hint_sz, before["num_columns"])
+    best = (before["db_size"], 0, None, cluster_ids, np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32), before)
+    if limits:
+        moves = score_moves(doc_vectors, cluster_ids, centroids, min(limits), args.num_candidates, args.chunk_size)
+    for limit in limits:
+        new_ids, moved, losses = rebalance(cluster_ids, moves, limit)
+        shape = db_shape(np.bincount(new_ids, minlength=num_clusters), dim, args.hint_sz)
+        print(f"  limit {limit:>9}: DB {shape['l']} x {shape['m']} = {shape['db_size']} "
+              f"({shape['padding'] * 100:.2f}% padding), {len(moved)} documents moved")
+        if (shape["db_size"], len(moved)) < best[:2]:
+            best = (shape["db_size"], len(moved), limit, new_ids, moved, losses, shape)
+    _, _, limit, new_ids, moved, losses, after = best
+
+    if limit is None:
+        print("No size limit shrinks the database, keeping the clusters as they are")
+    else:
+        print(f"Using a size limit of {limit}")
+    print_shape("After", after)
+    print(f"Moved {len(moved)} documents ({len(moved) / len(new_ids) * 100:.2f}%), "
+          f"mean cosine loss {losses.mean() if len(losses) else 0.0:.4f}")
+    print(f"Server work (l * m) changes by {(after['db_size'] / before['db_size'] - 1) * 100:+.2f}%")
+
+    # Recall cost: queries are routed to the nearest centroid of the old and of the new clusters
+    new_centroids = cluster_centroids(doc_vectors, new_ids, num_clusters, args.chunk_size)
+    if args.ground_truth_path and args.query_vectors_path:
+        queries = load_vectors(args.query_vectors_path)
+        ground_truth = np.asarray(load_vectors(args.ground_truth_path)[:, :args.k])
+        queries = queries[:ground_truth.shape[0]]
+        old_routes = Router.from_centroids(centroids).route(queries)[0][:, 0]
+        new_routes = Router.from_centroids(new_centroids).route(queries)[0][:, 0]
+        recall_before = cluster_recall(ground_truth, cluster_ids, old_routes)
+        recall_after = cluster_recall(ground_truth, new_ids, new_routes)
+        print(f"Cluster recall@{args.k} (top-1 centroid routing): {recall_before:.4f} -> {recall_after:.4f} "
+              f"({recall_after - recall_before:+.4f})")
+
+    np.save(args.output_assignments, new_ids)
+    print(f"Saved rebalanced cluster assignments to {args.output_assignments}")
+    if args.output_centroids:
+        np.save(args.output_centroids, new_centroids)
+        print(f"Saved rebalanced centroids to {args.output_centroids}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move boundary documents out of oversized clusters so they pack tightly into the PIR database.")
+    parser.add_argument('--doc_embeddings_path', required=True, help="Path to normalized document embeddings (.npy or .fbin)")
+    parser.add_argument('--cluster_assignments_path', required=True, help="Path to cluster assignments .npy file")
+    parser.add_argument('--centroids_path', default=None, help="Path to centroids .npy file (default: normalized cluster means)")
+    parser.add_argument('--output_assignments', required=True, help="Path to save the rebalanced cluster assignments (npy)")
+    parser.add_argument('--output_centroids', default=None, help="Optional path to save the normalized means of the rebalanced clusters (npy)")
+    parser.add_argument('--hint_sz', type=int, default=HINT_SZ, help="Server hintSz; columns hold hint_sz * 125 rows")
+    parser.add_argument('--max_cluster_size', type=int, default=None, help="Largest allowed cluster (default: search for the limit giving the smallest database)")
+    parser.add_argument('--num_candidates', type=int, default=8, help="Next-nearest clusters considered per moved document")
+    parser.add_argument('--ground_truth_path', default=None, help="Optional doc-id ground truth (.npy/.ibin) to report the recall cost")
+    parser.add_argument('--query_vectors_path', default=None, help="Queries matching the ground truth rows, routed by nearest centroid")
+    parser.add_argument('--k', type=int, default=10, help="Ground-truth depth for the recall report")
+    parser.add_argument('--chunk_size', type=int, default=65536, help="Documents per matrix product")
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,43 @@
+import numpy as np
+
+# Building blocks shared by the synthetic-data and exact-search tools: the
+# Gaussian mixture on the unit sphere used by benchmark.py and pir_cost_model.py,
+# and the running top-k merge of the blocked ground-truth searches.
+
+
+def cluster_sizes(num_vectors, num_clusters, skew, rng):
+    """
+    Zipf-like cluster sizes, size ~ 1 / rank^skew (skew=0 gives equal sizes), in
+    random cluster order. Every cluster gets at least one vector and the sizes sum
+    to num_vectors exactly.
+    """
+    if num_vectors < num_clusters:
+        raise ValueError(f"Need at least one vector per cluster, got {num_vectors} vectors for {num_clusters} clusters")
+    weights = 1.0 / np.arange(1, num_clusters + 1) ** skew
+    weights = rng.permutation(weights / weights.sum())
+
+    # Largest-remainder rounding of the vectors left after the one-per-cluster minimum
+    share = weights * (num_vectors - num_clusters)
+    sizes = np.floor(share).astype(np.int64)
+    remainder = num_vectors - num_clusters - sizes.sum()
+    sizes[np.argsort(sizes - share, kind="stable")[:remainder]] += 1
+    return sizes + 1
+
+
+def sample_sphere(center, count, spread, rng):
+    """Unit vectors scattered around a unit center; larger spread gives wider clusters."""
+    dim = center.shape[0]
+    points = center + rng.standard_normal((count, dim), dtype=np.float32) * np.float32(spread / np.sqrt(dim))
+    points /= np.linalg.norm(points, axis=1, keepdims=True)
+    return points
+
+
+def merge_topk(best_scores, best_ids, scores, ids, k):
+    """
+    Merges a block of candidate (scores, ids) into the running per-query top-k.
+    Both inputs are (num_queries, *) arrays; the result is unsorted.
+    """
+    all_scores = np.concatenate([best_scores, scores], axis=1)
+    all_ids = np.concatenate([best_ids, ids], axis=1)
+    top = np.argpartition(-all_scores, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(all_scores, top, axis=1), np.take_along_axis(all_ids, top, axis=1)
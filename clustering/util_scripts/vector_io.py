@@ -0,0 +1,73 @@
+import os
+import numpy as np
+
+# Vector files read by the pipeline: NumPy .npy, and the big-ann-benchmarks
+# .fbin / .ibin / .u8bin layout used by the SIFT, GloVe and Deep downloads
+# (data/download_small_scale_datasets.py): a little-endian uint32 row count and
+# uint32 dimension, followed by the row-major values.
+BIN_DTYPES = {".fbin": np.dtype("<f4"), ".ibin": np.dtype("<i4"), ".u8bin": np.dtype("u1")}
+BIN_HEADER_SIZE = 8
+
+
+def _bin_dtype(path):
+    ext = os.path.splitext(path)[1]
+    if ext not in BIN_DTYPES:
+        raise ValueError(f"Unsupported vector file {path}: expected .npy or one of {sorted(BIN_DTYPES)}")
+    return BIN_DTYPES[ext]
+
+
+def read_bin_header(path):
+    with open(path, "rb") as f:
+        num_rows, dim = np.fromfile(f, dtype="<u4", count=2)
+    return int(num_rows), int(dim)
+
+
+def load_vectors(path, mode="r"):
+    """
+    Opens a .npy, .fbin, .ibin or .u8bin file as a zero-copy memory-mapped
+    (num_rows, dim) array.
+    """
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode=mode)
+    num_rows, dim = read_bin_header(path)
+    return np.memmap(path, dtype=_bin_dtype(path), mode=mode, offset=BIN_HEADER_SIZE, shape=(num_rows, dim))
+
+
+def save_vectors(path, vectors):
+    """Writes a whole (num_rows, dim) array as .npy or in the .fbin/.ibin/.u8bin layout."""
+    if path.endswith(".npy"):
+        np.save(path, vectors)
+        return
+    with BinWriter(path, vectors.shape[1], _bin_dtype(path)) as writer:
+        writer.write(vectors)
+
+
+class BinWriter:
+    """
+    Streams rows into a .fbin/.ibin/.u8bin file in bulk chunks when the row
+    count is not known up front; the header count is patched on close().
+    """
+
+    def __init__(self, path, dim, dtype=None):
+        self.path = path
+        self.dim = dim
+        self.dtype = np.dtype(dtype) if dtype is not None else _bin_dtype(path)
+        self.num_rows = 0
+        self.file = open(path, "wb")
+        np.array([0, dim], dtype="<u4").tofile(self.file)
+
+    def write(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype).reshape(-1, self.dim)
+        rows.tofile(self.file)
+        self.num_rows += rows.shape[0]
+
+    def close(self):
+        self.file.seek(0)
+        np.array([self.num_rows], dtype="<u4").tofile(self.file)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,53 +1,45 @@
+import os
+import sys
 import tensorflow as tf
-import struct
 import tensorflow_datasets as tfds
 import numpy as np
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "clustering", "util_scripts"))
+from vector_io import BinWriter
+
 tensorflow_name_of_dataset = { 'sift' : 'sift1m', 'glove' : 'glove100_angular', 'deep': 'deep1b'}
 
+BATCH_SIZE = 65536
+
+
+def normalize_rows(embeddings):
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
 def download_and_write_dataset(dataset_name, normalize=False):
     print("Downloading and writing " + dataset_name + " dataset")
     # Load the dataset using TensorFlow Datasets
     builder = tfds.builder(tensorflow_name_of_dataset[dataset_name])
     builder.download_and_prepare()
 
-    with open('data/' + dataset_name + '.fbin', 'wb') as f:
-        dataset = builder.as_dataset(split='database')
-        
-        f.write(len(dataset).to_bytes(4, byteorder='little', signed=False))
-        
-        dim = next(iter(dataset))['embedding'].shape[0]
-        f.write(dim.to_bytes(4, byteorder='little', signed=False))
-        
-        for sample in dataset:
-            embedding = sample['embedding'].numpy()
-            if normalize:
-                embedding = embedding / np.linalg.norm(embedding)
-            for value in embedding:
-                f.write(struct.pack('<f', value))
+    # Whole batches of embeddings are written at once; the row count is patched on close
+    dataset = builder.as_dataset(split='database', batch_size=BATCH_SIZE)
+    dim = next(iter(builder.as_dataset(split='database')))['embedding'].shape[0]
+    with BinWriter('data/' + dataset_name + '.fbin', dim, np.float32) as f:
+        for batch in tfds.as_numpy(dataset):
+            embeddings = batch['embedding']
+            f.write(normalize_rows(embeddings) if normalize else embeddings)
     print("Base set written")
 
-    with open('data/' +dataset_name + '.query.fbin', 'wb') as qf:
-        with open('data/' +dataset_name + '.ground-truth.fbin', 'wb') as gtf:
-            dataset = builder.as_dataset(split='test')
-            
-            qf.write(len(dataset).to_bytes(4, byteorder='little', signed=False))
-            gtf.write(len(dataset).to_bytes(4, byteorder='little', signed=False))
-            
-            dim = next(iter(dataset))['embedding'].shape[0]
-            K = next(iter(dataset))['neighbors']['index'].shape[0]
-            qf.write(dim.to_bytes(4, byteorder='little', signed=False))
-            gtf.write(K.to_bytes(4, byteorder='little', signed=False))
-            
-            for sample in dataset:
-                embedding = sample['embedding'].numpy()
-                if normalize:
-                    embedding = embedding / np.linalg.norm(embedding)
-                for value in embedding:
-                    qf.write(struct.pack('<f', value))
-                neighbor_indices = sample['neighbors']['index']
-                for i in neighbor_indices:
-                    gtf.write(int(i).to_bytes(4, byteorder='little', signed=False))
+    # The neighbor ids are integers, so the ground truth is an .ibin file
+    dataset = builder.as_dataset(split='test', batch_size=BATCH_SIZE)
+    K = next(iter(builder.as_dataset(split='test')))['neighbors']['index'].shape[0]
+    with BinWriter('data/' + dataset_name + '.query.fbin', dim, np.float32) as qf, \
+            BinWriter('data/' + dataset_name + '.ground-truth.ibin', K, np.int32) as gtf:
+        for batch in tfds.as_numpy(dataset):
+            embeddings = batch['embedding']
+            qf.write(normalize_rows(embeddings) if normalize else embeddings)
+            gtf.write(batch['neighbors']['index'])
     print("Queries and ground truth written")
 
 download_and_write_dataset('deep')
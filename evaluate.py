@@ -1,54 +1,144 @@
 import pandas as pd
+import numpy as np
 import argparse
+import io
+import json
+import os
+import sys
 
-def merge_columns(df, num_pairs=10):
-    return pd.DataFrame({
-        f'merged_{i}': list(zip(df.iloc[:, 2*i], df.iloc[:, 2*i + 1]))
-        for i in range(num_pairs)
-    })
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "clustering", "prepare_tiptoe_data"))
+from reverse_index import ReverseIndex
 
-def main(args):
-    # Load and merge evaluation results
-    df_eval = pd.read_csv(args.eval_path, header=None)
-    df_eval = merge_columns(df_eval)
-    eval_rows = df_eval.values.tolist()
 
-    # Load and merge ground truth
-    df_gt = pd.read_csv(args.ground_truth_path, header=None)
-    df_gt = merge_columns(df_gt)
-    gt_rows = df_gt.values.tolist()
+def pairs_to_keys(pairs):
+    """
+    Encodes (cluster_id, position) column pairs as one int64 key per result,
+    cluster_id << 32 | position. Missing or negative pairs become -1.
+    """
+    clusters, positions = pairs[:, 0::2], pairs[:, 1::2]
+    valid = (clusters >= 0) & (positions >= 0)
+    return np.where(valid, (clusters.astype(np.int64) << 32) | positions.astype(np.int64), -1)
+
+
+def load_result_keys(path):
+    """
+    Reads a results / ground-truth CSV of (cluster_id, position) pairs once and
+    returns a (num_rows, width) int64 key array. Rows may be ragged (the server
+    writes fewer pairs when a cluster has fewer than k vectors); the gaps are -1.
+    """
+    with open(path, "r") as f:
+        text = f.read()
+    num_fields = max((line.count(",") + 1 for line in text.splitlines() if line), default=0)
+    df = pd.read_csv(io.StringIO(text), header=None, names=range(num_fields))
+    pairs = df.fillna(-1).to_numpy(dtype=np.int64)
+    return pairs_to_keys(pairs)
+
+
+def load_ground_truth_keys(path, reverse_index_path=None, num_rows=None):
+    # Raw doc-id ground truth (.npy) is translated to (cluster_id, position)
+    # pairs through the reverse index
+    if not path.endswith(".npy"):
+        return load_result_keys(path)
+    if reverse_index_path is None:
+        raise ValueError("--reverse_index_path is required for .npy ground truth")
+    gt_doc_ids = np.load(path, mmap_mode="r")[:num_rows]
+    cluster_ids, positions = ReverseIndex.load(reverse_index_path).lookup(gt_doc_ids)
+    pairs = np.empty((gt_doc_ids.shape[0], 2 * gt_doc_ids.shape[1]), dtype=np.int64)
+    pairs[:, 0::2], pairs[:, 1::2] = cluster_ids, positions
+    return pairs_to_keys(pairs)
+
+
+def evaluate_keys(eval_keys, gt_keys, k, chunk_size=16384):
+    """
+    Mean recall@k, MRR@k and nDCG@k over all rows.
+
+    recall@k: fraction of the top-k ground truth found in the top-k results.
+    MRR@k: reciprocal rank of the top-1 ground-truth result within the top-k results.
+    nDCG@k: binary relevance (result is in the top-k ground truth).
+    """
+    if k > eval_keys.shape[1] or k > gt_keys.shape[1]:
+        raise ValueError(f"k={k} exceeds the result width ({eval_keys.shape[1]}) or ground-truth width ({gt_keys.shape[1]})")
+
+    discounts = 1.0 / np.log2(np.arange(2, k + 2))
+    ideal_cumsum = np.cumsum(discounts)
+    recall_sum = mrr_sum = ndcg_sum = 0.0
 
-    # Compute recall scores
-    recall_scores = [
-        len(set(eval_row) & set(gt_row)) / 10
-        for eval_row, gt_row in zip(eval_rows, gt_rows)
-    ]
+    # Rows are processed in chunks to bound the (rows, k, k) comparison tensor
+    for start in range(0, eval_keys.shape[0], chunk_size):
+        ev = eval_keys[start:start + chunk_size, :k]
+        gt = gt_keys[start:start + chunk_size, :k]
+        matches = (ev[:, :, None] == gt[:, None, :]) & (gt[:, None, :] >= 0)
 
-    # Print mean recall if desired (or return/save if needed)
-    print(f"Mean Recall@10: {sum(recall_scores)/len(recall_scores):.4f}")
+        # Each ground-truth item counts once, however often it is returned
+        recall_sum += float(matches.any(axis=1).sum(axis=1).sum()) / k
 
-    # Compute MRR
+        hit_top1 = matches[:, :, 0]
+        first_rank = np.argmax(hit_top1, axis=1)
+        mrr_sum += float(np.where(hit_top1.any(axis=1), 1.0 / (first_rank + 1), 0.0).sum())
 
-    mrr_scores = []
+        relevant = matches.any(axis=2)
+        dcg = relevant @ discounts
+        num_ideal = np.minimum((gt >= 0).sum(axis=1), k)
+        idcg = np.where(num_ideal > 0, ideal_cumsum[np.maximum(num_ideal - 1, 0)], 1.0)
+        ndcg_sum += float((dcg / idcg).sum())
 
-    for eval_row, gt_row in zip(eval_rows, gt_rows):
-        reciprocal_rank = 0.0
-        relevant = gt_row[0]
-        for rank, doc_id in enumerate(eval_row[:10]):  # top-10 only
-            if doc_id == relevant:
-                reciprocal_rank = 1.0 / (rank + 1)
-                break
+    num_rows = eval_keys.shape[0]
+    return {
+        "recall": recall_sum / num_rows,
+        "mrr": mrr_sum / num_rows,
+        "ndcg": ndcg_sum / num_rows,
+    }
 
-        mrr_scores.append(reciprocal_rank)
 
-    print(f"MRR@10: {sum(mrr_scores)/len(mrr_scores):.4f}")
+def parse_run(spec):
+    # Runs are given as PATH or LABEL=PATH
+    if "=" in spec:
+        label, path = spec.split("=", 1)
+        return label, path
+    return os.path.basename(spec), spec
+
+
+def main(args):
+    runs = [parse_run(spec) for spec in args.eval_path]
+
+    # Each result file is read exactly once
+    eval_keys = {label: load_result_keys(path) for label, path in runs}
+    max_rows = max(keys.shape[0] for keys in eval_keys.values())
+    gt_keys = load_ground_truth_keys(args.ground_truth_path, args.reverse_index_path, max_rows)
+
+    results = {}
+    for label, keys in eval_keys.items():
+        num_rows = min(keys.shape[0], gt_keys.shape[0])
+        if keys.shape[0] != gt_keys.shape[0]:
+            print(f"Warning: {label} has {keys.shape[0]} rows and the ground truth {gt_keys.shape[0]}; "
+                  f"evaluating the first {num_rows}")
+        results[label] = {}
+        for k in args.k:
+            if k > keys.shape[1] or k > gt_keys.shape[1]:
+                print(f"Skipping k={k} for {label}: only {keys.shape[1]} results per row")
+                continue
+            results[label][k] = evaluate_keys(keys[:num_rows], gt_keys[:num_rows], k)
+
+    # Print one row per (run, k) so runs can be compared side by side
+    label_width = max(len(label) for label in results)
+    print(f"{'run':<{label_width}}  {'k':>4}  {'recall':>8}  {'mrr':>8}  {'ndcg':>8}")
+    for label, by_k in results.items():
+        for k, metrics in by_k.items():
+            print(f"{label:<{label_width}}  {k:>4}  {metrics['recall']:>8.4f}  {metrics['mrr']:>8.4f}  {metrics['ndcg']:>8.4f}")
+
+    if args.output_json:
+        with open(args.output_json, "w") as f:
+            json.dump({label: {str(k): m for k, m in by_k.items()} for label, by_k in results.items()}, f, indent=2)
+        print(f"Saved metrics to {args.output_json}")
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Evaluate recall@10 from result and ground truth CSVs.")
+    parser = argparse.ArgumentParser(description="Evaluate recall@k, MRR@k and nDCG@k of one or more result CSVs against the ground truth.")
 
-    parser.add_argument('--eval_path', required=True, help="Path to evaluation results CSV")
-    parser.add_argument('--ground_truth_path', required=True, help="Path to ground truth CSV")
+    parser.add_argument('--eval_path', required=True, nargs='+', help="Path(s) to evaluation results CSV, optionally as LABEL=PATH")
+    parser.add_argument('--ground_truth_path', required=True, help="Path to ground truth CSV, or doc-id ground truth .npy")
+    parser.add_argument('--reverse_index_path', default=None, help="Path to reverse index .npz, needed for .npy ground truth")
+    parser.add_argument('--k', type=int, nargs='+', default=[10], help="Cutoff(s) to evaluate at (up to the result width)")
+    parser.add_argument('--output_json', default=None, help="Optional path to save the metrics as JSON")
 
     args = parser.parse_args()
     main(args)
-
@@ -127,10 +127,12 @@ func filesValidation(preamble string, query string) {
 	if _, err := os.Stat(queryFile); os.IsNotExist(err) {
 		panic("Error: query file does not exist: " + queryFile)
 	}
-	// check if prefix_cluster_0.csv is present
+	// check if prefix_cluster_0.bin or prefix_cluster_0.csv is present
 	clusterFile := preamble + "_cluster_0.csv"
-	if _, err := os.Stat(clusterFile); os.IsNotExist(err) {
-		panic("Error: cluster file does not exist: " + clusterFile)
+	if _, err := os.Stat(preamble + "_cluster_0.bin"); os.IsNotExist(err) {
+		if _, err := os.Stat(clusterFile); os.IsNotExist(err) {
+			panic("Error: cluster file does not exist: " + clusterFile)
+		}
 	}
 }
 
@@ -0,0 +1,105 @@
+import pandas as pd
+import numpy as np
+import argparse
+import json
+
+from evaluate import parse_run
+
+# Columns of the {preamble}_perf.csv files written by main.go, one row per query.
+# Times are in seconds, sizes in bytes. The hint phases are the offline part of
+# the protocol (they do not depend on the query and can be run ahead of time),
+# the rest is the online part.
+OFFLINE_TIME_COLUMNS = ["clientHintQueryTime", "serverHintAnswerTime", "clientHintApplyTime"]
+ONLINE_TIME_COLUMNS = ["clientQueryProcessingTime", "serverComputeTime", "clientReconTime"]
+OFFLINE_SIZE_COLUMNS = ["hintQuerySize", "hintAnsSize"]
+ONLINE_SIZE_COLUMNS = ["querySize", "ansSize"]
+TIME_COLUMNS = OFFLINE_TIME_COLUMNS + ONLINE_TIME_COLUMNS
+PERF_COLUMNS = TIME_COLUMNS + OFFLINE_SIZE_COLUMNS + ONLINE_SIZE_COLUMNS
+
+
+def load_perf(path, time_unit="auto"):
+    """
+    Loads a perf CSV with its times in seconds. Older runs wrote whole
+    milliseconds; with time_unit="auto", all-integer times are taken as such.
+    """
+    df = pd.read_csv(path)
+    missing = [column for column in PERF_COLUMNS if column not in df.columns]
+    if missing:
+        raise ValueError(f"{path} is not a perf CSV, missing columns {missing}")
+    df = df[PERF_COLUMNS].astype(np.float64)
+    if time_unit == "auto":
+        times = df[TIME_COLUMNS].to_numpy()
+        time_unit = "ms" if np.all(times == np.round(times)) and times.max() > 1 else "s"
+        if time_unit == "ms":
+            print(f"{path}: integer times, reading them as milliseconds")
+    if time_unit == "ms":
+        df[TIME_COLUMNS] /= 1e3
+    return df
+
+
+def summarize(df, percentiles=(50, 95, 99)):
+    """
+    Per-run summary: latency percentiles (ms) of every phase and of the offline,
+    online and total time per query, sequential queries per second, and the mean
+    offline / online communication per query.
+    """
+    times = df[TIME_COLUMNS].copy()
+    times["offline"] = df[OFFLINE_TIME_COLUMNS].sum(axis=1)
+    times["online"] = df[ONLINE_TIME_COLUMNS].sum(axis=1)
+    times["total"] = times["offline"] + times["online"]
+
+    summary = {"queries": len(df)}
+    quantiles = times.quantile(np.asarray(percentiles) / 100.0)
+    for column in times.columns:
+        for p, value in zip(percentiles, quantiles[column]):
+            summary[f"{column} p{p} (ms)"] = value * 1e3
+
+    # Queries are answered one after the other, so throughput is 1 / mean latency
+    with np.errstate(divide="ignore"):
+        summary["QPS (online)"] = len(df) / times["online"].sum()
+        summary["QPS (total)"] = len(df) / times["total"].sum()
+        summary["offline/online time"] = times["offline"].sum() / times["online"].sum()
+
+    offline_bytes = df[OFFLINE_SIZE_COLUMNS].sum(axis=1).mean()
+    online_bytes = df[ONLINE_SIZE_COLUMNS].sum(axis=1).mean()
+    for column in OFFLINE_SIZE_COLUMNS + ONLINE_SIZE_COLUMNS:
+        summary[f"{column} (KiB)"] = df[column].mean() / 1024
+    summary["offline comm (KiB)"] = offline_bytes / 1024
+    summary["online comm (KiB)"] = online_bytes / 1024
+    summary["offline comm share"] = offline_bytes / (offline_bytes + online_bytes)
+    return summary
+
+
+def main(args):
+    runs = [parse_run(spec) for spec in args.perf_path]
+    summaries = {label: summarize(load_perf(path, args.time_unit), tuple(args.percentiles)) for label, path in runs}
+
+    # One column per run, so configurations can be compared side by side
+    table = pd.DataFrame(summaries)
+    with pd.option_context("display.max_rows", None, "display.float_format", "{:,.4g}".format):
+        print(table.to_string())
+
+    if args.baseline:
+        if args.baseline not in summaries:
+            raise ValueError(f"--baseline {args.baseline} is not one of the runs {list(summaries)}")
+        ratios = table.div(table[args.baseline], axis=0).drop(columns=[args.baseline]).drop(index="queries")
+        print(f"\nRelative to {args.baseline}:")
+        with pd.option_context("display.max_rows", None, "display.float_format", "{:.3f}x".format):
+            print(ratios.to_string())
+
+    if args.output_json:
+        with open(args.output_json, "w") as f:
+            json.dump(summaries, f, indent=2)
+        print(f"Saved summary to {args.output_json}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize latency, throughput and communication of Tiptoe perf CSVs.")
+    parser.add_argument('--perf_path', required=True, nargs='+', help="Path(s) to {preamble}_perf.csv files, optionally as LABEL=PATH")
+    parser.add_argument('--percentiles', type=int, nargs='+', default=[50, 95, 99], help="Latency percentiles to report")
+    parser.add_argument('--time_unit', choices=['auto', 's', 'ms'], default='auto', help="Unit of the time columns (auto: integers are milliseconds)")
+    parser.add_argument('--baseline', default=None, help="Label of the run the others are compared against")
+    parser.add_argument('--output_json', default=None, help="Optional path to save the summaries as JSON")
+
+    args = parser.parse_args()
+    main(args)
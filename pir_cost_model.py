@@ -0,0 +1,226 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from evaluate import parse_run
+from perf_analysis import PERF_COLUMNS, load_perf
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "clustering", "util_scripts"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "clustering", "prepare_tiptoe_data"))
+from pir_layout import HINT_SZ, RECORD_LEN, db_shape, inner_product_bits, scores_fit
+from cluster_format import read_header
+from synthetic_data import cluster_sizes
+
+# SimplePIR parameters fixed in BuildVectorDatabase: 64-bit elements and
+# RECORD_LEN-bit plaintext records, so precBits can be at most RECORD_LEN.
+LOG_Q = 64
+ELEM_BYTES = LOG_Q // 8
+LWE_N = 2048
+
+# The quantity of the database shape each perf column is expected to grow with:
+# the online query is one element per DB column (m) and the answer one per row
+# (l), the server multiplies the l x m database by the query, and the hint
+# (l x lwe_n) is what the offline phase works on.
+PERF_FEATURES = {
+    "clientHintQueryTime": "const",
+    "serverHintAnswerTime": "hint",
+    "clientHintApplyTime": "l",
+    "clientQueryProcessingTime": "m",
+    "serverComputeTime": "lm",
+    "clientReconTime": "l",
+    "hintQuerySize": "const",
+    "hintAnsSize": "l",
+    "querySize": "m",
+    "ansSize": "l",
+}
+
+
+def shape_features(shape, lwe_n=LWE_N):
+    return {"const": 1.0, "l": shape["l"], "m": shape["m"], "lm": shape["db_size"], "hint": shape["l"] * lwe_n}
+
+
+def default_model():
+    """
+    Uncalibrated (intercept, slope) per perf column: query and answer sizes from
+    the matrix dimensions alone, i.e. lower bounds of one raw 8-byte element per
+    entry (the serialized messages measure larger), hint sizes and times unknown.
+    """
+    model = {column: (np.nan, np.nan) for column in PERF_COLUMNS}
+    model["querySize"] = (0.0, ELEM_BYTES)
+    model["ansSize"] = (0.0, ELEM_BYTES)
+    return model
+
+
+def preamble_sizes(preamble):
+    """Cluster sizes of an exported dataset, from the binary headers or CSV line counts."""
+    with open(f"{preamble}_metadata.json", "r") as f:
+        metadata = json.load(f)
+    sizes = np.zeros(metadata["num_clusters"], dtype=np.int64)
+    for i in range(len(sizes)):
+        if os.path.exists(f"{preamble}_cluster_{i}.bin"):
+            sizes[i] = read_header(f"{preamble}_cluster_{i}.bin")[1]
+        else:
+            with open(f"{preamble}_cluster_{i}.csv", "rb") as f:
+                sizes[i] = sum(1 for line in f if line.strip())
+    return sizes, metadata["dim"]
+
+
+def calibrate(runs, hint_sz=HINT_SZ, lwe_n=LWE_N):
+    """
+    Least-squares fit of every perf column against its shape feature over all
+    queries of all runs, given as (perf_path, preamble) pairs. With a single
+    database shape only the slope (through the origin) can be fitted.
+    """
+    xs, ys = {column: [] for column in PERF_COLUMNS}, {column: [] for column in PERF_COLUMNS}
+    for perf_path, preamble in runs:
+        sizes, dim = preamble_sizes(preamble)
+        features = shape_features(db_shape(sizes, dim, hint_sz), lwe_n)
+        df = load_perf(perf_path)
+        for column in PERF_COLUMNS:
+            xs[column].append(np.full(len(df), features[PERF_FEATURES[column]], dtype=np.float64))
+            ys[column].append(df[column].to_numpy())
+
+    model = {}
+    for column in PERF_COLUMNS:
+        x, y = np.concatenate(xs[column]), np.concatenate(ys[column])
+        if PERF_FEATURES[column] == "const":
+            model[column] = (float(y.mean()), 0.0)
+        elif len(np.unique(x)) > 1:
+            intercept, slope = np.linalg.lstsq(np.stack([np.ones_like(x), x], axis=1), y, rcond=None)[0]
+            model[column] = (float(intercept), float(slope))
+        else:
+            model[column] = (0.0, float(y.mean() / x[0]))
+        fit = model[column][0] + model[column][1] * x
+        print(f"{column:>26} ~ {model[column][0]:.4g} + {model[column][1]:.4g} * {PERF_FEATURES[column]}"
+              f"  (mean abs error {np.mean(np.abs(fit - y)) / max(np.mean(np.abs(y)), 1e-30) * 100:.1f}%)")
+    return model
+
+
+def predict(config, model, lwe_n=LWE_N):
+    """Database shape and per-query costs of one configuration."""
+    sizes, dim, hint_sz, prec_bits = config["sizes"], config["dim"], config["hint_sz"], config["prec_bits"]
+    shape = db_shape(sizes, dim, hint_sz)
+    features = shape_features(shape, lwe_n)
+    row = {key: value for key, value in config.items() if key != "sizes"}
+    row.update({"n_clusters": len(sizes), "l": shape["l"], "m": shape["m"], "columns": shape["num_columns"],
+                "padding": shape["padding"]})
+    for column in PERF_COLUMNS:
+        intercept, slope = model[column]
+        row[column] = intercept + slope * features[PERF_FEATURES[column]]
+    # Offline communication per query, NaN unless the model is calibrated
+    row["hint_bytes"] = row["hintQuerySize"] + row["hintAnsSize"]
+    row["online_bytes"] = row["querySize"] + row["ansSize"]
+    row["server_compute"] = shape["db_size"]
+    # The server rejects plaintext spaces below 2^precBits; larger inner
+    # products wrap around mod 2^RECORD_LEN
+    row["valid"] = prec_bits <= RECORD_LEN
+    row["inner_product_bits"] = inner_product_bits(dim, prec_bits)
+    row["scores_fit"] = scores_fit(dim, prec_bits)
+    return row
+
+
+def pareto_front(df, objectives):
+    """Marks the rows no other row beats on every objective (all minimized)."""
+    values = df[objectives].to_numpy(dtype=np.float64)
+    dominated = np.zeros(len(df), dtype=bool)
+    for i in range(len(df)):
+        better_or_equal = np.all(values <= values[i], axis=1)
+        strictly_better = np.any(values < values[i], axis=1)
+        dominated[i] = np.any(better_or_equal & strictly_better)
+    return ~dominated
+
+
+def _predict_one(job):
+    config, model, lwe_n = job
+    return predict(config, model, lwe_n)
+
+
+def main(args):
+    if args.calibration:
+        model = calibrate(args.calibration, args.calibration_hint_sz, args.lwe_n)
+        if args.save_model:
+            with open(args.save_model, "w") as f:
+                json.dump(model, f, indent=2)
+            print(f"Saved calibrated model to {args.save_model}")
+    elif args.model:
+        with open(args.model, "r") as f:
+            model = {column: tuple(coefficients) for column, coefficients in json.load(f).items()}
+    else:
+        model = default_model()
+        print("No calibration given, predicting lower bounds of the online message sizes only; "
+              "server compute is relative (l * m)")
+
+    # The hint size is only known from measured runs
+    hint_calibrated = all(np.isfinite(model[column]).all() for column in ("hintQuerySize", "hintAnsSize"))
+    objectives = args.objectives or ["online_bytes", "server_compute"] + (["hint_bytes"] if hint_calibrated else [])
+    if "hint_bytes" in objectives and not hint_calibrated:
+        raise ValueError("hint_bytes needs a calibrated model (--calibration or --model)")
+
+    # One clustering per assignments file or exported dataset, or simulated sizes per n_clusters
+    clusterings = []
+    for label, path in map(parse_run, args.assignments or []):
+        if path.endswith(".npy"):
+            clusterings.append((label, np.bincount(np.ravel(np.load(path)).astype(np.int64)), args.dim))
+        else:
+            clusterings.append((label, *preamble_sizes(path)))
+    rng = np.random.default_rng(args.seed)
+    for n_clusters in args.n_clusters or []:
+        clusterings.append((f"skew{args.skew:g}", cluster_sizes(args.num_vectors, n_clusters, args.skew, rng), args.dim))
+    if not clusterings:
+        raise ValueError("Give --assignments and/or --n_clusters (with --num_vectors) to sweep over")
+
+    configs = [{"mode": label, "sizes": sizes, "dim": dim, "hint_sz": hint_sz, "prec_bits": prec_bits}
+               for (label, sizes, dim), hint_sz, prec_bits in itertools.product(clusterings, args.hint_sz, args.prec_bits)]
+    print(f"Predicting {len(configs)} configurations")
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        rows = list(executor.map(_predict_one, [(config, model, args.lwe_n) for config in configs], chunksize=4))
+
+    df = pd.DataFrame(rows)
+    df = df[df["valid"]].drop(columns=["valid"])
+    df["server_compute"] /= df["server_compute"].min()
+    df["pareto"] = pareto_front(df, objectives)
+    df = df.sort_values(["pareto"] + objectives, ascending=[False] + [True] * len(objectives))
+
+    columns = ["mode", "n_clusters", "hint_sz", "prec_bits", "l", "m", "columns", "padding", "hint_bytes",
+               "querySize", "ansSize", "online_bytes", "server_compute", "serverComputeTime", "serverHintAnswerTime",
+               "inner_product_bits", "scores_fit", "pareto"]
+    table = df[columns] if args.all else df[df["pareto"]][columns]
+    with pd.option_context("display.max_rows", None, "display.width", 250, "display.float_format", "{:,.4g}".format):
+        print(table.to_string(index=False))
+    print(f"{int(df['pareto'].sum())} of {len(df)} configurations are Pareto-optimal on {objectives}")
+
+    if args.output_csv:
+        df.to_csv(args.output_csv, index=False)
+        print(f"Saved predictions to {args.output_csv}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Predict the PIR database shape and per-query costs of clustering configurations without running the server.")
+    parser.add_argument('--assignments', nargs='+', default=None, help="Cluster assignments .npy or exported preambles, optionally as LABEL=PATH")
+    parser.add_argument('--n_clusters', type=int, nargs='+', default=None, help="Also sweep simulated Zipf cluster sizes for these cluster counts")
+    parser.add_argument('--num_vectors', type=int, default=1000000, help="Documents of the simulated clusterings")
+    parser.add_argument('--skew', type=float, default=0.5, help="Zipf exponent of the simulated cluster sizes")
+    parser.add_argument('--dim', type=int, default=384, help="Embedding dimension for .npy assignments and simulated sizes")
+    parser.add_argument('--hint_sz', type=int, nargs='+', default=[HINT_SZ], help="Server hintSz values to sweep")
+    parser.add_argument('--prec_bits', type=int, nargs='+', default=[5], help="precBits values to sweep")
+    parser.add_argument('--lwe_n', type=int, default=LWE_N, help="LWE secret dimension, for the hint size")
+    parser.add_argument('--calibration', nargs=2, action='append', metavar=('PERF_CSV', 'PREAMBLE'), default=None,
+                        help="Measured perf CSV and the preamble it was run on; repeat for more runs")
+    parser.add_argument('--calibration_hint_sz', type=int, default=HINT_SZ, help="hintSz the calibration runs used")
+    parser.add_argument('--save_model', default=None, help="Path to save the calibrated coefficients (json)")
+    parser.add_argument('--model', default=None, help="Previously saved coefficients to use instead of calibrating")
+    parser.add_argument('--objectives', nargs='+', default=None,
+                        help="Columns minimized by the Pareto front (default: online_bytes, server_compute and, when calibrated, hint_bytes)")
+    parser.add_argument('--all', action='store_true', help="Print every configuration, not only the Pareto front")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: all cores)")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed of the simulated cluster sizes")
+    parser.add_argument('--output_csv', default=None, help="Optional path to save all predictions")
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,199 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from perf_analysis import load_perf, summarize
+from pir_cost_model import LWE_N, preamble_sizes
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "clustering", "util_scripts"))
+from pir_layout import HINT_SZ, db_shape
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def available_memory_bytes():
+    """MemAvailable from /proc/meminfo, or the physical memory where that is missing."""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def estimate_process_memory(preamble, hint_sz=HINT_SZ):
+    """
+    Rough peak memory of one main.go process: every process builds the whole
+    database, i.e. the l x m uint64 values twice (the value slice and the PIR
+    matrix) and the l x lwe_n hint, plus the int8 cluster vectors.
+    """
+    sizes, dim = preamble_sizes(preamble)
+    shape = db_shape(sizes, dim, hint_sz)
+    return 2 * shape["db_size"] * 8 + shape["l"] * LWE_N * 8 + shape["actual_size"]
+
+
+def split_queries(query_path, shard_prefix, num_shards):
+    """
+    Splits the query CSV into contiguous shards <shard_prefix>_NNNN.csv, so
+    concatenating the shard outputs in shard order gives the original query
+    order. Returns the shard paths and their query counts.
+    """
+    with open(query_path, "r") as f:
+        num_queries = sum(1 for line in f if line.strip())
+    num_shards = max(1, min(num_shards, num_queries))
+    per_shard = -(-num_queries // num_shards)
+
+    paths, counts = [], []
+    with open(query_path, "r") as f:
+        lines = (line for line in f if line.strip())
+        for shard in range(num_shards):
+            path = f"{shard_prefix}_{shard:04d}.csv"
+            chunk = "".join(line for _, line in zip(range(per_shard), lines))
+            if not chunk:
+                break
+            # An unchanged shard keeps its file (and age), so its earlier outputs still count
+            if os.path.exists(path):
+                with open(path, "r") as existing:
+                    unchanged = existing.read() == chunk
+            if not os.path.exists(path) or not unchanged:
+                with open(path, "w") as out:
+                    out.write(chunk)
+            paths.append(path)
+            counts.append(chunk.count("\n"))
+    return paths, counts
+
+
+def output_paths(query_path, cluster_only):
+    # main.go names its outputs after the -query file
+    stem = query_path[:-len(".csv")]
+    if cluster_only:
+        return stem + "_results_cluster_only.csv", stem + "_perf_cluster_only.csv"
+    return stem + "_results.csv", stem + "_perf.csv"
+
+
+def is_done(shard, count, cluster_only):
+    # Complete results written after the shard itself
+    results = output_paths(shard, cluster_only)[0]
+    if not os.path.exists(results) or os.path.getmtime(results) < os.path.getmtime(shard):
+        return False
+    with open(results, "r") as f:
+        return sum(1 for line in f if line.strip()) == count
+
+
+def build_binary(output_path):
+    # Built once, so the processes do not each compile through `go run`
+    print(f"Building the search binary {output_path}")
+    subprocess.run(["go", "build", "-o", output_path, "."], cwd=REPO_DIR, check=True)
+    return output_path
+
+
+def run_shards(binary, shards, counts, args, log_dir, num_workers, threads_per_worker):
+    """
+    Runs one search process per shard, at most num_workers at a time. Shards whose
+    results are already complete (from an interrupted run) are skipped.
+    """
+    env = dict(os.environ, GOMAXPROCS=str(threads_per_worker))
+    pending = [(path, count) for path, count in zip(shards, counts) if not is_done(path, count, args.cluster_only)]
+    print(f"{len(shards) - len(pending)}/{len(shards)} shards already done, running {len(pending)} "
+          f"with {num_workers} processes of {threads_per_worker} threads")
+
+    running, failed = [], []
+    while pending or running:
+        while pending and len(running) < num_workers:
+            path, count = pending.pop(0)
+            argv = [binary, f"-preamble={args.preamble}", f"-query={path}", f"-topk={args.topk}", f"-precBits={args.prec_bits}"]
+            if args.cluster_only:
+                argv.append("-clusterOnly")
+            log = open(os.path.join(log_dir, os.path.basename(path)[:-len(".csv")] + ".log"), "w")
+            running.append((subprocess.Popen(argv, cwd=REPO_DIR, stdout=log, stderr=subprocess.STDOUT, env=env), path, log))
+        time.sleep(0.2)
+        for proc, path, log in list(running):
+            if proc.poll() is None:
+                continue
+            running.remove((proc, path, log))
+            log.close()
+            if proc.returncode != 0:
+                failed.append(path)
+                print(f"{os.path.basename(path)} failed with exit code {proc.returncode}, see {log.name}")
+            else:
+                print(f"{os.path.basename(path)} done ({len(shards) - len(pending) - len(running)}/{len(shards)} finished or failed)")
+    return failed
+
+
+def merge_outputs(shards, cluster_only, results_path, perf_path):
+    """Concatenates the shard results and perf files in shard (= query) order, with one perf header."""
+    with open(results_path, "w") as results, open(perf_path, "w") as perf:
+        for i, shard in enumerate(shards):
+            shard_results, shard_perf = output_paths(shard, cluster_only)
+            with open(shard_results, "r") as f:
+                results.writelines(f)
+            with open(shard_perf, "r") as f:
+                header = f.readline()
+                if i == 0:
+                    perf.write(header)
+                perf.writelines(f)
+
+
+def main(args):
+    # The processes run from the repository, so every path is made absolute first
+    args.preamble = os.path.abspath(args.preamble)
+    query_path = os.path.abspath(args.query or f"{args.preamble}_query.csv")
+    results_path, perf_path = output_paths(query_path, args.cluster_only)
+    # main.go only accepts a -query in the preamble's directory, so the shards go there;
+    # the logs (and the built binary) go to the shard directory
+    shard_prefix = os.path.join(os.path.dirname(args.preamble), os.path.basename(query_path)[:-len(".csv")] + "_shard")
+    shard_dir = os.path.abspath(args.shard_dir or query_path[:-len(".csv")] + "_shards")
+    os.makedirs(shard_dir, exist_ok=True)
+
+    # As many processes as the cores and the memory (each holds the whole database) allow
+    cores = os.cpu_count()
+    memory = available_memory_bytes()
+    per_process = args.memory_per_process_gb * 2**30 if args.memory_per_process_gb else estimate_process_memory(args.preamble)
+    num_workers = args.workers or max(1, min(cores // (args.threads_per_worker or 1), int(memory // per_process)))
+    threads_per_worker = args.threads_per_worker or max(1, cores // num_workers)
+    print(f"{cores} cores, {memory / 2**30:.1f} GiB available, ~{per_process / 2**30:.2f} GiB per process "
+          f"-> {num_workers} parallel processes")
+
+    shards, counts = split_queries(query_path, shard_prefix, args.shards or num_workers)
+    print(f"Split {sum(counts)} queries from {query_path} into {len(shards)} shards {shard_prefix}_*.csv")
+    binary = os.path.abspath(args.go_binary) if args.go_binary else build_binary(os.path.join(shard_dir, "tiptoe_search"))
+
+    start = time.time()
+    failed = run_shards(binary, shards, counts, args, shard_dir, min(num_workers, len(shards)), threads_per_worker)
+    wall = time.time() - start
+    if failed:
+        print(f"{len(failed)} shards failed, not merging; rerun to retry only those")
+        return False
+
+    merge_outputs(shards, args.cluster_only, results_path, perf_path)
+    print(f"Merged results into {results_path} and perf statistics into {perf_path}")
+
+    # The per-query times add up to what a single serial run would have taken (without its setup)
+    summary = summarize(load_perf(perf_path))
+    serial = summary["queries"] / summary["QPS (total)"]
+    print(f"{summary['queries']} queries in {wall:.1f}s wall: {summary['queries'] / wall:.2f} queries/s "
+          f"(serial per-query time {serial:.1f}s, {serial / wall:.2f}x)")
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the Tiptoe search on shards of a query file in parallel and merge the outputs.")
+    parser.add_argument('--preamble', required=True, help="Dataset preamble, as for main.go")
+    parser.add_argument('--query', default=None, help="Query CSV (default: <preamble>_query.csv); merged outputs are named after it like main.go's")
+    parser.add_argument('--topk', type=int, default=10, help="main.go -topk")
+    parser.add_argument('--prec_bits', type=int, default=5, help="main.go -precBits")
+    parser.add_argument('--cluster_only', action='store_true', help="main.go -clusterOnly")
+    parser.add_argument('--workers', type=int, default=None, help="Parallel processes (default: as many as cores and memory allow)")
+    parser.add_argument('--threads_per_worker', type=int, default=None, help="GOMAXPROCS of each process (default: the cores split evenly)")
+    parser.add_argument('--memory_per_process_gb', type=float, default=None, help="Memory of one process (default: estimated from the database shape)")
+    parser.add_argument('--shards', type=int, default=None, help="Number of shards (default: one per process; every shard rebuilds the database)")
+    parser.add_argument('--shard_dir', default=None, help="Directory for the shard logs and the built binary (default: <query>_shards); "
+                        "the shard queries and outputs go next to the preamble, as main.go requires")
+    parser.add_argument('--go_binary', default=None, help="Prebuilt search binary (default: go build into the shard directory)")
+
+    args = parser.parse_args()
+    sys.exit(0 if main(args) else 1)
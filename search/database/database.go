@@ -1,6 +1,7 @@
 package database
 
 import (
+	"encoding/binary"
 	"encoding/csv"
 	"encoding/json"
 	"fmt"
@@ -9,6 +10,8 @@ import (
 	"path/filepath"
 	"sort"
 	"strconv"
+	"syscall"
+	"unsafe"
 
 	"github.com/DeweiFeng/6.5610-project/search/utils"
 	"github.com/henrycg/simplepir/lwe"
@@ -82,6 +85,124 @@ func ReadClusterFromCsv(file string, index uint64, dim uint64, precBits uint64)
 	}
 }
 
+// Binary cluster files hold vectors that are already quantized: a 32-byte header
+// (magic "TTCL", uint32 version, uint64 dim, uint64 count, uint64 precBits, all
+// little endian) followed by count*dim int8 values, one vector after another.
+const (
+	clusterBinMagic      = "TTCL"
+	clusterBinVersion    = 1
+	clusterBinHeaderSize = 32
+)
+
+// ReadClusterFromBin memory-maps a binary cluster file. The returned vectors
+// alias the read-only mapping, which stays alive for the rest of the process.
+func ReadClusterFromBin(file string, index uint64, dim uint64) *Cluster {
+	f, err := os.Open(file)
+	if err != nil {
+		fmt.Println(err)
+		panic("Error opening file " + file)
+	}
+	defer f.Close()
+
+	info, err := f.Stat()
+	if err != nil {
+		panic("Error reading size of file " + file)
+	}
+	size := info.Size()
+	if size < clusterBinHeaderSize {
+		panic("Error reading binary cluster file " + file + " -- file too short")
+	}
+
+	data, err := syscall.Mmap(int(f.Fd()), 0, int(size), syscall.PROT_READ, syscall.MAP_SHARED)
+	if err != nil {
+		fmt.Println(err)
+		panic("Error memory-mapping file " + file)
+	}
+
+	if string(data[0:4]) != clusterBinMagic {
+		panic("Error reading binary cluster file " + file + " -- bad magic")
+	}
+	if binary.LittleEndian.Uint32(data[4:8]) != clusterBinVersion {
+		panic("Error reading binary cluster file " + file + " -- unsupported version")
+	}
+	fileDim := binary.LittleEndian.Uint64(data[8:16])
+	numVec := binary.LittleEndian.Uint64(data[16:24])
+	precBits := binary.LittleEndian.Uint64(data[24:32])
+
+	if fileDim != dim {
+		panic("Dimension mismatch in " + file)
+	}
+	if uint64(size) != clusterBinHeaderSize+numVec*dim {
+		panic("Error reading binary cluster file " + file + " -- length of vectors does not match")
+	}
+
+	vectors := []int8{}
+	if numVec > 0 {
+		vectors = unsafe.Slice((*int8)(unsafe.Pointer(&data[clusterBinHeaderSize])), numVec*dim)
+	}
+
+	return &Cluster{
+		Index:      index,
+		NumVectors: numVec,
+		Dim:        dim,
+		PrecBits:   precBits,
+		Vectors:    vectors,
+	}
+}
+
+// WriteClusterToBin saves an already quantized cluster in the binary cluster format
+func WriteClusterToBin(file string, cluster *Cluster) {
+	f, err := os.Create(file)
+	if err != nil {
+		fmt.Println(err)
+		panic("Error creating file " + file)
+	}
+	defer f.Close()
+
+	header := make([]byte, clusterBinHeaderSize)
+	copy(header[0:4], clusterBinMagic)
+	binary.LittleEndian.PutUint32(header[4:8], clusterBinVersion)
+	binary.LittleEndian.PutUint64(header[8:16], cluster.Dim)
+	binary.LittleEndian.PutUint64(header[16:24], cluster.NumVectors)
+	binary.LittleEndian.PutUint64(header[24:32], cluster.PrecBits)
+
+	body := make([]byte, len(cluster.Vectors))
+	for i, v := range cluster.Vectors {
+		body[i] = byte(v)
+	}
+
+	if _, err := f.Write(header); err != nil {
+		panic("Error writing file " + file)
+	}
+	if _, err := f.Write(body); err != nil {
+		panic("Error writing file " + file)
+	}
+}
+
+// ReadCluster loads cluster i of a dataset, preferring the binary file and
+// falling back to the CSV file when there is no binary file (or it was
+// quantized with a different precBits and a CSV file is available). A binary
+// file of a different precBits without a CSV file is an error, since its
+// scores would not match the queries' scale
+func ReadCluster(dir string, prefix string, i uint64, dim uint64, precBits uint64) *Cluster {
+	binFile := filepath.Join(dir, fmt.Sprintf("%s_cluster_%d.bin", prefix, i))
+	csvFile := filepath.Join(dir, fmt.Sprintf("%s_cluster_%d.csv", prefix, i))
+
+	if _, err := os.Stat(binFile); err == nil {
+		cluster := ReadClusterFromBin(binFile, i, dim)
+		if cluster.PrecBits == precBits {
+			return cluster
+		}
+		if _, err := os.Stat(csvFile); err != nil {
+			panic(fmt.Sprintf("Error: %s was quantized with %d bits, run with -precBits=%d or re-export it with --prec_bits %d",
+				binFile, cluster.PrecBits, cluster.PrecBits, precBits))
+		}
+		fmt.Printf("%s was quantized with %d bits, reading %s instead\n", binFile, cluster.PrecBits, csvFile)
+	}
+
+	return ReadClusterFromCsv(csvFile, i, dim, precBits)
+}
+
 func PackClusters(clusters []*Cluster, maxCapacity uint64) ([][]uint, []uint64) {
 	numClusters := uint64(len(clusters))
 	if numClusters == 0 {
@@ -146,7 +267,7 @@ func ReadAllClusters(clusterPreamble string, precBits uint64) (Metadata, []*Clus
 	numClusters := metadata.NumClusters
 	dim := metadata.Dim
 
-	// file names of clusters are dir/prefix_cluster_0.csv, ..., until the last cluster (number of clusters is metadata.NumClusters)
+	// file names of clusters are dir/prefix_cluster_0.bin (or .csv), ..., until the last cluster (number of clusters is metadata.NumClusters)
 
 	fmt.Printf("Building database with %d %d-dim %d-bit vectors, organized in %d clusters\n", numVectors, dim, precBits, numClusters)
 
@@ -159,9 +280,7 @@ func ReadAllClusters(clusterPreamble string, precBits uint64) (Metadata, []*Clus
 	clusters := make([]*Cluster, numClusters)
 
 	for i := uint64(0); i < numClusters; i++ {
-		clusterFile := filepath.Join(dir, fmt.Sprintf("%s_cluster_%d.csv", prefix, i))
-		// clusterNumVec, clusterDim, clusterPrecBits, clusterVec := ReadClusterFromCsv(clusterFile)
-		clusters[i] = ReadClusterFromCsv(clusterFile, i, dim, precBits)
+		clusters[i] = ReadCluster(dir, prefix, i, dim, precBits)
 		cluster_sizes[i] = clusters[i].NumVectors
 		vecCountVeri += clusters[i].NumVectors
 
@@ -56,3 +56,28 @@ func TestBuildVectorDatabase(t *testing.T) {
 	_, _ = BuildVectorDatabase(metadata, clusters, seed, 900, 5)
 	utils.RemoveTestData()
 }
+
+func TestReadClusterFromBin(t *testing.T) {
+	preamble := utils.GenerateTestData()
+	// Round trip cluster 0 through the binary format
+	csvCluster := ReadClusterFromCsv(preamble+"_cluster_0.csv", 0, 10, 5)
+	WriteClusterToBin(preamble+"_cluster_0.bin", csvCluster)
+	binCluster := ReadClusterFromBin(preamble+"_cluster_0.bin", 0, 10)
+
+	if binCluster.NumVectors != csvCluster.NumVectors || binCluster.PrecBits != csvCluster.PrecBits {
+		t.Fatalf("Header mismatch: got %d vectors / %d bits, want %d / %d",
+			binCluster.NumVectors, binCluster.PrecBits, csvCluster.NumVectors, csvCluster.PrecBits)
+	}
+	for i := range csvCluster.Vectors {
+		if binCluster.Vectors[i] != csvCluster.Vectors[i] {
+			t.Fatalf("Vector value %d mismatch: got %d, want %d", i, binCluster.Vectors[i], csvCluster.Vectors[i])
+		}
+	}
+
+	// ReadAllClusters should now pick up the binary file for cluster 0
+	_, clusters := ReadAllClusters(preamble, 5)
+	if clusters[0].NumVectors != csvCluster.NumVectors {
+		t.Fatalf("ReadAllClusters read %d vectors for cluster 0, want %d", clusters[0].NumVectors, csvCluster.NumVectors)
+	}
+	utils.RemoveTestData()
+}
@@ -1,50 +1,175 @@
+import argparse
+import json
 import os
-import sys
+import struct
 import numpy as np
-from sklearn.cluster import KMeans
 
-def generate_test_files(num_vectors, dim, num_clusters, preamble, num_queries=10):
+# This script is run by the Go tests (utils.GenerateTestData), so it depends on
+# numpy only. The binary layout matches clustering/prepare_tiptoe_data/cluster_format.py
+# and search/database.ReadClusterFromBin:
+#   magic "TTCL" | uint32 version | uint64 dim | uint64 count | uint64 precBits | int8 values
+BIN_HEADER = struct.Struct("<4sIQQQ")
+
+
+class ClusterBinWriter:
+    """Streams float vectors into a binary cluster file, quantized like utils.QuantizeClamp."""
+
+    def __init__(self, path, dim, prec_bits):
+        self.dim = dim
+        self.prec_bits = prec_bits
+        self.count = 0
+        self.f = open(path, "wb", buffering=1 << 22)
+        self.f.write(BIN_HEADER.pack(b"TTCL", 1, dim, 0, prec_bits))
+
+    def write(self, vectors):
+        scale = 1 << (self.prec_bits - 1)
+        scaled = np.asarray(vectors, dtype=np.float64) * scale
+        quantized = np.sign(scaled) * np.floor(np.abs(scaled) + 0.5)
+        self.f.write(np.clip(quantized, -scale, scale).astype(np.int16).astype(np.int8).tobytes())
+        self.count += len(vectors)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.f.seek(0)
+        self.f.write(BIN_HEADER.pack(b"TTCL", 1, self.dim, self.count, self.prec_bits))
+        self.f.close()
+
+
+def merge_topk(best_scores, best_ids, scores, ids, k):
+    """Merges a block of candidate (scores, ids) into the running per-query top-k (unsorted)."""
+    all_scores = np.concatenate([best_scores, scores], axis=1)
+    all_ids = np.concatenate([best_ids, ids], axis=1)
+    top = np.argpartition(-all_scores, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(all_scores, top, axis=1), np.take_along_axis(all_ids, top, axis=1)
+
+
+def cluster_sizes(num_vectors, num_clusters, skew, rng):
+    """
+    Zipf-like cluster sizes, size ~ 1 / rank^skew (skew=0 gives equal sizes), in
+    random cluster order. Every cluster gets at least one vector and the sizes sum
+    to num_vectors exactly.
+    """
+    if num_vectors < num_clusters:
+        raise ValueError(f"Need at least one vector per cluster, got {num_vectors} vectors for {num_clusters} clusters")
+    weights = 1.0 / np.arange(1, num_clusters + 1) ** skew
+    weights = rng.permutation(weights / weights.sum())
+
+    # Largest-remainder rounding of the vectors left after the one-per-cluster minimum
+    share = weights * (num_vectors - num_clusters)
+    sizes = np.floor(share).astype(np.int64)
+    remainder = num_vectors - num_clusters - sizes.sum()
+    sizes[np.argsort(sizes - share, kind="stable")[:remainder]] += 1
+    return sizes + 1
+
+
+def sample_sphere(center, count, spread, rng):
+    """Unit vectors scattered around a unit center; larger spread gives wider clusters."""
+    dim = center.shape[0]
+    points = center + rng.standard_normal((count, dim), dtype=np.float32) * np.float32(spread / np.sqrt(dim))
+    points /= np.linalg.norm(points, axis=1, keepdims=True)
+    return points
+
+
+def generate_test_files(num_vectors, dim, num_clusters, preamble, num_queries=10, skew=0.0, spread=1.0, top_k=10,
+                        file_format="csv", prec_bits=5, chunk_size=65536, npy_output=None, seed=0):
+    """
+    Streams a Gaussian mixture on the unit sphere straight into the per-cluster
+    files (one chunk of vectors in memory at a time) and writes the matching
+    queries, their exact top-k ground truth as (cluster, position) pairs, and
+    the metadata. Documents belong to the mixture component they were drawn from;
+    queries are routed to their nearest component center.
+    """
     # get the dir of preamble and create it if it does not exist
-    os.makedirs(os.path.dirname(preamble), exist_ok=True)
-    all_vectors = np.random.uniform(-1, 1, (num_vectors, dim))
-    queries = np.random.uniform(-1, 1, (num_queries, dim))
-
-    # normalize all vectors and queries such that l2 norm is 1, so that cosine similarity is the same as dot product
-    all_vectors = all_vectors / np.linalg.norm(all_vectors, axis=1, keepdims=True)
-    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
-
-    kmeans = KMeans(n_clusters=num_clusters, random_state=0).fit(all_vectors)
-    clusters = [[] for _ in range(num_clusters)]
-    for i in range(num_vectors):
-        clusters[kmeans.labels_[i]].append(all_vectors[i])
-
-    # get the cluster ids of all query vectors
-    queries_labels = kmeans.predict(queries)
-
-    for i in range(num_clusters):
-        with open(f"{preamble}_cluster_{i}.csv", "w") as f:
-            np.savetxt(f, clusters[i], delimiter=",", fmt="%s")
-    
+    os.makedirs(os.path.dirname(preamble) or ".", exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    centers = rng.standard_normal((num_clusters, dim), dtype=np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    sizes = cluster_sizes(num_vectors, num_clusters, skew, rng)
+
+    # Queries follow the same mixture as the documents
+    components = rng.choice(num_clusters, size=num_queries, p=sizes / num_vectors)
+    queries = np.concatenate([sample_sphere(centers[c], 1, spread, rng) for c in components]) if num_queries else \
+        np.empty((0, dim), dtype=np.float32)
+    query_clusters = np.argmax(queries @ centers.T, axis=1) if num_queries else np.empty(0, dtype=np.int64)
+
+    k = min(top_k, num_vectors)
+    best_scores = np.full((num_queries, k), -np.inf, dtype=np.float32)
+    best_ids = np.full((num_queries, k), -1, dtype=np.int64)
+
+    docs = None
+    if npy_output:
+        docs = np.lib.format.open_memmap(npy_output + "_docs.npy", mode="w+", dtype=np.float32, shape=(num_vectors, dim))
+
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    for c in range(num_clusters):
+        path = f"{preamble}_cluster_{c}.{file_format}"
+        writer = ClusterBinWriter(path, dim, prec_bits) if file_format == "bin" else open(path, "w")
+        with writer:
+            for offset in range(0, sizes[c], chunk_size):
+                chunk = sample_sphere(centers[c], min(chunk_size, sizes[c] - offset), spread, rng)
+                if file_format == "bin":
+                    writer.write(chunk)
+                else:
+                    np.savetxt(writer, chunk, delimiter=",", fmt="%.6f")
+                if docs is not None:
+                    docs[starts[c] + offset:starts[c] + offset + len(chunk)] = chunk
+
+                # Fold the chunk into the running exact top-k of every query
+                scores = queries @ chunk.T
+                kk = min(k, len(chunk))
+                top = np.argpartition(-scores, kk - 1, axis=1)[:, :kk]
+                best_scores, best_ids = merge_topk(best_scores, best_ids, np.take_along_axis(scores, top, axis=1),
+                                                   top + starts[c] + offset, k)
+        if (c + 1) % max(1, num_clusters // 10) == 0:
+            print(f"Wrote {c + 1}/{num_clusters} clusters")
+
     # save queries to a csv file, each row is cluster id followed by the query vector
-    with open(f"{preamble}_queries.csv", "w") as f:
-        for i in range(num_queries):
-            f.write(f"{queries_labels[i]},")
-            np.savetxt(f, queries[i].reshape(1, -1), delimiter=",", fmt="%s")
+    fmt = ['%d'] + ['%.6f'] * dim
+    np.savetxt(f"{preamble}_query.csv", np.hstack((query_clusters.reshape(-1, 1), queries)), delimiter=",", fmt=fmt)
+
+    # Ground truth in the (cluster, position) CSV layout of prepare_ground_truth.py, best first
+    best_ids = np.take_along_axis(best_ids, np.argsort(-best_scores, axis=1, kind="stable"), axis=1)
+    gt_clusters = np.searchsorted(starts, best_ids, side="right") - 1
+    rows = np.empty((num_queries, 2 * k), dtype=np.int64)
+    rows[:, 0::2] = gt_clusters
+    rows[:, 1::2] = best_ids - starts[gt_clusters]
+    np.savetxt(f"{preamble}_ground_truth.csv", rows, delimiter=",", fmt="%d")
+
+    if docs is not None:
+        docs.flush()
+        del docs
+        np.save(npy_output + "_queries.npy", queries)
+        np.save(npy_output + "_gnd.npy", best_ids)
+        np.save(npy_output + "_assignments.npy", np.repeat(np.arange(num_clusters), sizes))
 
     with open(f"{preamble}_metadata.json", "w") as f:
-        f.write("{\n")
-        f.write(f'  "num_vectors": {num_vectors},\n')
-        f.write(f'  "num_clusters": {num_clusters},\n')
-        f.write(f'  "dim": {dim}\n')
-        f.write("}\n")
+        json.dump({"num_vectors": num_vectors, "num_clusters": num_clusters, "dim": dim}, f, indent=2)
+    print(f"Generated {num_vectors} vectors in {num_clusters} clusters (largest {sizes.max()}, "
+          f"smallest {sizes.min()}) and {num_queries} queries under {preamble}")
 
-# if __name__ == "__main__":
-#     generate_test_files(100, 10, 5, "./test_data/test")
 
-# four arguments from command line
+# four positional arguments from command line, as passed by utils.GenerateTestData
 if __name__ == "__main__":
-    num_vectors = int(sys.argv[1])
-    dim = int(sys.argv[2])
-    num_clusters = int(sys.argv[3])
-    preamble = sys.argv[4]
-    generate_test_files(num_vectors, dim, num_clusters, preamble)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Generate a clustered synthetic dataset in Tiptoe format.")
+    parser.add_argument('num_vectors', type=int, help="Number of document vectors")
+    parser.add_argument('dim', type=int, help="Vector dimension")
+    parser.add_argument('num_clusters', type=int, help="Number of clusters")
+    parser.add_argument('preamble', help="Output prefix, including the directory")
+    parser.add_argument('--num_queries', type=int, default=10, help="Number of query vectors")
+    parser.add_argument('--skew', type=float, default=0.0, help="Zipf exponent of the cluster sizes (0 for equal sizes)")
+    parser.add_argument('--spread', type=float, default=1.0, help="Noise scale around each cluster center")
+    parser.add_argument('--top_k', type=int, default=10, help="Ground-truth neighbors per query")
+    parser.add_argument('--format', choices=['csv', 'bin'], default='csv', help="Cluster file format")
+    parser.add_argument('--prec_bits', type=int, default=5, help="Quantization bits for the binary format")
+    parser.add_argument('--chunk_size', type=int, default=65536, help="Vectors generated per chunk")
+    parser.add_argument('--npy_output', default=None, help="Also write <prefix>_docs/_queries/_gnd/_assignments.npy for the clustering scripts")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed")
+
+    args = parser.parse_args()
+    generate_test_files(args.num_vectors, args.dim, args.num_clusters, args.preamble, num_queries=args.num_queries,
+                        skew=args.skew, spread=args.spread, top_k=args.top_k, file_format=args.format,
+                        prec_bits=args.prec_bits, chunk_size=args.chunk_size, npy_output=args.npy_output,
+                        seed=args.seed)
@@ -0,0 +1,202 @@
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+from evaluate import evaluate_keys, pairs_to_keys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "clustering", "util_scripts"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "clustering", "prepare_tiptoe_data"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "clustering", "cluster_model"))
+from pir_layout import HINT_SZ, column_capacity, pack_clusters
+from quantization_sweep import smooth_scores
+from vector_io import load_vectors
+from cluster_format import quantize_clamp
+from reverse_index import ReverseIndex
+from router import Router
+
+MODES = ("clusterOnly", "bin")
+
+
+class SimulatedDatabase:
+    """
+    The plaintext view of the server's database: clusters packed into columns
+    exactly as PackClusters does, documents within a cluster in doc id order (as
+    prepare_doc_data writes them), and the rows a client scores for a cluster.
+
+    Like ReconstructWithinCluster and ReconstructWithinBin, the candidates include
+    the zero padding rows below the last cluster of a column, labelled as further
+    positions of that cluster; they score 0.
+    """
+
+    def __init__(self, cluster_ids, num_clusters, hint_sz=HINT_SZ):
+        self.cluster_ids = np.ravel(cluster_ids).astype(np.int64)
+        self.sizes = np.bincount(self.cluster_ids, minlength=num_clusters)
+        self.columns, column_sizes = pack_clusters(self.sizes, column_capacity(hint_sz))
+        self.num_rows = int(column_sizes.max())
+        self.order = np.argsort(self.cluster_ids, kind="stable")
+        self.starts = np.r_[0, np.cumsum(self.sizes)[:-1]]
+
+        self.column_of = np.empty(num_clusters, dtype=np.int64)
+        self.padding_of = np.zeros(num_clusters, dtype=np.int64)
+        for column, (clusters, size) in enumerate(zip(self.columns, column_sizes)):
+            self.column_of[clusters] = column
+            self.padding_of[clusters[-1]] = self.num_rows - size
+
+    def cluster_rows(self, cluster):
+        """(doc_ids, cluster_labels, positions, num_padding) of one cluster."""
+        docs = self.order[self.starts[cluster]:self.starts[cluster] + self.sizes[cluster]]
+        return docs, np.full(len(docs), cluster, dtype=np.int64), np.arange(len(docs), dtype=np.int64), \
+            int(self.padding_of[cluster])
+
+    def candidates(self, unit, mode):
+        """
+        Rows the client scores for a unit: a cluster in clusterOnly mode, a column
+        in bin mode. Returns (doc_ids, labels, positions, padding_label, padding_start, num_padding).
+        """
+        clusters = [unit] if mode == "clusterOnly" else self.columns[unit]
+        parts = [self.cluster_rows(cluster) for cluster in clusters]
+        last = clusters[-1]
+        return (np.concatenate([part[0] for part in parts]), np.concatenate([part[1] for part in parts]),
+                np.concatenate([part[2] for part in parts]), last, int(self.sizes[last]), parts[-1][3])
+
+    def unit_of(self, clusters, mode):
+        return clusters if mode == "clusterOnly" else self.column_of[clusters]
+
+
+def _merge(best_scores, best_labels, best_positions, scores, labels, positions, k):
+    all_scores = np.concatenate([best_scores, scores], axis=1)
+    all_labels = np.concatenate([best_labels, labels], axis=1)
+    all_positions = np.concatenate([best_positions, positions], axis=1)
+    top = np.argsort(-all_scores, axis=1, kind="stable")[:, :k]
+    return (np.take_along_axis(all_scores, top, axis=1), np.take_along_axis(all_labels, top, axis=1),
+            np.take_along_axis(all_positions, top, axis=1))
+
+
+def simulate(db, doc_vectors, queries, routes, mode, k=10, prec_bits=5, query_block_size=4096):
+    """
+    Top-k (cluster, position) pairs per query with the server's quantized,
+    mod 2^15 scores, over the rows the client would score for each routed
+    cluster. With several routes per query (multi-probe), every probe is one
+    PIR query and the results are merged by score; probes that hit the same
+    cluster (or, in bin mode, the same column) are scored once.
+    Returns (num_queries, 2k) pairs, -1 where there are fewer than k candidates.
+    """
+    num_queries = queries.shape[0]
+    quantized_queries = quantize_clamp(queries, prec_bits).astype(np.float32)
+    units = db.unit_of(routes, mode)
+    best_scores = np.full((num_queries, k), -np.inf, dtype=np.float64)
+    best_labels = np.full((num_queries, k), -1, dtype=np.int64)
+    best_positions = np.full((num_queries, k), -1, dtype=np.int64)
+
+    for probe in range(units.shape[1]):
+        fresh = np.all(units[:, :probe] != units[:, probe:probe + 1], axis=1)
+        query_ids = np.flatnonzero(fresh)
+        # Queries of one unit share their candidate rows, so they are scored together
+        query_ids = query_ids[np.argsort(units[query_ids, probe], kind="stable")]
+        unit_values, unit_starts = np.unique(units[query_ids, probe], return_index=True)
+        for unit, start, end in zip(unit_values, unit_starts, np.r_[unit_starts[1:], len(query_ids)]):
+            docs, labels, positions, padding_label, padding_start, num_padding = db.candidates(unit, mode)
+            # Rows are gathered in doc id order, which is sequential on a memory map
+            doc_block = np.empty((len(docs), doc_vectors.shape[1]), dtype=np.float32)
+            gather = np.argsort(docs, kind="stable")
+            doc_block[gather] = quantize_clamp(np.asarray(doc_vectors[docs[gather]], dtype=np.float32), prec_bits)
+            # Identical zero scores, so only the first k padding rows can make the top-k
+            num_padding = min(num_padding, k)
+            labels = np.r_[labels, np.full(num_padding, padding_label, dtype=np.int64)]
+            positions = np.r_[positions, padding_start + np.arange(num_padding, dtype=np.int64)]
+
+            for q in range(start, end, query_block_size):
+                block = query_ids[q:min(q + query_block_size, end)]
+                scores = smooth_scores((quantized_queries[block] @ doc_block.T).astype(np.int64))
+                scores = np.concatenate([scores, np.zeros((len(block), num_padding), dtype=np.int64)], axis=1)
+                kk = min(k, scores.shape[1])
+                top = np.argpartition(-scores, kk - 1, axis=1)[:, :kk]
+                merged = _merge(best_scores[block], best_labels[block], best_positions[block],
+                                np.take_along_axis(scores, top, axis=1).astype(np.float64), labels[top], positions[top], k)
+                best_scores[block], best_labels[block], best_positions[block] = merged
+
+    pairs = np.empty((num_queries, 2 * k), dtype=np.int64)
+    pairs[:, 0::2], pairs[:, 1::2] = best_labels, best_positions
+    return pairs
+
+
+def write_results(path, pairs):
+    """Writes pairs in the server's results CSV format, rows shortened where there are fewer than k."""
+    with open(path, "w") as f:
+        for row in pairs:
+            row = row[:np.count_nonzero(row >= 0) // 2 * 2]
+            f.write(",".join(map(str, row)) + "\n")
+
+
+def main(args):
+    doc_vectors = load_vectors(args.doc_embeddings_path)
+    cluster_ids = np.ravel(np.load(args.cluster_assignments_path)).astype(np.int64)
+    queries = np.asarray(load_vectors(args.query_embeddings_path)[:args.num_queries], dtype=np.float32)
+
+    # Routes: precomputed ids (e.g. from router.py), a router artifact, or the nearest centroids
+    if args.routes_path:
+        routes = np.load(args.routes_path)
+        routes = routes.reshape(routes.shape[0], -1)[:len(queries), :args.num_probes].astype(np.int64)
+    else:
+        router = Router.load(args.router_path) if args.router_path else Router.from_centroids(np.load(args.centroids_path))
+        routes = router.route(queries, m=args.num_probes)[0]
+    if routes.shape[0] != len(queries):
+        raise ValueError(f"{routes.shape[0]} routes for {len(queries)} queries")
+
+    num_clusters = max(int(cluster_ids.max()), int(routes.max())) + 1
+    db = SimulatedDatabase(cluster_ids, num_clusters, args.hint_sz)
+    print(f"Simulated database: {db.num_rows} rows x {len(db.columns)} columns for {len(cluster_ids)} documents "
+          f"in {num_clusters} clusters, {routes.shape[1]} probe(s) per query")
+
+    gt_keys = None
+    if args.ground_truth_path:
+        gt_doc_ids = np.asarray(load_vectors(args.ground_truth_path)[:len(queries)])
+        gt_clusters, gt_positions = ReverseIndex.from_assignments(cluster_ids).lookup(gt_doc_ids)
+        gt_pairs = np.empty((gt_doc_ids.shape[0], 2 * gt_doc_ids.shape[1]), dtype=np.int64)
+        gt_pairs[:, 0::2], gt_pairs[:, 1::2] = gt_clusters, gt_positions
+        gt_keys = pairs_to_keys(gt_pairs)
+
+    metrics = {}
+    for mode in args.modes:
+        start = time.time()
+        pairs = simulate(db, doc_vectors, queries, routes, mode, args.k, args.prec_bits, args.query_block_size)
+        suffix = "_results_cluster_only.csv" if mode == "clusterOnly" else "_results.csv"
+        write_results(args.output_prefix + suffix, pairs)
+        print(f"{mode}: {len(queries)} queries in {time.time() - start:.2f}s, results saved to {args.output_prefix + suffix}")
+        if gt_keys is not None:
+            k = min(args.k, gt_keys.shape[1])
+            metrics[mode] = evaluate_keys(pairs_to_keys(pairs), gt_keys, k)
+            print(f"{mode}: recall@{k} {metrics[mode]['recall']:.4f}  mrr@{k} {metrics[mode]['mrr']:.4f}  "
+                  f"ndcg@{k} {metrics[mode]['ndcg']:.4f}")
+
+    if args.output_json and metrics:
+        with open(args.output_json, "w") as f:
+            json.dump(metrics, f, indent=2)
+        print(f"Saved metrics to {args.output_json}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate the Tiptoe search in plaintext to predict its results and recall without running the PIR protocol.")
+    parser.add_argument('--doc_embeddings_path', required=True, help="Path to normalized document embeddings (.npy or .fbin)")
+    parser.add_argument('--cluster_assignments_path', required=True, help="Path to the documents' cluster assignments .npy file")
+    parser.add_argument('--query_embeddings_path', required=True, help="Path to normalized query embeddings (.npy or .fbin)")
+    routing = parser.add_mutually_exclusive_group(required=True)
+    routing.add_argument('--routes_path', help="Routed cluster ids .npy, (num_queries,) or (num_queries, probes)")
+    routing.add_argument('--router_path', help="Router artifact .npz to route the queries with")
+    routing.add_argument('--centroids_path', help="Centroids .npy to route the queries to the nearest ones")
+    parser.add_argument('--num_probes', type=int, default=1, help="Clusters searched per query (one PIR query each)")
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES), help="Candidate sets to simulate")
+    parser.add_argument('--output_prefix', required=True, help="Results go to <prefix>_results.csv / <prefix>_results_cluster_only.csv")
+    parser.add_argument('--ground_truth_path', default=None, help="Optional doc-id ground truth (.npy/.ibin) to report recall")
+    parser.add_argument('--num_queries', type=int, default=None, help="Only use the first num_queries queries")
+    parser.add_argument('--k', type=int, default=10, help="Results per query, like the server's -topk")
+    parser.add_argument('--prec_bits', type=int, default=5, help="Quantization bits, like the server's -precBits")
+    parser.add_argument('--hint_sz', type=int, default=HINT_SZ, help="Server hintSz; columns hold hint_sz * 125 rows")
+    parser.add_argument('--query_block_size', type=int, default=4096, help="Queries per matrix product")
+    parser.add_argument('--output_json', default=None, help="Optional path to save the metrics as JSON")
+
+    args = parser.parse_args()
+    main(args)